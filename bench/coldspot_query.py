@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+Benchmark of batched cold spot queries against a linear scan.
+
+An index of --spots random cold spots over 16 amplifiers is built in
+memory and --queries radius queries are answered in one batch:
+
+  $ python bench/coldspot_query.py --spots 1000000 --queries 10000
+
+The first --check queries are also answered by scanning every spot
+and the answers compared.  The exit code is 1 if they differ or if
+the batch takes longer than ``--max-seconds``.
+'''
+
+import sys
+import time
+import numpy
+from optparse import OptionParser
+
+from lcatr.schema import coldspots
+
+def main(argv):
+    parser = OptionParser(usage = __doc__)
+    parser.add_option('--spots', type='int', default=1000000,
+                      help='Number of cold spots')
+    parser.add_option('--queries', type='int', default=10000,
+                      help='Number of radius queries in the batch')
+    parser.add_option('--radius', type='float', default=20.0,
+                      help='Query radius in pixels')
+    parser.add_option('--check', type='int', default=100,
+                      help='Number of queries to check against a scan')
+    parser.add_option('--max-seconds', type='float', default=2.0,
+                      help='Longest the batch may take')
+    opts, args = parser.parse_args(argv)
+
+    rand = numpy.random.RandomState(1)
+    amp = rand.randint(1, 17, opts.spots)
+    x = rand.randint(0, 512, opts.spots)
+    y = rand.randint(0, 2002, opts.spots)
+    file_id = rand.randint(0, 1000, opts.spots)
+    start = time.time()
+    index = coldspots.SpotIndex(amp, x, y, numpy.ones(opts.spots), file_id,
+                                ['ccd%04d' % count for count in range(1000)])
+    print '%d spots indexed in %.2f s' % (opts.spots, time.time() - start)
+
+    qamp = rand.randint(1, 17, opts.queries)
+    qx = rand.uniform(0, 512, opts.queries)
+    qy = rand.uniform(0, 2002, opts.queries)
+    start = time.time()
+    query, spot = index.radius(qamp, qx, qy, opts.radius)
+    took = time.time() - start
+    print '%d queries, %d matches in %.3f s' % (opts.queries, len(query), took)
+
+    start = time.time()
+    bad = 0
+    for count in range(opts.check):
+        near = (amp == qamp[count]) & (numpy.hypot(x - qx[count], y - qy[count]) <= opts.radius)
+        if near.sum() != (query == count).sum():
+            bad += 1
+        continue
+    scan = (time.time() - start) / max(opts.check, 1)
+    print 'scan: %.4f s per query, about %.1f s for the batch' % (scan, scan * opts.queries)
+
+    if bad:
+        print '%d queries differ from the scan' % bad
+        return 1
+    if took > opts.max_seconds:
+        print 'batch took longer than %.1f s' % opts.max_seconds
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
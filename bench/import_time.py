@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+Import time benchmark for lcatr.schema.
+
+Each import statement is run in a fresh interpreter several times and
+the best wall clock time, less that of an interpreter doing nothing,
+is reported along with the number of modules it left loaded:
+
+  $ python bench/import_time.py --budget bench/import_budget.json
+
+With ``--budget`` the times are checked against the JSON file, which
+maps each statement to its allowed milliseconds, and the exit code is
+1 if any goes over.  ``--write-budget`` stores the measured times,
+scaled by ``--slack``, as a new budget.
+
+Interpreters which support ``-X importtime`` (Python 3.7 and later)
+give a per-module breakdown of the same imports with:
+
+  $ python -X importtime -c 'import lcatr.schema'
+'''
+
+import os
+import sys
+import json
+import time
+from subprocess import Popen, PIPE
+from optparse import OptionParser
+
+#: The import statements timed by default, from lightest to heaviest.
+statements = [
+    'import lcatr.schema',
+    'import lcatr.schema.util',
+    'import lcatr.schema.headers',
+    'import lcatr.schema.verifier',
+    'import lcatr.schema.base',
+    'import lcatr.schema; lcatr.schema.load()',
+    ]
+
+def python_path():
+    '''
+    Return a PYTHONPATH which finds this source tree first.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(here, '..', 'python')
+    return os.pathsep.join([path, os.environ.get('PYTHONPATH', '')])
+
+def run_one(statement):
+    '''
+    Run the statement in a fresh interpreter and return (seconds,
+    number of modules loaded).
+    '''
+    code = statement + '\nimport sys\nprint len(sys.modules)'
+    env = dict(os.environ, PYTHONPATH = python_path())
+    start = time.time()
+    proc = Popen([sys.executable, '-c', code], stdout=PIPE, stderr=PIPE, env=env)
+    out, err = proc.communicate()
+    took = time.time() - start
+    if proc.returncode:
+        raise RuntimeError, 'failed to run "%s":\n%s' % (statement, err)
+    return took, int(out.split()[-1])
+
+def measure(statement, repeat):
+    '''
+    Return the best of repeat (seconds, modules) for the statement.
+    '''
+    runs = [run_one(statement) for count in range(repeat)]
+    return min(took for took,nmods in runs), runs[0][1]
+
+def main(argv):
+    parser = OptionParser(usage = __doc__)
+    parser.add_option('--repeat', type='int', default=10,
+                      help='Number of times to run each statement')
+    parser.add_option('--budget', default=None,
+                      help='JSON file of allowed milliseconds per statement')
+    parser.add_option('--write-budget', default=None,
+                      help='Write the measured times as a budget to this JSON file')
+    parser.add_option('--slack', type='float', default=2.0,
+                      help='Factor applied to measured times by --write-budget')
+    opts, args = parser.parse_args(argv)
+
+    budget = dict()
+    if opts.budget:
+        budget = json.load(open(opts.budget))
+
+    base_time, base_mods = measure('pass', opts.repeat)
+    print '%-45s %8s %8s %8s' % ('statement', 'ms', 'budget', 'modules')
+    measured = dict()
+    over = []
+    for statement in args or statements:
+        took, nmods = measure(statement, opts.repeat)
+        ms = max(0.0, (took - base_time) * 1000)
+        measured[statement] = ms
+        allowed = budget.get(statement)
+        flag = ''
+        if allowed is not None and ms > allowed:
+            over.append(statement)
+            flag = ' OVER'
+        print '%-45s %8.1f %8s %8d%s' % (statement, ms, allowed is None and '-' or '%.1f' % allowed,
+                                         nmods - base_mods, flag)
+        continue
+
+    if opts.write_budget:
+        new = dict((stmt, round(ms * opts.slack, 1)) for stmt,ms in measured.items())
+        fp = open(opts.write_budget, 'w')
+        fp.write(json.dumps(new, indent=2, sort_keys=True) + '\n')
+        fp.close()
+
+    if over:
+        print '%d statement(s) over budget' % len(over)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
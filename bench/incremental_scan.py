@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+Benchmark of the incremental ingest scan over a large manifest.
+
+A tree of --dirs directories of --files-per-dir empty files each is
+made and their manifest written straight into a database, without
+loading them, so that a large manifest is cheap to set up:
+
+  $ python bench/incremental_scan.py --dirs 1000 --files-per-dir 100
+
+An update with nothing changed is timed, as it is by default, which
+stats every file, and with ``trust_dirs``, which stats only the
+directories.  Then one after --changed new directories, each holding a
+few copies of a small result file, are added.  The exit code is 1 if
+the default unchanged scan takes longer than ``--max-seconds``.
+'''
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+from optparse import OptionParser
+
+import lcatr.schema
+lcatr.schema.load()
+from lcatr.schema import base, ptc, ingest
+
+def make_manifest(dbfile, root, ndirs, nfiles):
+    '''
+    Make the directories and their files and fill the manifest,
+    returning the number of entries.
+    '''
+    db = ingest.Ingester(dbfile)
+    db.close()
+    conn = sqlite3.connect(dbfile)
+    conn.text_factory = str
+    dirs = []
+    rows = []
+    for count in range(ndirs):
+        dirname = os.path.join(root, 'run%05d' % count)
+        os.makedirs(dirname)
+        for num in range(nfiles):
+            path = os.path.join(dirname, 'result%05d.fits' % num)
+            open(path, 'w').close()
+            rows.append((path, dirname, 0, os.stat(path).st_mtime, '0'*40))
+            continue
+        os.utime(dirname, (1e9, 1e9))
+        dirs.append((dirname, os.stat(dirname).st_mtime))
+        continue
+    os.utime(root, (1e9, 1e9))
+    dirs.append((root, os.stat(root).st_mtime))
+    conn.executemany('INSERT INTO manifest VALUES (?,?,?,?,?)', rows)
+    conn.executemany('INSERT INTO manifest_dirs VALUES (?,?)', dirs)
+    conn.commit()
+    count = conn.execute('SELECT count(*) FROM manifest').fetchone()[0]
+    conn.close()
+    return count
+
+def main(argv):
+    parser = OptionParser(usage = __doc__)
+    parser.add_option('--dirs', type='int', default=1000,
+                      help='Number of directories')
+    parser.add_option('--files-per-dir', type='int', default=100,
+                      help='Number of manifest entries per directory')
+    parser.add_option('--changed', type='int', default=10,
+                      help='Number of new directories of files for the second update')
+    parser.add_option('--max-seconds', type='float', default=2.0,
+                      help='Longest the default unchanged scan may take')
+    opts, args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='lcatr-bench-')
+    try:
+        root = os.path.join(workdir, 'results')
+        dbfile = os.path.join(workdir, 'bench.db')
+        start = time.time()
+        entries = make_manifest(dbfile, root, opts.dirs, opts.files_per_dir)
+        print '%d manifest entries in %d directories made in %.1f s' % \
+            (entries, opts.dirs, time.time() - start)
+
+        db = ingest.Ingester(dbfile)
+        start = time.time()
+        delta = db.update([root], trust_dirs = True)
+        print 'unchanged, trusting directories: %.3f s, %s' % (time.time() - start, delta.summary())
+        start = time.time()
+        delta = db.update([root])
+        unchanged = time.time() - start
+        print 'unchanged: %.3f s, %s' % (unchanged, delta.summary())
+
+        template = os.path.join(workdir, 'template.fits')
+        base.HDUList([ptc.schema[0](), ptc.PtcColdSpotTableHDU(ampnum=[1], pixcount=[1],
+                                                               spotx=[1], spoty=[1])]).writeto(template)
+        for count in range(opts.changed):
+            dirname = os.path.join(root, 'new%05d' % count)
+            os.makedirs(dirname)
+            for num in range(10):
+                shutil.copyfile(template, os.path.join(dirname, 'result%d.fits' % num))
+                continue
+            continue
+        start = time.time()
+        delta = db.update([root])
+        print 'changed:   %.3f s, %s' % (time.time() - start, delta.summary())
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    if unchanged > opts.max_seconds:
+        print 'unchanged scan took longer than %.1f s' % opts.max_seconds
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
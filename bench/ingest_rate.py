@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+Throughput benchmark for loading result files into SQLite.
+
+A LIMS meta data file and a PTC result file with tables of the given
+number of rows are written and copied to make --files files in all,
+which are then loaded with ``ingest.Ingester`` and the rate reported:
+
+  $ python bench/ingest_rate.py --files 5000 --rows 16 --min-rate 2000
+
+The exit code is 1 if fewer than ``--min-rate`` files per minute are
+loaded.  Use ``--no-validate`` to leave out ``HDUList.validate()``
+and ``LCATR_INSTRUMENT=1`` to see where the time goes.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+import numpy
+import lcatr.schema
+lcatr.schema.load()
+from lcatr.schema import base, ptc, limsmeta, ingest, instrument
+
+def write_templates(workdir, rows):
+    '''
+    Write one file of each kind and return their names.
+    '''
+    files = [os.path.join(workdir, 'ref%d.dat' % count) for count in range(4)]
+    for path in files:
+        open(path, 'wb').write(os.urandom(1024))
+        continue
+    meta = os.path.join(workdir, 'template-meta.fits')
+    hdus = base.HDUList([
+            limsmeta.LimsMetaPrimaryHDU(testname='Bench', date_obs='2012-01-01T00:00:00',
+                                        username='bench'),
+            limsmeta.LimsMetaSoftwareTableHDU(commithash=['0'*40], committag=['v1'],
+                                              repourl=['git://bench'], progpath=['bench.py'],
+                                              cmdline=['bench.py'], exitcode=[0]),
+            limsmeta.LimsMetaResultFilesHDU(filename=files, sha1hash=[''] * len(files)),
+            ])
+    hdus[2].generate()
+    hdus.writeto(meta)
+
+    result = os.path.join(workdir, 'template-ptc.fits')
+    amps = numpy.arange(rows)
+    hdus = base.HDUList([ptc.schema[0](),
+                         ptc.PtcInputFilesHDU(filename=files, sha1hash=[''] * len(files)),
+                         ptc.PtcAmpTableHDU(),
+                         ptc.PtcColdSpotTableHDU(ampnum=amps % 16 + 1, pixcount=amps,
+                                                 spotx=amps, spoty=amps)])
+    for name, typestr, comment, kwname in hdus[2].schema_plan().columns:
+        hdus[2].set_column_array(name, numpy.arange(1, rows + 1).astype(base.util.tform_dtype(typestr)))
+        continue
+    hdus[2].sync()
+    hdus[1].generate()
+    hdus.writeto(result)
+    return [meta, result]
+
+def main(argv):
+    parser = OptionParser(usage = __doc__)
+    parser.add_option('--files', type='int', default=2000,
+                      help='Number of files to load')
+    parser.add_option('--rows', type='int', default=16,
+                      help='Rows in each table of the result files')
+    parser.add_option('--batch-size', type='int', default=ingest.Ingester.batch_size,
+                      help='Files per transaction')
+    parser.add_option('--no-validate', action='store_true', default=False,
+                      help='Load without validating')
+    parser.add_option('--min-rate', type='float', default=2000,
+                      help='Fewest files per minute to pass')
+    opts, args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='lcatr-bench-')
+    try:
+        templates = write_templates(workdir, opts.rows)
+        names = []
+        for count in range(opts.files):
+            name = os.path.join(workdir, 'file%06d.fits' % count)
+            shutil.copyfile(templates[count % len(templates)], name)
+            names.append(name)
+            continue
+
+        dbfile = os.path.join(workdir, 'bench.db')
+        start = time.time()
+        cpu = time.clock()
+        db = ingest.Ingester(dbfile, opts.batch_size, not opts.no_validate)
+        for name in names:
+            db.add_file(name)
+            continue
+        db.close()
+        took = time.time() - start
+        cpu = time.clock() - cpu
+        size = os.path.getsize(dbfile)
+    finally:
+        shutil.rmtree(workdir)
+
+    rate = opts.files / took * 60
+    print '%d files in %.2f s (%.2f s CPU), %.0f files/minute, %d not loaded, database %d kB' % \
+        (opts.files, took, cpu, rate, len(db.errors), size / 1024)
+    for path, error in db.errors[:5]:
+        print path, error
+        continue
+    if instrument.enabled:
+        print instrument.stats.to_json()
+    if rate < opts.min_rate or db.errors:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
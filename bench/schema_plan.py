@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark of the cached lcatr.schema schema plan lookup.
+
+``BaseHDU.schema_plan()`` is called on every card and column access,
+so finding the cached plan must cost no more than the list
+concatenation it replaced.  Both are timed, along with
+``get_column()`` which looks columns up through the plan:
+
+  $ python bench/schema_plan.py --calls 1000000
+
+The exit code is 1 if a schema_plan() call takes more than
+``--max-ratio`` times the concatenation, so a slower check for an out
+of date plan shows up on any machine.
+'''
+
+import sys
+import timeit
+from optparse import OptionParser
+
+setup = '''
+import lcatr.schema
+lcatr.schema.load()
+from lcatr.schema import base, ptc
+klass = ptc.PtcAmpTableHDU
+hdu = klass(lineargain = [1.0])
+hdu.sync()
+'''
+
+#: Name and statement of each timing
+statements = [
+    ('list concatenation', 'base.required_cards + (klass.required_cards or list())'),
+    ('schema_plan()', 'klass.schema_plan()'),
+    ('get_column()', 'hdu.get_column("LinearGain")'),
+    ]
+
+def main(argv):
+    parser = OptionParser(usage = __doc__)
+    parser.add_option('--calls', type='int', default=1000000,
+                      help='Number of calls timed for each statement')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='Number of times to time each statement')
+    parser.add_option('--max-ratio', type='float', default=4.0,
+                      help='Most a schema_plan() call may take relative to the concatenation')
+    opts, args = parser.parse_args(argv)
+
+    took = dict()
+    for name, statement in statements:
+        best = min(timeit.repeat(statement, setup, number = opts.calls, repeat = opts.repeat))
+        took[name] = best / opts.calls
+        print '%-20s %8.3f us' % (name, took[name] * 1e6)
+        continue
+
+    ratio = took['schema_plan()'] / took['list concatenation']
+    if ratio > opts.max_ratio:
+        print 'schema_plan() takes %.1f times the concatenation, more than %.1f' % \
+            (ratio, opts.max_ratio)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+'''
+Benchmark suite for the lcatr.schema HDU classes.
+
+Each schema case is filled with tables of each of the given sizes and
+taken through the stages of its life, each timed separately:
+
+  construct   make the HDUList with empty tables
+  fill        set every column with set_column_array() and sync()
+  generate    FileRefTableHDU.generate() on the file references
+  write       HDUList.writeto()
+  open        lcatr_open() and read all table data
+  validate    HDUList.validate() without the result cache
+
+Every (case, size) runs in a forked child so that its peak resident
+memory is its own.  For each stage the wall clock seconds, the peak
+RSS so far (kB) and the net number of Python objects left tracked by
+the garbage collector (a proxy for allocations, as Python 2 has no
+tracemalloc) are recorded:
+
+  $ python bench/schema_suite.py --sizes 16,1k,100k,1M --save baseline.json
+  $ python bench/schema_suite.py --sizes 16,1k,100k,1M --baseline baseline.json
+
+With ``--baseline`` any stage which is slower or uses more memory than
+the baseline by more than ``--tolerance`` is flagged and the exit code
+is 1.  Stages taking less than ``--min-seconds`` are not compared on
+time as they are dominated by noise.  File reference tables have at
+most ``--max-files`` rows, each naming one of a few small scratch
+files, so that generate() measures hashing rather than file creation.
+'''
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import resource
+import tempfile
+from optparse import OptionParser
+
+import numpy
+import lcatr.schema
+lcatr.schema.load()
+from lcatr.schema import base, ptc, limsmeta
+
+from sha1_digest import parse_size
+
+#: The names of the stages in the order they run
+stages = ['construct', 'fill', 'generate', 'write', 'open', 'validate']
+
+def column_array(typestr, size):
+    '''
+    Return an array of the given size suiting the column TFORM.
+    '''
+    dtype = base.util.tform_dtype(typestr)
+    if dtype.kind == 'S':
+        return numpy.array(['x' * dtype.itemsize] * size, dtype=dtype)
+    return numpy.arange(1, size + 1).astype(dtype)     # positive, as gains must be
+
+def make_ptc(size, files):
+    hdus = base.HDUList([ptc.schema[0](), ptc.PtcInputFilesHDU(filename=files, sha1hash=[''] * len(files)),
+                         ptc.PtcAmpTableHDU()])
+    return hdus, hdus[2:]
+
+def make_coldspot(size, files):
+    hdus = base.HDUList([ptc.schema[0](), ptc.PtcColdSpotTableHDU()])
+    return hdus, hdus[1:]
+
+def make_limsmeta(size, files):
+    hdus = base.HDUList([
+            limsmeta.LimsMetaPrimaryHDU(testname='Bench', date_obs='2012-01-01T00:00:00',
+                                        username='bench'),
+            limsmeta.LimsMetaSoftwareTableHDU(),
+            limsmeta.LimsMetaResultFilesHDU(filename=files, sha1hash=[''] * len(files)),
+            ])
+    return hdus, hdus[1:2]
+
+#: Map of case name to a function returning the HDUList and the
+#: tables in it to fill.
+cases = dict(ptc = make_ptc, coldspot = make_coldspot, limsmeta = make_limsmeta)
+
+class Recorder(object):
+    '''
+    Time stages and note their memory and object counts.
+    '''
+    def __init__(self):
+        self.results = dict()
+        return
+
+    def __call__(self, stage, func):
+        gc.collect()
+        objects = len(gc.get_objects())
+        start = time.time()
+        ret = func()
+        took = time.time() - start
+        gc.collect()
+        self.results[stage] = dict(
+            seconds = took,
+            maxrss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            objects = len(gc.get_objects()) - objects)
+        return ret
+    pass
+
+def run_case(case, size, workdir, files):
+    '''
+    Run all stages of one case and size and return the recorded results.
+    '''
+    record = Recorder()
+    hdus, tables = record('construct', lambda: cases[case](size, files))
+
+    def fill():
+        for hdu in tables:
+            for name, typestr, comment, kwname in hdu.schema_plan().columns:
+                hdu.set_column_array(name, column_array(typestr, size))
+                continue
+            hdu.sync()
+            continue
+        return
+    record('fill', fill)
+
+    def generate():
+        for hdu in hdus:
+            if hasattr(hdu, 'generate'):
+                hdu.generate()
+            continue
+        return
+    record('generate', generate)
+
+    filename = os.path.join(workdir, '%s-%d.fits' % (case, size))
+    record('write', lambda: hdus.writeto(filename))
+
+    def open_all():
+        opened = base.lcatr_open(filename)
+        for hdu in opened:
+            if hdu.data is not None:
+                len(hdu.data)
+            continue
+        return opened
+    opened = record('open', open_all)
+    record('validate', lambda: opened.validate(use_cache = False))
+    os.remove(filename)
+    return record.results
+
+def run_forked(case, size, workdir, files):
+    '''
+    Run one case in a child process and return its results.
+    '''
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        try:
+            out = json.dumps(run_case(case, size, workdir, files))
+        except Exception, err:
+            out = json.dumps(dict(error = '%s: %s' % (err.__class__.__name__, err)))
+        os.write(wfd, out)
+        os._exit(0)
+    os.close(wfd)
+    chunks = []
+    while True:
+        chunk = os.read(rfd, 1<<16)
+        if not chunk: break
+        chunks.append(chunk)
+        continue
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(chunks))
+
+def compare(results, baseline, tolerance, min_seconds):
+    '''
+    Return a list of regression descriptions of results against the baseline.
+    '''
+    ret = []
+    for case, sizes in sorted(results.items()):
+        for size, got in sorted(sizes.items()):
+            want = baseline.get(case, {}).get(size)
+            if not want or 'error' in want or 'error' in got:
+                continue
+            for stage in stages:
+                new, old = got[stage], want.get(stage)
+                if not old: continue
+                if new['seconds'] >= min_seconds and \
+                        new['seconds'] > old['seconds'] * (1 + tolerance):
+                    ret.append('%s/%s/%s: %.3f s, was %.3f s' %
+                               (case, size, stage, new['seconds'], old['seconds']))
+                if new['maxrss_kb'] > old['maxrss_kb'] * (1 + tolerance):
+                    ret.append('%s/%s/%s: %d kB peak RSS, was %d kB' %
+                               (case, size, stage, new['maxrss_kb'], old['maxrss_kb']))
+                continue
+            continue
+        continue
+    return ret
+
+def main(argv):
+    parser = OptionParser(usage = __doc__)
+    parser.add_option('--cases', default=','.join(sorted(cases)),
+                      help='Comma separated list of cases to run')
+    parser.add_option('--sizes', default='16,1k,100k',
+                      help='Comma separated list of table row counts')
+    parser.add_option('--max-files', type='int', default=1000,
+                      help='Most rows in a file reference table')
+    parser.add_option('--save', default=None,
+                      help='Write the results as JSON to this file')
+    parser.add_option('--baseline', default=None,
+                      help='Compare against results saved in this JSON file')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='Allowed fractional increase over the baseline')
+    parser.add_option('--min-seconds', type='float', default=0.05,
+                      help='Stages faster than this are not compared on time')
+    opts, args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='lcatr-bench-')
+    results = dict()
+    try:
+        scratch = []
+        for count in range(8):
+            path = os.path.join(workdir, 'ref%d.dat' % count)
+            open(path, 'wb').write(os.urandom(4096))
+            scratch.append(path)
+            continue
+
+        print '%-10s %8s %-10s %10s %12s %10s' % ('case', 'rows', 'stage', 'seconds',
+                                                 'maxrss(kB)', 'objects')
+        for case in opts.cases.split(','):
+            for text in opts.sizes.split(','):
+                size = parse_size(text)
+                nfiles = min(size, opts.max_files)
+                files = [scratch[n % len(scratch)] for n in range(nfiles)]
+                got = run_forked(case, size, workdir, files)
+                results.setdefault(case, dict())[str(size)] = got
+                if 'error' in got:
+                    print '%-10s %8d %s' % (case, size, got['error'])
+                    continue
+                for stage in stages:
+                    res = got[stage]
+                    print '%-10s %8d %-10s %10.4f %12d %10d' % \
+                        (case, size, stage, res['seconds'], res['maxrss_kb'], res['objects'])
+                    continue
+                continue
+            continue
+    finally:
+        shutil.rmtree(workdir)
+
+    if opts.save:
+        fp = open(opts.save, 'w')
+        fp.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+        fp.close()
+
+    if opts.baseline:
+        regressions = compare(results, json.load(open(opts.baseline)),
+                              opts.tolerance, opts.min_seconds)
+        for line in regressions:
+            print 'REGRESSION', line
+            continue
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark of lcatr.schema.util.sha1_file() buffer sizes.
+
+A scratch file of the given size is written (or an existing file is
+used) and hashed once per buffer size, each time in a forked child so
+that its peak resident memory can be reported separately:
+
+  $ python bench/sha1_digest.py --size 1024 --buffers 4k,64k,1M,16M
+
+Sizes take an optional k, M or G suffix.  The file is removed
+afterwards unless it was given with ``--file``.
+'''
+
+import os
+import sys
+import time
+import resource
+import tempfile
+from optparse import OptionParser
+
+from lcatr.schema import util
+
+def parse_size(text):
+    '''
+    Convert "64k", "1M", etc to a number of bytes.
+    '''
+    mult = dict(k=1<<10, m=1<<20, g=1<<30)
+    text = text.strip()
+    suffix = text[-1].lower()
+    if suffix in mult:
+        return int(float(text[:-1]) * mult[suffix])
+    return int(text)
+
+def make_file(size):
+    '''
+    Write a scratch file of the given size and return its path.
+    '''
+    fd, path = tempfile.mkstemp(prefix='lcatr-sha1-bench-')
+    chunk = os.urandom(1<<20)
+    left = size
+    while left > 0:
+        os.write(fd, chunk[:left])
+        left -= len(chunk)
+        continue
+    os.close(fd)
+    return path
+
+def run_one(path, bufsize):
+    '''
+    Hash the file in a child process and return (seconds, peak RSS in kB).
+    '''
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        start = time.time()
+        util.sha1_file(path, bufsize)
+        os.write(wfd, '%f' % (time.time() - start))
+        os._exit(0)
+    os.close(wfd)
+    took = float(os.read(rfd, 64))
+    os.close(rfd)
+    pid, status, usage = os.wait4(pid, 0)
+    return took, usage.ru_maxrss
+
+def main(argv):
+    parser = OptionParser(usage = __doc__)
+    parser.add_option('--size', default='256M',
+                      help='Size of the scratch file to hash')
+    parser.add_option('--file', default=None,
+                      help='Hash this file instead of a scratch one')
+    parser.add_option('--buffers', default='4k,64k,256k,1M,4M,16M',
+                      help='Comma separated list of buffer sizes')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='Number of times to hash for each buffer size')
+    opts, args = parser.parse_args(argv)
+
+    path = opts.file or make_file(parse_size(opts.size))
+    size = os.stat(path).st_size
+    try:
+        print '%10s %10s %10s %12s' % ('buffer', 'best(s)', 'MB/s', 'maxrss(kB)')
+        for text in opts.buffers.split(','):
+            bufsize = parse_size(text)
+            runs = [run_one(path, bufsize) for count in range(opts.repeat)]
+            best = min(took for took,rss in runs)
+            rss = max(rss for took,rss in runs)
+            print '%10s %10.3f %10.1f %12d' % (text, best, size/best/(1<<20), rss)
+            continue
+    finally:
+        if not opts.file:
+            os.remove(path)
+    return
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
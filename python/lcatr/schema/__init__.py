@@ -60,10 +60,107 @@ the resulting HDUList returned by ``open()`` will contain instances of
 the ``lcatr`` schema HDU classes. A ValueError exception will be
 raised on failure.
 
+Lazy loading
+------------
+
+Importing this package is cheap: its submodules, and with them
+``pyfits`` and ``numpy``, are only imported when first used as
+attributes of the package (eg ``lcatr.schema.ptc``) or imported
+explicitly.  Tools which only need ``util`` or ``headers`` never load
+``pyfits``.  Names which are not submodules, such as ``open`` or
+``PrimaryHDU``, are taken from ``base`` which re-exports ``pyfits``.
+
+Loading ``base`` is what replaces ``pyfits.open()`` and the ``pyfits``
+HDU classes with the ``lcatr`` versions.  This still happens for code
+which uses the plain ``pyfits`` module after ``import lcatr.schema``:
+``load()``, which does it and registers all schema classes, is called
+as soon as ``pyfits`` is imported, or at once if it already was:
+
+  >>> import lcatr.schema
+  >>> import pyfits
+  >>> hdus = pyfits.open("results.fits")   # lcatr HDU classes
+
+``base.find_schema()``, and so ``lcatr_open()``, also make sure all
+schema classes are registered.
+
 '''
 
-import base
-import common
-import limsmeta
-import ptc
-import util
+import sys
+import types
+
+#: The submodules loaded on first use.
+submodules = ['base', 'bulk', 'cache', 'coldspots', 'common', 'export', 'headers', 'ingest',
+              'instrument', 'migrate', 'limsmeta', 'ptc', 'stream', 'util', 'verifier']
+
+#: The submodules defining schema classes, loaded by load().
+schema_modules = ['common', 'limsmeta', 'ptc']
+
+def load():
+    '''
+    Import ``base``, patching ``pyfits``, and all modules defining
+    schema classes so that they are registered (see
+    ``base.find_schema()``).  Return this package.
+    '''
+    for name in schema_modules:
+        __import__(__name__ + '.' + name)
+        continue
+    return sys.modules[__name__]
+
+class PyfitsImportHook(object):
+    '''
+    An import hook, kept on ``sys.meta_path`` until ``pyfits`` is
+    imported, which calls load() once it is.
+    '''
+    def find_module(self, fullname, path = None):
+        if fullname == 'pyfits':
+            return self
+        return None
+
+    def load_module(self, fullname):
+        _remove_hook()
+        module = __import__(fullname)
+        # when base itself imports pyfits it does the patching, and
+        # the schema modules load on the first find_schema()
+        if __name__ + '.base' not in sys.modules:
+            load()
+        return module
+    pass
+
+def _remove_hook():
+    sys.meta_path[:] = [hook for hook in sys.meta_path
+                        if not isinstance(hook, PyfitsImportHook)]
+    return
+
+class LazyPackage(types.ModuleType):
+    '''
+    The type of this package, importing submodules on first access.
+    '''
+    def __getattr__(self, name):
+        # only called for names not already set on the package
+        if name in submodules:
+            __import__(self.__name__ + '.' + name)
+            return self.__dict__[name]
+        if name.startswith('__'):
+            raise AttributeError, name
+        try:
+            return getattr(self.base, name)
+        except AttributeError:
+            raise AttributeError, "'module' object has no attribute '%s'" % name
+    pass
+
+def _replace_module():
+    # Python 2 has no module __getattr__ so the module in sys.modules
+    # is replaced by a LazyPackage holding the same attributes.  The
+    # original is kept as its functions refer to its namespace.
+    old = sys.modules[__name__]
+    new = LazyPackage(__name__, __doc__)
+    new.__dict__.update(old.__dict__)
+    new._original_module = old
+    sys.modules[__name__] = new
+    return
+_replace_module()
+
+if 'pyfits' in sys.modules:
+    load()
+else:
+    sys.meta_path.append(PyfitsImportHook())
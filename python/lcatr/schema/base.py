@@ -9,10 +9,12 @@ HDU classes that supports the LCATR schema.
 Importing
 ---------
 
-The ``lcatr.base`` module (or just ``lcatr`` which imports ``base``)
-must be imported before any ``pyfits`` objects are used:
+The ``lcatr.base`` module must be imported (or ``lcatr.schema.load()``
+called, as ``import lcatr.schema`` alone loads nothing) before any
+``pyfits`` objects are used:
 
-  >>> import lcatr
+  >>> import lcatr.schema
+  >>> lcatr.schema.load()
   >>> import pyfits
 
 It imports all of ``pyfits`` so strictly speaking one does not need to
@@ -47,13 +49,167 @@ what schema the HDU follows.  They are:
     The version of the schema that the data follows.  This default to
     0 (zero).  Each change to the schema must include an increment of
     this number and code that can read older files into the newer
-    schema.
+    schema, given as the class's ``schema_upgrades`` (see the
+    ``migrate`` module).
 
 '''
 
+import os
+import types
 import pyfits
 import numpy
+import hashlib
+import contextlib
 import util
+import headers
+import instrument
+
+
+# The schema registry.  Every concrete HDU class that mixes in
+# ``BaseHDU`` is entered here when its class statement is executed.
+
+#: Map of (lower-cased EXTNAME, EXTVER) to the implementing class.
+#: Use ``register_schema()``, ``find_schema()`` and
+#: ``registered_schema()`` rather than touching this directly.
+schema_registry = {}
+
+# The plain pyfits HDU classes, needed before they get replaced below.
+_pyfits_hdu_classes = (pyfits.PrimaryHDU, pyfits.TableHDU, pyfits.BinTableHDU)
+
+def register_schema(klass):
+    '''
+    Enter a schema class into the registry.
+
+    The class is keyed by its lower-cased name (which is what is used
+    as its ``EXTNAME``) and its ``schema_version`` (its ``EXTVER``).
+    A class registered under an existing key replaces the old one.
+    This is called automatically for all HDU classes inheriting from
+    ``BaseHDU`` and returns the class so it may be used as a
+    decorator.
+    '''
+    key = (klass.__name__.lower(), klass.schema_version)
+    schema_registry[key] = klass
+    return klass
+
+_all_schema_loaded = False
+def load_all_schema():
+    '''
+    Make sure all the schema modules of this package are imported, and
+    so their classes registered, see ``lcatr.schema.load()``.
+    '''
+    global _all_schema_loaded
+    if not _all_schema_loaded:
+        import lcatr.schema
+        lcatr.schema.load()
+        _all_schema_loaded = True
+    return
+
+def find_schema(name, version = None):
+    '''
+    Return the schema class registered for the given ``EXTNAME`` and
+    ``EXTVER`` or None if there is none.
+
+    The name is case insensitive.  If version is None the class with
+    the highest registered version is returned.
+    '''
+    load_all_schema()
+    name = name.lower()
+    if version is not None:
+        return schema_registry.get((name, int(version)))
+    found = [(ver,klass) for (nam,ver),klass in schema_registry.items() if nam == name]
+    if not found: return None
+    return max(found)[1]
+
+def registered_schema():
+    '''
+    Return a list of ((extname, extver), class) pairs, sorted by key,
+    for all registered schema classes.
+    '''
+    load_all_schema()
+    return sorted(schema_registry.items())
+
+# Counts changes to the requirements of any schema class.  A
+# ``SchemaPlan`` made before the latest change is out of date.
+_schema_generation = 0
+
+def schema_changed():
+    '''
+    Mark every ``SchemaPlan`` out of date, to be made again when next
+    asked for.  This is called whenever the requirements of a schema
+    class change, see ``SchemaList``.
+    '''
+    global _schema_generation
+    _schema_generation += 1
+    return
+
+class SchemaList(list):
+    '''
+    The ``required_cards`` or ``required_columns`` of a schema class.
+
+    A list which calls ``schema_changed()`` when it is edited in place,
+    so that checking whether a plan is current costs next to nothing.
+    The metaclass turns the lists classes give into these.  Editing an
+    entry's constraints dictionary in place is not noticed, call
+    ``schema_changed()`` after doing that.
+    '''
+    pass
+
+def _schema_edit(method):
+    def edit(self, *args, **kwds):
+        ret = method(self, *args, **kwds)
+        schema_changed()
+        return ret
+    edit.__name__ = method.__name__
+    edit.__doc__ = method.__doc__
+    return edit
+
+for _name in ['__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__',
+              '__imul__', 'append', 'extend', 'insert', 'pop', 'remove', 'reverse', 'sort']:
+    setattr(SchemaList, _name, _schema_edit(getattr(list, _name)))
+    continue
+
+class SchemaRegistrant(type(pyfits.PrimaryHDU)):
+    '''
+    Metaclass which registers every concrete HDU schema class.
+
+    It derives from the metaclass of the ``pyfits`` HDU classes so
+    that it can be mixed with them.  The ``BaseHDU`` mixins themselves
+    are not registered.
+
+    Setting or editing a class's ``required_cards``,
+    ``required_columns`` or ``allow_empty`` marks the schema plans out
+    of date, see ``schema_changed()``.
+    '''
+
+    #: The class attributes a ``SchemaPlan`` is made from
+    schema_attributes = ('required_cards', 'required_columns', 'allow_empty')
+
+    def __init__(klass, name, bases, attrs):
+        super(SchemaRegistrant,klass).__init__(name, bases, attrs)
+        for attr in ['required_cards', 'required_columns']:
+            if type(attrs.get(attr)) is list:
+                type.__setattr__(klass, attr, SchemaList(attrs[attr]))
+            continue
+        if issubclass(klass, _pyfits_hdu_classes):
+            klass.schema_plan() # a class with a broken schema is not registered
+            register_schema(klass)
+        return
+
+    def __setattr__(klass, attr, value):
+        if attr in SchemaRegistrant.schema_attributes:
+            if type(value) is list:
+                value = SchemaList(value)
+            schema_changed()
+        super(SchemaRegistrant,klass).__setattr__(attr, value)
+        return
+
+    def __delattr__(klass, attr):
+        if attr in SchemaRegistrant.schema_attributes:
+            schema_changed()
+        super(SchemaRegistrant,klass).__delattr__(attr)
+        return
+
+    pass
 
 
 # Some quantities and methods shared by all HDU classes.
@@ -67,6 +223,186 @@ required_cards = [
     ]
 
 
+#: The constraints a column of ``required_columns`` may declare in
+#: its fourth element, a dictionary:
+#:
+#: ``min``, ``max``
+#:     no value is less, or greater, than this
+#: ``gt``, ``lt``
+#:     every value is greater, or less, than this, an exclusive bound
+#: ``finite``
+#:     if True, no value is NaN or infinite
+#: ``values``
+#:     a list of the values allowed
+#: ``unique``
+#:     if True, no value appears twice
+#: ``monotonic``
+#:     one of ``monotonic_orders``, how values change from row to row
+column_constraints = ('min', 'max', 'gt', 'lt', 'finite', 'values', 'unique', 'monotonic')
+
+#: The orders a ``monotonic`` column constraint may give
+monotonic_orders = ('increasing', 'decreasing', 'strictly increasing', 'strictly decreasing')
+
+def column_entry(klass, entry):
+    '''
+    Return an entry of the ``required_columns`` of the schema class as
+    (name, TFORM, comment, constraints), constraints being an empty
+    dictionary if the entry declares none.
+    '''
+    if len(entry) == 3:
+        return tuple(entry) + (dict(),)
+    if len(entry) == 4:
+        return tuple(entry[:3]) + (entry[3] or dict(),)
+    raise ValueError, '%s: required column %r is not (name, TFORM, comment[, constraints])' % \
+        (klass.__name__, entry)
+
+def check_constraints(klass, name, dtype, constraints):
+    '''
+    Raise ValueError if a column declares constraints which are not
+    known or do not suit its type.
+    '''
+    unknown = sorted(set(constraints) - set(column_constraints))
+    if unknown:
+        raise ValueError, '%s: column "%s": unknown constraints: %s' % \
+            (klass.__name__, name, ', '.join(unknown))
+    order = constraints.get('monotonic')
+    if order is not None and order not in monotonic_orders:
+        raise ValueError, '%s: column "%s": monotonic must be one of %s' % \
+            (klass.__name__, name, ', '.join(monotonic_orders))
+    if dtype is not None and dtype.shape and \
+            (constraints.get('unique') or order is not None):
+        raise ValueError, '%s: column "%s": unique and monotonic need a scalar column' % \
+            (klass.__name__, name)
+    return
+
+def column_violations(array, constraints):
+    '''
+    Check a column's array against its constraints, see
+    ``column_constraints``.  Return a list of (constraint, rows), rows
+    being the array of indices of every row breaking the constraint,
+    for each constraint broken.
+
+    Each constraint is one whole column comparison, the rows of a
+    column with a repeat count failing if any element does.
+    '''
+    array = numpy.asarray(array)
+    ret = []
+
+    def rows_of(bad, what):
+        if bad.ndim > 1:
+            bad = bad.reshape(len(bad), -1).any(axis=1)
+        rows = numpy.flatnonzero(bad)
+        if len(rows):
+            ret.append((what, rows))
+        return
+
+    if constraints.get('min') is not None:
+        rows_of(array < constraints['min'], 'min=%r' % constraints['min'])
+    if constraints.get('max') is not None:
+        rows_of(array > constraints['max'], 'max=%r' % constraints['max'])
+    if constraints.get('gt') is not None:
+        rows_of(array <= constraints['gt'], 'gt=%r' % constraints['gt'])
+    if constraints.get('lt') is not None:
+        rows_of(array >= constraints['lt'], 'lt=%r' % constraints['lt'])
+    if constraints.get('finite') and array.dtype.kind in 'fc':
+        rows_of(~numpy.isfinite(array), 'finite')
+    if constraints.get('values') is not None:
+        allowed = numpy.asarray(constraints['values'])
+        rows_of(~numpy.in1d(array.ravel(), allowed).reshape(array.shape), 'values')
+    if constraints.get('unique') and len(array) > 1:
+        order = numpy.argsort(array, kind='mergesort')
+        ordered = array[order]
+        # with a stable sort the first of equal values is kept
+        repeat = numpy.zeros(len(array), dtype=bool)
+        repeat[order[1:][ordered[1:] == ordered[:-1]]] = True
+        rows_of(repeat, 'unique')
+    order = constraints.get('monotonic')
+    if order is not None and len(array) > 1:
+        later, earlier = array[1:], array[:-1]
+        if order == 'increasing':
+            bad = later < earlier
+        elif order == 'decreasing':
+            bad = later > earlier
+        elif order == 'strictly increasing':
+            bad = later <= earlier
+        else:
+            bad = later >= earlier
+        rows_of(numpy.concatenate([[False], bad]), 'monotonic=%s' % order)
+    return ret
+
+def violations_text(violations):
+    'Return a list of (column name, constraint, rows) as one line of text.'
+    return '; '.join('%s %s at rows %s' % (name, what, ','.join(map(str, rows)))
+                     for name, what, rows in violations)
+
+
+class SchemaPlan(object):
+    '''
+    The card and column requirements of a schema class worked out
+    once so that building and validating HDUs need not redo it.
+
+    Get it with ``BaseHDU.schema_plan()``.
+    '''
+
+    def __init__(self, klass):
+        #: The class the plan is for
+        self.klass = klass
+        #: The count of schema changes when the plan was made
+        self.generation = _schema_generation
+
+        #: List of (name, comment) of all required cards
+        self.card_desc = required_cards + (klass.required_cards or list())
+
+        #: List of (name, comment, keyword argument) of all required cards
+        self.cards = [(name, comment, util.keywordify(name))
+                      for name, comment in self.card_desc]
+
+        #: The names of the required cards
+        self.card_names = tuple(name for name, comment in self.card_desc)
+
+        columns = [column_entry(klass, entry)
+                   for entry in getattr(klass, 'required_columns', None) or list()]
+
+        #: List of (name, TFORM, comment, keyword argument) of all required columns
+        self.columns = [(name, typestr, comment, util.keywordify(name))
+                        for name, typestr, comment, constraints in columns]
+
+        #: Map of lower case column name to its index in ``columns``
+        self.column_index = dict((name.lower(), index)
+                                 for index, (name, typestr, comment, constraints)
+                                 in enumerate(columns))
+
+        #: The expected ``util.tform_key()`` of each column, for binary
+        #: and for ASCII tables
+        self.tform_keys = [util.tform_key(typestr) for name, typestr, comment, c in columns]
+        self.ascii_tform_keys = [util.tform_key(typestr, True)
+                                 for name, typestr, comment, c in columns]
+
+        #: The numpy dtype of each column or None, see ``util.tform_dtype()``
+        self.dtypes = [util.tform_dtype(typestr) for name, typestr, comment, c in columns]
+
+        #: List of (name, constraints) of the columns declaring any,
+        #: see ``column_violations()``
+        self.constraints = []
+        for (name, typestr, comment, constraints), dtype in zip(columns, self.dtypes):
+            if not constraints: continue
+            check_constraints(klass, name, dtype, constraints)
+            self.constraints.append((name, constraints))
+            continue
+
+        self.fingerprint = None # see BaseHDU.schema_fingerprint()
+        return
+
+    def current(self):
+        '''
+        Return True if no schema requirements have changed since this
+        plan was made, see ``schema_changed()``.
+        '''
+        return self.generation == _schema_generation
+
+    pass
+
+
 class BaseHDU(object):
     '''
     Base HDU class.
@@ -79,19 +415,58 @@ class BaseHDU(object):
     * ``PrimaryHDU``
     * ``TableHDU``
     * ``BinTableHDU``
+
+    Each class deriving from this one is entered into the schema
+    registry, see ``find_schema()``.
     '''
+    __metaclass__ = SchemaRegistrant
+
+    #: The schema version, stored as the ``EXTVER`` card.  Increment
+    #: this when the schema of a class changes.
+    schema_version = 0
+
+    #: Map of each older ``schema_version`` to the list of
+    #: ``migrate.Step`` upgrading it to the next version, or None.
+    schema_upgrades = None
 
     #: Specific HDU sub classes should set this to the list of cards required.  These are cards beyond and listed in the same manner as the standard ones listed above in ``base.required_cards``.
     required_cards = None
 
-    def required_card_desc(self):
+    # The class's SchemaPlan, see schema_plan()
+    _schema_plan = None
+
+    @classmethod
+    def schema_plan(klass):
+        '''
+        Return the class's ``SchemaPlan``.
+
+        It is made when the class is defined and made again, along
+        with the ``schema_fingerprint()`` kept with it, after its
+        ``required_cards`` or ``required_columns`` change, whether the
+        lists are replaced or edited in place, see ``SchemaList``.
+        '''
+        plan = klass._schema_plan
+        # a plan found is the class's own unless inherited from a base
+        if plan is None or plan.klass is not klass or plan.generation != _schema_generation:
+            plan = klass.compile_schema_plan()
+        return plan
+
+    @classmethod
+    def compile_schema_plan(klass):
+        '''
+        Make and keep a new ``SchemaPlan`` for the class.
+        '''
+        klass._schema_plan = SchemaPlan(klass)
+        return klass._schema_plan
+
+    @classmethod
+    def required_card_desc(klass):
         '''
         Return the list of required card descriptions built from the
         common set ``base.required_card`` and the ones specific to the
         subclasses ``.required_cards`` list.  This is used internally.
         '''
-        mycards = self.required_cards or list()
-        return required_cards + mycards
+        return klass.schema_plan().card_desc
 
     def initialize_cards(self, **kwds):
         '''
@@ -109,24 +484,24 @@ class BaseHDU(object):
           >>> hdu.header['extver'] = 1 # set schema version after construction
 
         ``EXTNAME`` is the implementing class name
-        ``EXTVER`` will default to 0
+        ``EXTVER`` will default to the class's ``schema_version``
         '''
 
         schema_name = self.__class__.__name__
-        schema_ver = kwds.get('version',0)
+        schema_ver = kwds.get('version',self.schema_version)
 
         self.update_ext_name(schema_name)
         self.update_ext_version(schema_ver)
 
-        for name, comment in self.required_card_desc():
-            if not self.header.has_key(name):
-                self.header.update(name, '', comment)
+        header = self.header
+        for name, comment, key in self.schema_plan().cards:
+            if not header.has_key(name):
+                header.update(name, '', comment)
                 pass
-            key = util.keywordify(name)
             val = kwds.get(key)
             if val is None: continue
             val = util.wash_card_value(val)
-            self.header[name] = val
+            header[name] = val
             continue
         return
 
@@ -140,23 +515,76 @@ class BaseHDU(object):
         ValueError is raise if validation fails.
         '''
         try:
-            self.verify("exception")
+            timed_verify(self, "exception")
         except VerifyError,msg:
             #msg = 'HDU "%s/%s": verify failed: %s' % (self.schema_name, self.name, msg)
             msg = 'HDU "%s/%s": verify failed: %s' % (self.__class__.__name__, self.name, msg)
             raise ValueError,msg
 
-        for name, comment in self.required_card_desc():
-            value = self.header.get(name)
+        self.validate_header(self.header)
+        return
+
+    @classmethod
+    def validate_header(klass, header):
+        '''
+        Check a header against the schema without using any data.
+
+        The header may be a ``pyfits.Header`` or a ``RawHeader`` read
+        by the ``headers`` module.  This checks the required cards and
+        is called by ``validate()``.  It may also be called on the
+        class directly, see ``validate_headers()``.
+
+        ValueError is raised if validation fails.
+        '''
+        for name in klass.schema_plan().card_names:
+            value = header.get(name)
             if value is None:
                 raise ValueError, '%s: required card: "%s" not set' % \
-                    (self.__class__.__name__,name)
+                    (klass.__name__,name)
             if value == '':
                 raise ValueError, '%s: required card: "%s" is empty string' % \
-                    (self.__class__.__name__,name)
+                    (klass.__name__,name)
             continue
         return
 
+    @classmethod
+    def schema_fingerprint(klass):
+        '''
+        Return a hex digest of what the class validates against: its
+        name and ``schema_version``, its required cards and columns
+        and the code of the ``validate()`` and ``validate_header()``
+        methods it and its bases define.  Any change to these gives a
+        new fingerprint, see ``validation_keys()``.
+
+        The fingerprint is kept with the class's ``schema_plan()``.
+        '''
+        plan = klass.schema_plan()
+        if plan.fingerprint is not None:
+            return plan.fingerprint
+        parts = [klass.__name__, klass.schema_version, klass.required_card_desc(),
+                 getattr(klass, 'required_columns', None),
+                 getattr(klass, 'allow_empty', None)]
+        for base in klass.__mro__:
+            for name in ('validate', 'validate_header', 'constraint_violations'):
+                meth = base.__dict__.get(name)
+                if meth is None: continue
+                code = getattr(meth, '__func__', meth).func_code
+                consts = [c for c in code.co_consts if not isinstance(c, types.CodeType)]
+                parts.append((base.__name__, name, code.co_code, consts, code.co_names))
+                continue
+            continue
+        plan.fingerprint = hashlib.sha1(repr(parts)).hexdigest()
+        return plan.fingerprint
+
+    def validation_key(self):
+        '''
+        Return a string identifying anything outside of the file
+        itself which ``validate()`` depends on.  It is part of the
+        keys made by ``validation_keys()``.  The base class depends on
+        nothing else and returns an empty string.
+        '''
+        return ''
+
     def update_self(self, doppel = None):
         '''
         If doppel is given, steal its header
@@ -188,6 +616,104 @@ class PrimaryHDU(pyfits.PrimaryHDU, BaseHDU):
     pass
 
 
+class RowBuilder(object):
+    '''
+    Accumulate rows for a table in growable column buffers.
+
+    Each column is held in a numpy array which doubles in size when
+    full so adding n rows costs O(n).  Rows are given with
+    ``append()`` and whole runs of rows with ``extend()``.  Columns
+    are named as for the ``TableBaseHDU`` constructor keywords (lower
+    case, ``-`` replaced by ``_``).
+
+    A builder is normally obtained from ``TableBaseHDU.batch()``.
+    '''
+
+    #: Initial number of rows allocated
+    initial_capacity = 64
+
+    def __init__(self, columns):
+        '''
+        Create a builder for columns given as a list of (name, dtype).
+        '''
+        self.names = [name for name,dtype in columns]
+        self.keys = [util.keywordify(name) for name in self.names]
+        self.buffers = [numpy.empty(self.initial_capacity, dtype=dtype) for name,dtype in columns]
+        self.size = 0
+        return
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, count):
+        need = self.size + count
+        capacity = len(self.buffers[0])
+        if need <= capacity:
+            return
+        while capacity < need:
+            capacity *= 2
+        for index, buf in enumerate(self.buffers):
+            new = numpy.empty(capacity, dtype=buf.dtype)
+            new[:self.size] = buf[:self.size]
+            self.buffers[index] = new
+            continue
+        return
+
+    def _values(self, args, kwds):
+        if args and kwds:
+            raise ValueError, 'RowBuilder: give values by position or by name, not both'
+        if kwds:
+            try:
+                args = [kwds.pop(key) for key in self.keys]
+            except KeyError, msg:
+                raise ValueError, 'RowBuilder: no value for column %s' % msg
+            if kwds:
+                raise ValueError, 'RowBuilder: unknown columns: %s' % ', '.join(kwds)
+        if len(args) != len(self.keys):
+            raise ValueError, 'RowBuilder: expected %d values, got %d' % \
+                (len(self.keys), len(args))
+        return args
+
+    def append(self, *args, **kwds):
+        '''
+        Add one row, given as one value per column either in column
+        order or by keyword.
+        '''
+        values = self._values(args, kwds)
+        self._reserve(1)
+        for buf, value in zip(self.buffers, values):
+            buf[self.size] = value
+            continue
+        self.size += 1
+        return
+
+    def extend(self, *args, **kwds):
+        '''
+        Add many rows, given as one sequence per column either in
+        column order or by keyword.  All sequences must be the same
+        length.
+        '''
+        values = [numpy.asarray(v) for v in self._values(args, kwds)]
+        count = len(values[0])
+        if [v for v in values if len(v) != count]:
+            raise ValueError, 'RowBuilder: column arrays differ in length'
+        self._reserve(count)
+        for buf, value in zip(self.buffers, values):
+            buf[self.size:self.size+count] = value
+            continue
+        self.size += count
+        return
+
+    def arrays(self):
+        '''
+        Return a dictionary mapping column name to an array of the rows
+        added so far.  The arrays are views into the builder's buffers.
+        '''
+        return dict([(name, buf[:self.size]) for name,buf in zip(self.names, self.buffers)])
+
+    pass
+
+
 class TableBaseHDU(BaseHDU):
     '''
     Base class for all Table HDUs.
@@ -195,15 +721,27 @@ class TableBaseHDU(BaseHDU):
 Each subclass should define a ``.required_columns`` class data member which holds a li
     '''
     
-    #: The list of descriptions of required columns in the form of a list of (name,type) doubles:
-    #:  >>> required_columns = [('Col1Name','I'),...]
+    #: The list of descriptions of required columns in the form of a list of (name,type,comment) triples:
+    #:  >>> required_columns = [('Col1Name','I','Comment'),...]
+    #: An optional fourth element is a dictionary of constraints on the column's values, see ``base.column_constraints``:
+    #:  >>> required_columns = [('Gain','E','Gain', dict(gt=0, finite=True)),...]
     required_columns = None
 
+    #: Set to True in subclasses where a table with no rows is valid.
+    allow_empty = False
+
+    #: True when columns have been modified since the table was last
+    #: rebuilt.  See ``sync()``.
+    dirty = False
+
+    #: The number of times this HDU's table has been rebuilt.
+    rebuilds = 0
+
     # Internal, intialize the table base class.  Called by constructor.
     def initialize_table_base(self,**kwds):
         self.initialize_cards(**kwds)
         self.initialize_columns(**kwds)
-        self.update_self()
+        self.dirty = True
         return
 
     def initialize_columns(self, **kwds):
@@ -215,10 +753,10 @@ Each subclass should define a ``.required_columns`` class data member which hold
         ``_``) will have their values treated as a column array.
         Otherwise the column will be created empty.
         '''
-        if not self.required_columns: return
+        plan = self.schema_plan()
+        if not plan.columns: return
         cols = []
-        for count,(name,typestr,comment) in enumerate(self.required_columns):
-            kwname = name.lower().replace('-','_')
+        for name,typestr,comment,kwname in plan.columns:
             array = kwds.get(kwname,list())
             #col = pyfits.Column(name=name, format=typestr, array=array, start=count+1)
             # fitsverify complains about "TBCOLn is not allowed in the Binary table."
@@ -235,11 +773,73 @@ Each subclass should define a ``.required_columns`` class data member which hold
         '''
         Validate a table HDU.
 
-        This adds to basic validity checking by requiring the table data to exist.
+        This adds to basic validity checking by requiring the table
+        data to exist and the columns to meet any constraints declared
+        in ``.required_columns``.  The message of the ValueError for
+        broken constraints lists every offending row.
         '''
         super(TableBaseHDU,self).validate()
-        if not len(self.data):
+        if not self.allow_empty and not len(self.data):
             raise ValueError,'TableHDU "%s": no table data' % self.name
+        violations = self.constraint_violations()
+        if violations:
+            raise ValueError, 'TableHDU "%s": column constraints not met: %s' % \
+                (self.name, violations_text(violations))
+        return
+
+    def constraint_violations(self):
+        '''
+        Return a list of (column name, constraint, rows) for each
+        constraint declared in ``.required_columns`` which the table
+        breaks, rows being the array of offending row indices.  See
+        ``base.column_violations()``.
+        '''
+        ret = []
+        plan = self.schema_plan()
+        if not plan.constraints:
+            return ret
+        data = self.data
+        for name, constraints in plan.constraints:
+            for what, rows in column_violations(data.field(name), constraints):
+                ret.append((name, what, rows))
+                continue
+            continue
+        return ret
+
+    @classmethod
+    def validate_header(klass, header):
+        '''
+        Check a table header against the schema without using any data.
+
+        In addition to the required cards this checks that each of
+        the ``.required_columns`` is described by a ``TTYPEn`` card
+        with a matching ``TFORMn`` and that ``NAXIS2`` says the table
+        has rows.
+        '''
+        super(TableBaseHDU,klass).validate_header(header)
+
+        ascii = header.get('XTENSION') == 'TABLE'
+        columns = dict()
+        for count in range(1, (header.get('TFIELDS') or 0) + 1):
+            name = header.get('TTYPE%d' % count)
+            if name is None: continue
+            columns[name.lower()] = header.get('TFORM%d' % count)
+            continue
+
+        plan = klass.schema_plan()
+        keys = ascii and plan.ascii_tform_keys or plan.tform_keys
+        for (name, typestr, comment, kwname), key in zip(plan.columns, keys):
+            tform = columns.get(name.lower())
+            if tform is None:
+                raise ValueError, '%s: required column: "%s" not found' % \
+                    (klass.__name__, name)
+            if tform != typestr and util.tform_key(tform, ascii) != key:
+                raise ValueError, '%s: required column: "%s" has format "%s" not "%s"' % \
+                    (klass.__name__, name, tform, typestr)
+            continue
+
+        if not klass.allow_empty and not header.get('NAXIS2'):
+            raise ValueError,'TableHDU "%s": no table data' % header.get('EXTNAME')
         return
 
     def get_column(self, column):
@@ -251,7 +851,11 @@ Each subclass should define a ``.required_columns`` class data member which hold
         if isinstance(column,int):
             index = column - 1
         else:
-            index = [c.name.lower() for c in self.columns].index(column.lower())
+            lower = column.lower()
+            index = self.schema_plan().column_index.get(lower)
+            if index is None or index >= len(self.columns) or \
+                    self.columns[index].name.lower() != lower:
+                index = [c.name.lower() for c in self.columns].index(lower)
             pass
 
         try:
@@ -260,24 +864,42 @@ Each subclass should define a ``.required_columns`` class data member which hold
             raise ValueError, 'TableHDU "%s": no column %s at index %s' % (column, index+1)
         return col
 
+    @instrument.timed('update_self')
     def update_self(self, doppel = None):
         '''
         Update self.
 
         To stay consistent this must be called any time a column's array
-        is modified directly.
+        is modified directly.  Alternatively, set ``.dirty`` to True
+        to have it called only once the table is next needed.
 
         If another HDU is given its contents will be used instead of self's.
         '''
         # pyfits doesn't have a way to say "update my data" so we make a
         # temporary new table HDU and steal its guts as our own.
+        self.dirty = False      # before touching the header, see sync()
         if not doppel:
             doppel = new_table(self.columns, self.header)
+            self.rebuilds += 1
+            instrument.count('new_table')
         self.header = doppel.header
         self.columns = doppel.columns
         self.data = doppel.data
         return
 
+    def sync(self):
+        '''
+        Rebuild the table if its columns have been modified.
+
+        Column changes made through this class only mark the table as
+        ``dirty``.  The rebuild is done here, once, when the table's
+        ``header`` or ``data`` are next used, which includes
+        validating, writing and calculating checksums.
+        '''
+        if self.dirty:
+            self.update_self()
+        return
+
     def set_column_array(self, column, array):
         '''
         Set a column's array.  
@@ -288,14 +910,14 @@ Each subclass should define a ``.required_columns`` class data member which hold
         
         ValueError is raised if column is not found.
         
-        This triggers an ``update_self()``.
+        This marks the table ``dirty``, see ``sync()``.
         '''
         col = self.get_column(column)
         if isinstance(array,list):
             array = numpy.array(array)
             pass
         col.array = array
-        self.update_self()
+        self.dirty = True
         return
 
     def append_column_array(self, column, entry):
@@ -304,15 +926,187 @@ Each subclass should define a ``.required_columns`` class data member which hold
         
         The column is specified either by its index (1-based) or name.
         
-        This triggers an ``update_self()``.
+        This marks the table ``dirty``, see ``sync()``.
         '''
         col = self.get_column(column)
-        numpy.append(col.array, entry)
-        self.update_self()
+        col.array = numpy.append(col.array, entry)
+        self.dirty = True
+        return
+
+    def column_dtypes(self):
+        '''
+        Return a list of (name, numpy dtype) for the table's columns.
+
+        The types follow the ``.required_columns`` if given, otherwise
+        those of the current column arrays.
+        '''
+        ret = []
+        plan = self.schema_plan()
+        if plan.columns:
+            for (name,typestr,comment,kwname),dtype in zip(plan.columns, plan.dtypes):
+                if dtype is None:
+                    dtype = numpy.asarray(self.get_column(name).array).dtype
+                ret.append((name, dtype))
+                continue
+            return ret
+        for col in self.columns:
+            ret.append((col.name, numpy.asarray(col.array).dtype))
+            continue
+        return ret
+
+    @classmethod
+    def records_dtype(klass):
+        '''
+        Return the numpy structured dtype of a row of the
+        ``.required_columns`` or None if the class has none.
+
+        ValueError is raised if a column has no numpy equivalent, see
+        ``util.tform_dtype()``.
+        '''
+        plan = klass.schema_plan()
+        if not plan.columns:
+            return None
+        fields = []
+        for (name,typestr,comment,kwname),dtype in zip(plan.columns, plan.dtypes):
+            if dtype is None:
+                raise ValueError, '%s: column "%s" of format "%s" has no numpy type' % \
+                    (klass.__name__, name, typestr)
+            fields.append((name, dtype))
+            continue
+        return numpy.dtype(fields)
+
+    @classmethod
+    def from_records(klass, records, **kwds):
+        '''
+        Return a new HDU holding the given rows.
+
+        The records may be a numpy structured (or record) array.  If its
+        fields are the ``.required_columns``, in order, with matching
+        types (names are case insensitive and either byte order is
+        accepted) the table wraps the array's buffer and no data is
+        copied.  Later changes to the array show in the HDU.
+
+        Otherwise, or if records is a dictionary mapping column names
+        to arrays, the columns are copied once into a new array of
+        ``records_dtype()``.  Fields or keys which are not required
+        columns are ignored.
+
+        Other keyword arguments give values of required cards as for
+        the constructor.  ValueError is raised if a required column is
+        missing.
+        '''
+        want = klass.records_dtype()
+        if isinstance(records, dict):
+            records = klass._copy_records(want, records)
+        else:
+            records = numpy.asanyarray(records)
+            if records.dtype.names is None:
+                raise ValueError, '%s: records must be a structured array' % klass.__name__
+            if want is None:
+                want = records.dtype
+            elif same_record_layout(records.dtype, want):
+                # rename the fields to the schema's spelling, no copy
+                records = records.view(numpy.dtype(
+                        [(name, records.dtype[index]) for index,name in enumerate(want.names)]))
+            else:
+                records = klass._copy_records(want, records)
+
+        hdu = klass(**kwds)
+        hdu.dirty = False       # the data set next replaces the columns
+        hdu.data = records
+        return hdu
+
+    @classmethod
+    def _copy_records(klass, want, source):
+        # Copy the required columns of source, a structured array or a
+        # dictionary of arrays, into a new array of dtype want.
+        if isinstance(source, dict):
+            fields = dict((key.lower(), value) for key,value in source.items())
+        else:
+            fields = dict((name.lower(), source[name]) for name in source.dtype.names)
+        arrays = []
+        for name in want.names:
+            array = fields.get(name.lower())
+            if array is None:
+                raise ValueError, '%s: required column: "%s" not given' % (klass.__name__, name)
+            arrays.append(numpy.asarray(array))
+            continue
+        out = numpy.empty(len(arrays[0]), dtype = want)
+        for name, array in zip(want.names, arrays):
+            if len(array) != len(out):
+                raise ValueError, '%s: column "%s" has %d rows, expected %d' % \
+                    (klass.__name__, name, len(array), len(out))
+            out[name] = array
+            continue
+        return out
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Add rows through a ``RowBuilder`` and commit them in one step.
+
+          >>> with hdu.batch() as rows:
+          ...     for spot in spots:
+          ...         rows.append(ampnum=spot.amp, pixcount=spot.count,
+          ...                     spotx=spot.x, spoty=spot.y)
+
+        On leaving the block the rows are appended to any already in
+        the table and it is marked ``dirty`` to be rebuilt once.  Nothing is
+        changed if the block raises an exception.  Filling a table this
+        way takes time linear in the number of rows where calling
+        ``append_column_array()`` for each row takes quadratic time.
+        '''
+        builder = RowBuilder(self.column_dtypes())
+        yield builder
+        for name, array in builder.arrays().items():
+            col = self.get_column(name)
+            old = numpy.asarray(col.array, dtype=array.dtype)
+            col.array = numpy.concatenate([old, array])
+            continue
+        self.dirty = True
         return
 
     pass                        # TableBaseHDU
 
+def same_record_layout(got, want):
+    '''
+    Return True if the structured dtype got has the fields of want, in
+    the same order and packed the same way, with names equal but for
+    case and types equal but for byte order.
+    '''
+    if len(got.names) != len(want.names) or got.itemsize != want.itemsize:
+        return False
+    for gname, wname in zip(got.names, want.names):
+        if gname.lower() != wname.lower():
+            return False
+        gtype, goffset = got.fields[gname][:2]
+        wtype, woffset = want.fields[wname][:2]
+        if goffset != woffset or gtype.shape != wtype.shape:
+            return False
+        if gtype.base.kind != wtype.base.kind or gtype.base.itemsize != wtype.base.itemsize:
+            return False
+        continue
+    return True
+
+def synced_property(kind, name):
+    '''
+    Return a property which wraps the named attribute of the pyfits
+    class so that accessing it first calls ``sync()``.
+    '''
+    for klass in kind.__mro__:
+        if name in klass.__dict__:
+            desc = klass.__dict__[name]
+            break
+        continue
+    def fget(self):
+        if self.dirty:
+            self.sync()
+        return desc.__get__(self, type(self))
+    def fset(self, value):
+        desc.__set__(self, value)
+        return
+    return property(fget, fset, doc = desc.__doc__)
+
 # note: need to do cut-and-paste programming here to retain the pyfits
 # table HDU class dichotomy
 
@@ -331,6 +1125,9 @@ class TableHDU(pyfits.TableHDU, TableBaseHDU):
         super(TableHDU,self).__init__(data,header,name)
         self.initialize_table_base(**kwds)
         return
+
+    header = synced_property(pyfits.TableHDU, 'header')
+    data = synced_property(pyfits.TableHDU, 'data')
     pass
 
 class BinTableHDU(pyfits.BinTableHDU, TableBaseHDU):
@@ -347,6 +1144,9 @@ class BinTableHDU(pyfits.BinTableHDU, TableBaseHDU):
         super(BinTableHDU,self).__init__(data,header,name)
         self.initialize_table_base(**kwds)
         return
+
+    header = synced_property(pyfits.BinTableHDU, 'header')
+    data = synced_property(pyfits.BinTableHDU, 'data')
     pass
 
 
@@ -360,49 +1160,209 @@ pyfits.BinTableHDU = BinTableHDU
 
 
 
+@instrument.timed('verify')
+def timed_verify(obj, option = 'warn'):
+    '''
+    Run the pyfits ``verify()`` of the HDU or HDUList, timed by
+    ``instrument``.
+    '''
+    return obj.verify(option)
+
 # This is just a simple bolt-on
-def HDUList_validate(self):
+def HDUList_validate(self, header_only = False, use_cache = True):
     '''
     Validate a list of HDUs.  
 
     This method is bolted on to ``pyfits.HDUList``.
+
+    If header_only is True only the schema conformance of each HDU's
+    header is checked (see ``BaseHDU.validate_header()``) and no
+    table data is touched.  To check a file without even loading
+    it, see ``validate_headers()``.
+
+    If ``util.result_cache`` is set (see ``util.use_result_cache()``),
+    use_cache is True and the list was read from a file, HDUs already
+    known to be valid are not checked again.  A list whose HDUs are
+    all known to be valid returns at once.  See ``validation_keys()``.
     '''
-    self.verify()
-    for hdu in self:
+    if header_only:
+        for hdu in self:
+            hdu.validate_header(hdu.header)
+        return
+
+    cache = util.result_cache
+    keys = None
+    if use_cache and cache is not None:
+        keys = validation_keys(self)
+    if keys is None:
+        keys = [None] * len(self)
+    known = [key is not None and cache.get(key) is True for key in keys]
+    if known and all(known):
+        return
+
+    timed_verify(self)
+    for hdu, key, valid in zip(self, keys, known):
+        if valid: continue
         hdu.validate()
+        if key is not None:
+            cache.put(key, True)
+        continue
     return
 pyfits.HDUList.validate = HDUList_validate
 
+def source_filename(hdus):
+    '''
+    Return the name of the file the HDU list was read from or None.
+    '''
+    return hdus.filename() or getattr(hdus, 'source', None)
+
+def validation_keys(hdus):
+    '''
+    Return a list of keys, one for each HDU in the list, under which
+    its validity is cached or None if the list can not be cached.
+
+    A key is made from the SHA1 digest of the file the list was read
+    from (see ``util.sha1_digest()`` for how this is itself cached),
+    the HDU's ``EXTNAME`` and ``EXTVER``, a digest of its header as it
+    is now, its class's ``schema_fingerprint()`` and its
+    ``validation_key()``.  A table modified since it was read (see
+    ``TableBaseHDU.dirty``) or an HDU which is not an ``lcatr`` one
+    means no keys are made.  Changes made in place to data arrays are
+    not noticed, pass ``use_cache=False`` to ``validate()`` after
+    making any.
+    '''
+    filename = source_filename(hdus)
+    if not filename or not os.path.isfile(filename):
+        return None
+    for hdu in hdus:
+        if not isinstance(hdu, BaseHDU) or getattr(hdu, 'dirty', False):
+            return None
+        continue
+    digest = util._sha1_found(filename).hexdigest()
+    keys = []
+    for hdu in hdus:
+        header = hdu.header
+        keys.append('validate:%s:%s:%s:%s:%s:%s' % \
+                        (digest, header.get('EXTNAME'), header.get('EXTVER'),
+                         hashlib.sha1(str(header.ascard)).hexdigest(),
+                         hdu.schema_fingerprint(), hdu.validation_key()))
+        continue
+    return keys
+
+def validate_headers(filename):
+    '''
+    Validate the named file against the schema by reading only its
+    headers.
+
+    Each header is read directly from the file, the data following
+    it is skipped, and it is checked with the ``validate_header()``
+    method of its schema class.  No ``pyfits`` objects are made.
+
+    ValueError is raised if validation fails.
+    '''
+    for header in headers.iter_headers(filename):
+        header_schema_class(header).validate_header(header)
+        continue
+    return
+
+
+def schema_class(hdu):
+    '''
+    Return the ``lcatr`` schema class for the given HDU.
 
+    See ``header_schema_class()``.
+    '''
+    return header_schema_class(hdu.header)
+
+@instrument.timed('schema_lookup')
+def header_schema_class(header):
+    '''
+    Return the ``lcatr`` schema class for the given header.
+
+    The class is found in the schema registry by the HDU's ``EXTNAME``
+    and ``EXTVER``.  If no class is registered for that exact version
+    the one with the highest version of the same name is used.
+
+    ValueError is raised if no class is known.
+    '''
+    schema_name = header['EXTNAME']
+    klass = find_schema(schema_name, header.get('EXTVER'))
+    if klass is None:
+        klass = find_schema(schema_name)
+    if klass is None:
+        raise ValueError, 'No known class for HDU "%s"' % schema_name
+    return klass
+
+@instrument.timed('hdu_pyfits2lcatr')
 def hdu_pyfits2lcatr(hdu):
     '''
     Return an ``lcatr`` version of the plain pyfits HDU.
+
+    See ``schema_class()`` for how the class is chosen.
     '''
-    import lcatr.schema
-    module = type(lcatr.schema)
+    klass = schema_class(hdu)
+    new = klass()
+    new.update_self(hdu)
+    return new
 
-    schema_name = hdu.header['EXTNAME']
+@instrument.timed('hdu_adopt')
+def hdu_adopt(hdu):
+    '''
+    Turn the plain pyfits HDU into its ``lcatr`` version in place and
+    return it.
+
+    Unlike ``hdu_pyfits2lcatr()`` no new HDU is constructed and no
+    table is rebuilt.  The HDU merely takes on its schema class so
+    that any data not yet read from file stays unread.  If the schema
+    class is not of the same kind of pyfits HDU (eg, an ASCII table in
+    the file but a binary table in the schema) this falls back to
+    ``hdu_pyfits2lcatr()``.
+    '''
+    klass = schema_class(hdu)
+    if isinstance(hdu, klass):
+        return hdu
+    for kind in _pyfits_hdu_classes:
+        if issubclass(klass, kind):
+            break
+        continue
+    if not isinstance(hdu, kind):
+        return hdu_pyfits2lcatr(hdu)
+    hdu.__class__ = klass
+    return hdu
 
-    for thing in dir(lcatr.schema):
-        mod = lcatr.schema.__dict__[thing]
-        if not isinstance(mod,module): 
-            continue
 
-        try:
-            schema = mod.schema
-        except AttributeError:
-            continue
-        for klass in schema:
-            if schema_name.lower() != klass.__name__.lower():
-                continue
+class LazyHDUList(pyfits.HDUList):
+    '''
+    An HDUList which converts its HDUs to their ``lcatr`` versions
+    only as they are accessed.
 
-            # got a hit
-            new = klass()
-            new.update_self(hdu)
-            return new
-        continue
-    raise ValueError, 'No known class for HDU "%s"' % schema_name
+    It is returned by ``lcatr_open(..., lazy=True)``.  The HDUs are
+    converted with ``hdu_adopt()`` so table data is only read (or
+    memory mapped) from file when it is used.  Iterating, slicing,
+    ``validate()`` and ``writeto()`` all see the converted HDUs.
+    '''
+
+    def __getitem__(self, key):
+        hdu = super(LazyHDUList,self).__getitem__(key)
+        if isinstance(key, slice):
+            return LazyHDUList(hdu)
+        new = hdu_adopt(hdu)
+        if new is not hdu:
+            list.__setitem__(self, self.index_of(key), new)
+        return new
+
+    pass
+
+
+def can_memmap(name):
+    '''
+    Return True if the file of the given name may be memory mapped.
 
+    File objects and compressed files are not.
+    '''
+    if not isinstance(name, basestring):
+        return False
+    return not name.lower().endswith(('.gz','.zip','.bz2'))
 
 pyfitsopen = pyfits.open
 def lcatr_open(*args, **kwds):
@@ -413,11 +1373,31 @@ def lcatr_open(*args, **kwds):
 
     After loading this module, this method is available as the
     familiar ``pyfits.open()``.
+
+    If the keyword ``lazy=True`` is given a ``LazyHDUList`` is
+    returned which converts each HDU only when it is accessed and
+    which memory maps the file where possible.  All other arguments
+    are as for ``pyfits.open()``.
     '''
+    if kwds.pop('lazy', False):
+        return lazy_open(*args, **kwds)
 
     hl = pyfitsopen(*args,**kwds)
-    return pyfits.HDUList([hdu_pyfits2lcatr(hdu) for hdu in hl])
+    ret = pyfits.HDUList([hdu_pyfits2lcatr(hdu) for hdu in hl])
+    ret.source = hl.filename()  # see source_filename()
+    return ret
 pyfits.open = lcatr_open
+
+def lazy_open(name, mode='readonly', memmap=None, **kwds):
+    '''
+    Open a file returning a ``LazyHDUList``.
+
+    Unless explicitly given, memory mapping is used if
+    ``can_memmap()`` allows it.
+    '''
+    if memmap is None:
+        memmap = can_memmap(name)
+    return LazyHDUList.fromfile(name, mode, memmap, **kwds)
     
 
 # import all of pyfits so users need not include pyfits 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+'''
+Validate many result files at once.
+
+Files are each opened with ``lcatr_open()`` and checked with
+``HDUList.validate()`` by a pool of worker processes.  One JSON
+object is written per file as soon as it is done, followed by a
+summary.  This is the ``lcatr-validate`` command:
+
+  $ lcatr-validate -j 16 /data/results '/data/more/*/results*.fits' > report.jsonl
+
+Each report line holds the ``file`` name, its ``size`` in bytes,
+whether it is ``valid``, the ``error`` message if not and the
+``seconds`` it took.  The summary is written to standard error.
+
+'''
+
+import os
+import sys
+import glob
+import time
+import json
+import fnmatch
+from optparse import OptionParser
+
+import util
+
+def find_files(args, pattern = '*.fits'):
+    '''
+    Generate the file names given by args.
+
+    Each argument may be a file, a directory, which is searched
+    recursively for files matching pattern, or a glob.
+    '''
+    for arg in args:
+        if os.path.isdir(arg):
+            for dirpath, dirnames, filenames in os.walk(arg):
+                dirnames.sort()
+                for filename in sorted(fnmatch.filter(filenames, pattern)):
+                    yield os.path.join(dirpath, filename)
+                continue
+            continue
+        if os.path.exists(arg):
+            yield arg
+            continue
+        for filename in sorted(glob.glob(arg)):
+            if os.path.isdir(filename):
+                for found in find_files([filename], pattern):
+                    yield found
+                continue
+            yield filename
+        continue
+    return
+
+def validate_file(filename, header_only = False):
+    '''
+    Validate one file and return its report as a dictionary.
+    '''
+    from lcatr.schema import base
+    start = time.time()
+    report = dict(file = filename, valid = True, error = None)
+    try:
+        report['size'] = os.stat(filename).st_size
+        if header_only:
+            base.validate_headers(filename)
+        else:
+            hdus = base.lcatr_open(filename, lazy=True)
+            try:
+                hdus.validate()
+            finally:
+                hdus.close()
+    except Exception, err:
+        report['valid'] = False
+        report['error'] = '%s: %s' % (err.__class__.__name__, err)
+    report['seconds'] = time.time() - start
+    return report
+
+# Pool workers take a single argument.
+def _validate_args(args):
+    return validate_file(*args)
+
+def validate_files(filenames, workers = None, header_only = False):
+    '''
+    Generate a report from validate_file() for each of the given
+    files, in the order they finish.
+
+    Up to workers processes are used, see util.process_map().
+    '''
+    args = ((filename, header_only) for filename in filenames)
+    return util.process_map(_validate_args, args, workers)
+
+def summarize(reports, seconds):
+    '''
+    Return a summary dictionary of the given reports which took the
+    given wall clock seconds to produce.  ``file_seconds`` is the sum
+    of the wall clock seconds spent on each file, across all workers.
+    '''
+    nfiles = len(reports)
+    nbytes = sum(r.get('size',0) for r in reports)
+    seconds = max(seconds, 1e-9)
+    return dict(files = nfiles,
+                invalid = len([r for r in reports if not r['valid']]),
+                bytes = nbytes,
+                seconds = seconds,
+                file_seconds = sum(r['seconds'] for r in reports),
+                files_per_second = nfiles/seconds,
+                megabytes_per_second = nbytes/seconds/(1<<20))
+
+def main(argv = None):
+    '''
+    The ``lcatr-validate`` command.  Return the exit code: 0 if all
+    files are valid, 1 if any are not.
+    '''
+    parser = OptionParser(usage = 'lcatr-validate [options] file|directory|glob ...')
+    parser.add_option('-j', '--workers', type='int', default=None,
+                      help='Number of worker processes, default is one per CPU')
+    parser.add_option('-p', '--pattern', default='*.fits',
+                      help='Pattern matching files to validate in directories')
+    parser.add_option('-o', '--output', default=None,
+                      help='Write the JSON-lines report to this file instead of standard output')
+    parser.add_option('--header-only', action='store_true', default=False,
+                      help='Only check headers against the schema, see base.validate_headers()')
+    opts, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no files given')
+
+    out = sys.stdout
+    if opts.output:
+        out = open(opts.output, 'w')
+
+    start = time.time()
+    reports = []
+    for report in validate_files(find_files(args, opts.pattern),
+                                 opts.workers, opts.header_only):
+        out.write(json.dumps(report, sort_keys=True) + '\n')
+        out.flush()
+        reports.append(report)
+        continue
+    summary = summarize(reports, time.time() - start)
+    if opts.output:
+        out.close()
+
+    sys.stderr.write('%(files)d files, %(invalid)d invalid, %(seconds).2f s, '
+                     '%(files_per_second).1f files/s, %(megabytes_per_second).1f MB/s\n' % summary)
+    sys.stderr.write(json.dumps(summary, sort_keys=True) + '\n')
+    if summary['invalid']:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
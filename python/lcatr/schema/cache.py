@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+'''
+Persistent caches.
+
+Digest cache
+------------
+
+Taking the SHA1 digest of the files referenced by a
+``FileRefTableHDU`` means reading them in full.  A ``DigestCache``
+remembers digests in an SQLite database keyed on the file's resolved
+path and its identity as given by ``os.stat()``: device, inode, size
+and modification time.  If any of these change the entry is ignored
+and the file is read again.
+
+The cache used by ``util.sha1_digest()`` is set with
+``util.use_digest_cache()`` or by pointing the ``LCATR_DIGEST_CACHE``
+environment variable at a database file:
+
+  >>> from lcatr.schema import util
+  >>> util.use_digest_cache('/var/cache/lcatr/digests.db')
+  >>> util.sha1_digest('flat1.fits').hexdigest()
+
+Result cache
+------------
+
+A ``ResultCache`` holds the outcome of checks on files, such as
+``util.fitsverify_files()`` and ``HDUList.validate()``, keyed by the
+file's content digest so unchanged files need not be checked again.  It is set with
+``util.use_result_cache()`` or the ``LCATR_RESULT_CACHE`` environment
+variable.
+
+Any number of threads and processes may share one database file.
+
+'''
+
+import os
+import time
+import json
+import sqlite3
+import binascii
+import threading
+
+import util
+import instrument
+
+class Digest(object):
+    '''
+    Stand in for a ``hashlib.sha1()`` object when only the digest is
+    known.
+    '''
+    def __init__(self, hexdigest):
+        self._hexdigest = hexdigest
+        return
+    def hexdigest(self):
+        return self._hexdigest
+    def digest(self):
+        return binascii.unhexlify(self._hexdigest)
+    pass
+
+
+def stat_key(st):
+    '''
+    Return the (dev, ino, size, mtime_ns) identity of a file from its
+    ``os.stat()`` result.
+    '''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1e9))
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+class SQLiteCache(object):
+    '''
+    Base for caches kept in an SQLite database file.
+
+    Subclasses give the ``table`` they use, its primary ``key``
+    column and the SQL to ``create`` it.  The table must have an
+    integer ``atime`` column holding when the entry was last used.
+
+    At most max_entries entries are kept.  Once the cache grows beyond
+    that the least recently used entries are dropped.  To keep reads
+    cheap an entry's use time is only updated if it is older than
+    touch_interval seconds.
+    '''
+
+    #: The name of the table, set by subclasses
+    table = None
+
+    #: The name of the primary key column, set by subclasses
+    key = None
+
+    #: SQL statements creating the table, set by subclasses
+    create = ()
+
+    #: Default number of entries kept
+    max_entries = 100000
+
+    #: Seconds between updates of an entry's last use time
+    touch_interval = 3600
+
+    #: Seconds to wait on another writer before giving up
+    timeout = 60.0
+
+    #: Check the cache size after this many new entries
+    evict_interval = 100
+
+    def __init__(self, filename, max_entries = None):
+        self.filename = filename
+        if max_entries:
+            self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stored = 0
+        for sql in self.create:
+            self._execute(sql)
+        self._execute('CREATE INDEX IF NOT EXISTS %s_atime ON %s (atime)' % (self.table, self.table))
+        return
+
+    def _connection(self):
+        'One connection per thread as required by sqlite3.'
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout = self.timeout,
+                                   isolation_level = None)
+            util.use_wal(conn)
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql, args = ()):
+        return self._connection().execute(sql, args)
+
+    def _touch(self, key, atime):
+        'Update the use time of the entry if it is stale.'
+        now = int(time.time())
+        if now - atime > self.touch_interval:
+            self._execute('UPDATE %s SET atime = ? WHERE %s = ?' % (self.table, self.key),
+                          (now, key))
+        return
+
+    def _stored_one(self):
+        'Count a new entry, evicting old ones every so often.'
+        with self._lock:
+            self._stored += 1
+            evict = not self._stored % self.evict_interval
+        if evict:
+            self.evict()
+        return
+
+    def evict(self):
+        '''
+        Remove the least recently used entries beyond ``max_entries``.
+        '''
+        self._execute('DELETE FROM %s WHERE %s IN '
+                      '(SELECT %s FROM %s ORDER BY atime LIMIT '
+                      'max(0, (SELECT count(*) FROM %s) - ?))' % \
+                          (self.table, self.key, self.key, self.table, self.table),
+                      (self.max_entries,))
+        return
+
+    def clear(self):
+        'Remove all entries.'
+        self._execute('DELETE FROM %s' % self.table)
+        return
+
+    def __len__(self):
+        return self._execute('SELECT count(*) FROM %s' % self.table).fetchone()[0]
+
+    pass
+
+
+class DigestCache(SQLiteCache):
+    '''
+    A SQLite backed cache of SHA1 file digests.
+
+    Entries are keyed on the file's path as given, normalised without
+    looking at the file system, and are only used if the file's
+    ``stat_key()`` is unchanged.  As that includes the device and
+    inode, a path which now names another file, or a relative path
+    taken from another directory, misses rather than giving a wrong
+    digest, and a hit costs the one stat of the file.
+    '''
+
+    table = 'digests'
+    key = 'path'
+    create = ['''CREATE TABLE IF NOT EXISTS digests (
+                 path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER,
+                 size INTEGER, mtime_ns INTEGER, sha1 TEXT, atime INTEGER)''']
+
+    def lookup(self, path, st = None):
+        '''
+        Return the cached hex digest of the file at the given path or
+        None if there is no valid entry.
+
+        The file's stat result may be given if already known.
+        '''
+        st = st or os.stat(path)
+        path = os.path.normpath(path)
+        row = self._execute('SELECT dev, ino, size, mtime_ns, sha1, atime '
+                            'FROM digests WHERE path = ?', (path,)).fetchone()
+        if row is None or tuple(row[:4]) != stat_key(st):
+            return None
+        self._touch(path, row[5])
+        return str(row[4])
+
+    def store(self, path, hexdigest, st = None):
+        '''
+        Remember the hex digest of the file at the given path.
+
+        The stat result should be taken before the file is read so a
+        file changing while it is hashed is not wrongly cached.
+        '''
+        st = st or os.stat(path)
+        path = os.path.normpath(path)
+        self._execute('INSERT OR REPLACE INTO digests VALUES (?,?,?,?,?,?,?)',
+                      (path,) + stat_key(st) + (hexdigest, int(time.time())))
+        self._stored_one()
+        return
+
+    def sha1(self, path, bufsize = None):
+        '''
+        Return the hex SHA1 digest of the file at the given path,
+        taken from the cache if possible and cached if not.
+        '''
+        st = os.stat(path)
+        hexdigest = self.lookup(path, st)
+        if hexdigest is None:
+            instrument.count('digest_cache.miss')
+            hexdigest = util.sha1_file(path, bufsize).hexdigest()
+            self.store(path, hexdigest, st)
+        else:
+            instrument.count('digest_cache.hit')
+        return hexdigest
+
+    pass
+
+
+class ResultCache(SQLiteCache):
+    '''
+    A SQLite backed cache of the results of checks on files.
+
+    Keys are strings built by the caller, typically from the kind of
+    check and the file's content digest, so that a changed file is
+    never given an old result.  Values are anything that can be
+    stored as JSON.
+    '''
+
+    table = 'results'
+    key = 'key'
+    create = ['''CREATE TABLE IF NOT EXISTS results (
+                 key TEXT PRIMARY KEY, value TEXT, atime INTEGER)''']
+
+    def get(self, key, default = None):
+        '''
+        Return the value stored under key or default if there is none.
+        '''
+        row = self._execute('SELECT value, atime FROM results WHERE key = ?', 
+                            (key,)).fetchone()
+        if row is None:
+            return default
+        self._touch(key, row[1])
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        '''
+        Store the value under key.
+        '''
+        self._execute('INSERT OR REPLACE INTO results VALUES (?,?,?)',
+                      (key, json.dumps(value), int(time.time())))
+        self._stored_one()
+        return
+
+    def discard(self, key):
+        '''
+        Remove any value stored under key.
+        '''
+        self._execute('DELETE FROM results WHERE key = ?', (key,))
+        return
+
+    pass
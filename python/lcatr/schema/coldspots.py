@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+'''
+Spatial index of cold spots across amplifiers and CCDs.
+
+Cold spot tables, such as ``ptc.PtcColdSpotTableHDU`` and the older
+``gnc.GncColdSpotsHDU``, hold one row per spot with its ``AmpNum``,
+``SpotX``, ``SpotY`` and ``PixCount``.  A ``SpotIndex`` holds the
+spots of many files sorted by amplifier and by the square grid cell
+of ``cell_size`` pixels they fall in, so that a query only looks at
+the spots in the cells it overlaps:
+
+  >>> from lcatr.schema import coldspots
+  >>> index = coldspots.from_files(bulk.find_files(['/data/results']))
+  >>> index.files_near(amp=3, x=120, y=1500, r=10)
+  ['/data/results/114-03/ptc.fits', ...]
+
+Queries come in batches, as arrays of amplifiers and positions, and
+are answered with whole array operations.  ``radius()`` and ``box()``
+return the query and spot index of each match.  The spot's file is
+``index.files[index.file_id[spot]]``.
+
+The index can also be built from the tables of a columnar store made
+by ``export``, see ``from_export()``, and kept on disk with
+``cached()`` which only rebuilds it when its sources change:
+
+  >>> index = coldspots.cached('spots.npz', outdir = '/data/columns')
+'''
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy
+import base
+import util
+
+#: Default size in pixels of the sides of the grid cells
+cell_size = 32
+
+#: The columns read from cold spot tables, matched without regard to
+#: case.  Tables without the first three are not cold spot tables.
+spot_columns = ['AmpNum', 'SpotX', 'SpotY', 'PixCount']
+
+# Bits of the sort key given to each cell coordinate
+_cell_bits = 20
+_cell_offset = 1 << (_cell_bits - 1)
+
+class SpotIndex(object):
+    '''
+    A grid index of cold spots.
+
+    The arrays give the amplifier, position, pixel count and file of
+    each spot, the file being an index into the list files.
+    '''
+
+    def __init__(self, amp, x, y, pixcount, file_id, files, cell = None):
+        self.cell = cell or cell_size
+        self.files = list(files)
+        amp = numpy.asarray(amp, dtype = numpy.int64)
+        x = numpy.asarray(x, dtype = numpy.float64)
+        y = numpy.asarray(y, dtype = numpy.float64)
+        keys = self.keys_of(amp, self.cells_of(x), self.cells_of(y))
+        order = numpy.argsort(keys, kind = 'mergesort')
+        #: The sort key of each spot, see keys_of()
+        self.keys = keys[order]
+        self.amp = amp[order]
+        self.x = x[order]
+        self.y = y[order]
+        self.pixcount = numpy.asarray(pixcount, dtype = numpy.int64)[order]
+        self.file_id = numpy.asarray(file_id, dtype = numpy.int64)[order]
+        #: Identifies the sources the index was built from, see cached()
+        self.fingerprint = None
+        #: List of (filename, error) of the files which could not be read
+        self.errors = []
+        return
+
+    def __len__(self):
+        return len(self.keys)
+
+    def cells_of(self, coord):
+        'Return the grid cell numbers of an array of coordinates.'
+        cells = numpy.floor(numpy.asarray(coord, dtype = numpy.float64) / self.cell)
+        return numpy.clip(cells + _cell_offset, 0, (1 << _cell_bits) - 1).astype(numpy.int64)
+
+    @staticmethod
+    def keys_of(amp, cx, cy):
+        '''
+        Return the sort keys of amplifiers and cells.  Cells of a row
+        of the grid of one amplifier have consecutive keys.
+        '''
+        return (amp << (2 * _cell_bits)) | (cy << _cell_bits) | cx
+
+    def candidates(self, amp, x0, y0, x1, y1):
+        '''
+        Return arrays of (query index, spot index) of the spots in the
+        grid cells overlapped by each query box.
+        '''
+        cx0, cx1 = self.cells_of(x0), self.cells_of(x1)
+        cy0, cy1 = self.cells_of(y0), self.cells_of(y1)
+        nrows = numpy.maximum(cy1 - cy0 + 1, 0)
+        # one entry for each row of grid cells of each query
+        query = numpy.repeat(numpy.arange(len(amp)), nrows)
+        first = numpy.cumsum(nrows) - nrows
+        cy = cy0[query] + numpy.arange(len(query)) - first[query]
+        start = numpy.searchsorted(self.keys, self.keys_of(amp[query], cx0[query], cy), 'left')
+        end = numpy.searchsorted(self.keys, self.keys_of(amp[query], cx1[query], cy), 'right')
+        counts = numpy.maximum(end - start, 0)
+        # one entry for each spot in those rows
+        first = numpy.cumsum(counts) - counts
+        spot = numpy.repeat(start - first, counts) + numpy.arange(counts.sum())
+        return numpy.repeat(query, counts), spot
+
+    def box(self, amp, x0, y0, x1, y1):
+        '''
+        Find the spots on amplifier amp with x0 <= x <= x1 and
+        y0 <= y <= y1.  The arguments are arrays, one entry per query,
+        or scalars.  Return arrays of (query index, spot index) of
+        the matches, ordered by query.
+        '''
+        amp, x0, y0, x1, y1 = query_arrays(amp, x0, y0, x1, y1)
+        query, spot = self.candidates(amp, x0, y0, x1, y1)
+        x, y = self.x[spot], self.y[spot]
+        keep = (x >= x0[query]) & (x <= x1[query]) & (y >= y0[query]) & (y <= y1[query])
+        return query[keep], spot[keep]
+
+    def radius(self, amp, x, y, r):
+        '''
+        Find the spots on amplifier amp within distance r of (x, y).
+        The arguments are arrays, one entry per query, or scalars.
+        Return arrays of (query index, spot index) of the matches,
+        ordered by query.
+        '''
+        amp, x, y, r = query_arrays(amp, x, y, r)
+        query, spot = self.candidates(amp, x - r, y - r, x + r, y + r)
+        dx = self.x[spot] - x[query]
+        dy = self.y[spot] - y[query]
+        keep = dx*dx + dy*dy <= r[query]*r[query]
+        return query[keep], spot[keep]
+
+    def files_near(self, amp, x, y, r):
+        '''
+        Return the sorted names of the files with a spot on amplifier
+        amp within distance r of (x, y).
+        '''
+        query, spot = self.radius(amp, x, y, r)
+        return sorted(self.files[index] for index in numpy.unique(self.file_id[spot]))
+
+    def save(self, filename):
+        '''
+        Write the index to a file, replacing it at once.
+        '''
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(suffix = '.npz', prefix = '.spots-', dir = dirname)
+        fp = os.fdopen(fd, 'wb')
+        try:
+            numpy.savez(fp, amp = self.amp, x = self.x, y = self.y, pixcount = self.pixcount,
+                        file_id = self.file_id, keys = self.keys,
+                        meta = numpy.array(json.dumps(dict(cell = self.cell, files = self.files,
+                                                           fingerprint = self.fingerprint,
+                                                           errors = self.errors))))
+            fp.close()
+            os.chmod(tmp, util.new_file_mode())
+        except:
+            fp.close()
+            os.remove(tmp)
+            raise
+        os.rename(tmp, filename)
+        return
+
+    @classmethod
+    def load(klass, filename):
+        'Return the index written to a file by save().'
+        arrays = numpy.load(filename)
+        meta = json.loads(str(arrays['meta']))
+        index = klass.__new__(klass)
+        index.cell = meta['cell']
+        index.files = meta['files']
+        index.fingerprint = meta['fingerprint']
+        index.errors = [tuple(error) for error in meta.get('errors', [])]
+        for name in ['amp', 'x', 'y', 'pixcount', 'file_id', 'keys']:
+            setattr(index, name, arrays[name])
+            continue
+        arrays.close()
+        return index
+
+    pass
+
+def query_arrays(*args):
+    'Return the query arguments as flat arrays of one length.'
+    args = numpy.broadcast_arrays(*[numpy.atleast_1d(arg) for arg in args])
+    return [args[0].astype(numpy.int64).ravel()] + \
+        [arg.astype(numpy.float64).ravel() for arg in args[1:]]
+
+def spot_table_columns(hdu):
+    '''
+    Return a map of each of the ``spot_columns`` to its name in the
+    table HDU or None if it is not a cold spot table.
+    '''
+    header = hdu.header
+    names = dict()
+    for count in range(1, (header.get('TFIELDS') or 0) + 1):
+        name = header.get('TTYPE%d' % count)
+        if name:
+            names[name.lower()] = name
+        continue
+    ret = dict((column, names.get(column.lower())) for column in spot_columns)
+    if None in [ret[column] for column in spot_columns[:3]]:
+        return None
+    return ret
+
+def read_spots(filename):
+    '''
+    Return a list of dictionaries mapping each of the ``spot_columns``
+    to its array, one for each cold spot table in the file.  Missing
+    pixel counts are zero.  The file is read without regard to its
+    schema so any table with the spot columns is found.
+    '''
+    hdus = base.pyfitsopen(filename, memmap = base.can_memmap(filename))
+    ret = []
+    try:
+        for hdu in hdus[1:]:
+            names = spot_table_columns(hdu)
+            if names is None or hdu.data is None:
+                continue
+            spots = dict((column, numpy.array(hdu.data.field(name)))
+                         for column, name in names.items() if name)
+            spots.setdefault('PixCount', numpy.zeros(len(hdu.data), dtype = numpy.int64))
+            ret.append(spots)
+            continue
+    finally:
+        hdus.close()
+    return ret
+
+def from_files(filenames, cell = None):
+    '''
+    Return a ``SpotIndex`` of the cold spot tables of the files.
+
+    A file which can not be read is left out of the index and noted,
+    with its error, in the index's ``errors``.
+    '''
+    files = []
+    parts = []
+    errors = []
+    for filename in filenames:
+        try:
+            found = read_spots(filename)
+        except Exception, err:
+            errors.append((filename, '%s: %s' % (err.__class__.__name__, err)))
+            continue
+        for spots in found:
+            spots['file_id'] = numpy.repeat(len(files), len(spots['AmpNum']))
+            parts.append(spots)
+            continue
+        files.append(filename)
+        continue
+    columns = spot_columns + ['file_id']
+    arrays = [numpy.concatenate([spots[name] for spots in parts]) if parts else numpy.zeros(0)
+              for name in columns]
+    index = SpotIndex(*(arrays + [files, cell]))
+    index.errors = errors
+    return index
+
+def from_export(outdir, classname = 'PtcColdSpotTableHDU', cell = None):
+    '''
+    Return a ``SpotIndex`` of the cold spot table of the given schema
+    class in the columnar store in outdir, see ``export``.
+    '''
+    import export
+    columns = export.load(outdir, classname)
+    files = [entry['file'] for entry in export.load_files(outdir)]
+    return SpotIndex(columns['AmpNum'], columns['SpotX'], columns['SpotY'],
+                     columns['PixCount'], columns['_file_id'], files, cell)
+
+def sources_fingerprint(filenames = None, outdir = None, classname = None, cell = None):
+    '''
+    Return a digest of the names, sizes and modification times of the
+    index sources along with the index parameters.
+    '''
+    if outdir:
+        paths = [os.path.join(outdir, 'files.json'), os.path.join(outdir, 'tables.json')]
+    else:
+        paths = filenames
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats.append((os.path.abspath(path), st.st_size, st.st_mtime))
+        except OSError:
+            stats.append((os.path.abspath(path), None, None))
+        continue
+    return hashlib.sha1(json.dumps([stats, classname, cell or cell_size])).hexdigest()
+
+def cached(cachefile, filenames = None, outdir = None, classname = 'PtcColdSpotTableHDU', cell = None):
+    '''
+    Return the ``SpotIndex`` of the files, or of the columnar store in
+    outdir, from cachefile if it was built from the same sources and
+    is still current, otherwise build it and write it to cachefile.
+    '''
+    filenames = filenames and list(filenames)
+    if outdir:
+        fingerprint = sources_fingerprint(outdir = outdir, classname = classname, cell = cell)
+    else:
+        fingerprint = sources_fingerprint(filenames, cell = cell)
+    if os.path.exists(cachefile):
+        try:
+            index = SpotIndex.load(cachefile)
+        except (IOError, ValueError, KeyError):
+            index = None        # unreadable, build anew
+        if index is not None and index.fingerprint == fingerprint:
+            return index
+    if outdir:
+        index = from_export(outdir, classname, cell)
+    else:
+        index = from_files(filenames, cell)
+    index.fingerprint = fingerprint
+    index.save(cachefile)
+    return index
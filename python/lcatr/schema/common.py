@@ -3,6 +3,9 @@
 Some common, reusable HDU classes.
 '''
 
+import os
+import hashlib
+import itertools
 import base as pyfits
 import util
 
@@ -27,15 +30,21 @@ class FileRefTableHDU(pyfits.BinTableHDU):
         ('SHA1Hash', 'A64', 'A SHA1 digest of the file contents'),
         ]
 
+    #: A fileset may be empty (eg, a test with no auxiliary files).
+    allow_empty = True
 
-    def generate(self):
+
+    def generate(self, workers = None):
         '''
         Replace file hashes with new ones by running
         ``hashlib.sha1()`` on the file contents.
+
+        Up to workers files are hashed concurrently, see
+        util.sha1_digests().
         '''
+        filenames = [filename for filename,ignore in self.data]
         hashes = []
-        for filename,ignore in self.data:
-            h = util.sha1_digest(filename)
+        for filename,h in zip(filenames, util.sha1_digests(filenames, workers)):
             if not h:
                 raise ValueError,'FileRefTableHDU.generate() failed take SHA1 of "%s"' % filename
             hashes.append(h.hexdigest())
@@ -43,23 +52,50 @@ class FileRefTableHDU(pyfits.BinTableHDU):
         self.set_column_array('SHA1Hash',hashes)
         return
 
-    def validate(self):
+    def validation_key(self):
+        '''
+        Return a digest of the identity of the referenced files, as
+        given by ``cache.stat_key()``, so that a cached validation is
+        not reused once any of them change.
+        '''
+        import cache
+        paths = util.full_paths([name for name,digest in self.data])
+        ids = [path and os.path.exists(path) and cache.stat_key(os.stat(path))
+               for path in paths]
+        return hashlib.sha1(repr(ids)).hexdigest()
+
+    def validate(self, workers = None, report_all = False):
         '''
         Validate the referenced files.
 
         This will locate each file by its path and calculate the SHA1
-        hash of its contents.
+        hash of its contents.  Up to workers files are hashed
+        concurrently, see util.sha1_digests().
+
+        By default the ValueError raised names the first bad file in
+        table order.  If report_all is True its message instead lists
+        every bad file, one per line.
 
         See util.full_path() for how the files are located.
         '''
-        for name,digest in self.data:
-            h = util.sha1_digest(name)
-            if not h:
-                raise ValueError,'Failed to take SHA1 of "%s"' % name
-            h = h.hexdigest()
-            if h != digest:
-                raise ValueError,'SHA1 hash mismatch for "%s": %s != %s' % (name, h, digest)
-            continue
+        names = [name for name,digest in self.data]
+        errors = []
+        digests = util.sha1_digests(names, workers)
+        try:
+            for (name,digest),h in itertools.izip(self.data, digests):
+                if not h:
+                    errors.append('Failed to take SHA1 of "%s"' % name)
+                else:
+                    h = h.hexdigest()
+                    if h != digest:
+                        errors.append('SHA1 hash mismatch for "%s": %s != %s' % (name, h, digest))
+                if errors and not report_all:
+                    break
+                continue
+        finally:
+            digests.close()     # stop hashing the rest
+        if errors:
+            raise ValueError, '\n'.join(errors)
         return
     pass
 
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+'''
+Export the tables of many result files into one columnar store.
+
+Every table HDU whose schema class has ``required_columns`` is
+appended, row for row, to one ``.npy`` file per schema class and
+column.  Each row also gets provenance columns:
+
+``_file_id``
+    index of the file the row came from in the store's ``files.json``
+
+``_testname``, ``_date_obs``
+    the ``TESTNAME`` and ``DATE-OBS`` cards of that file's primary HDU
+
+The files are written as the result files are read so memory use does
+not grow with the size of the fleet.  Once written the store is loaded
+as memory mapped arrays and fleet wide statistics are single numpy
+reductions:
+
+  >>> from lcatr.schema import export
+  >>> export.export(['/data/results'], '/data/columns')
+  >>> amps = export.load('/data/columns', 'PtcAmpTableHDU')
+  >>> print amps['FullWell'].mean()
+
+This is also the ``lcatr-export`` command:
+
+  $ lcatr-export -o /data/columns /data/results
+'''
+
+import os
+import sys
+import json
+import struct
+import numpy
+from optparse import OptionParser
+
+import base
+import bulk
+
+#: Size of the .npy header written, large enough to later hold any row count.
+npy_header_size = 128
+
+#: The provenance columns and their types.
+provenance_columns = [('_file_id', numpy.dtype('<i4')),
+                      ('_testname', numpy.dtype('S68')),
+                      ('_date_obs', numpy.dtype('S68'))]
+
+def npy_header(dtype, rows):
+    '''
+    Return a version 1.0 ``.npy`` header of npy_header_size bytes for
+    a C ordered array of rows elements of the given dtype.  Subarray
+    dtypes give extra dimensions.
+    '''
+    shape = (rows,) + dtype.shape
+    desc = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % \
+        (numpy.lib.format.dtype_to_descr(dtype.base), shape)
+    pad = npy_header_size - 10 - len(desc) - 1
+    if pad < 0:
+        raise ValueError, 'npy header for %s is too long' % dtype
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(desc) + pad + 1) + desc + ' '*pad + '\n'
+
+class ColumnWriter(object):
+    '''
+    Append arrays of one dtype to a ``.npy`` file.
+    '''
+
+    def __init__(self, filename, dtype):
+        self.filename = filename
+        self.dtype = numpy.dtype(dtype)
+        self.rows = 0
+        self.fp = open(filename, 'wb')
+        self.fp.write(npy_header(self.dtype, 0))
+        return
+
+    def append(self, array):
+        array = numpy.ascontiguousarray(array, dtype = self.dtype.base)
+        self.fp.write(array.tostring())
+        self.rows += len(array)
+        return
+
+    def close(self):
+        'Write the final row count into the header and close the file.'
+        self.fp.seek(0)
+        self.fp.write(npy_header(self.dtype, self.rows))
+        self.fp.close()
+        return
+
+    pass
+
+class Exporter(object):
+    '''
+    Append the tables of result files to a columnar store.
+
+    If classes is given only the schema classes of those names are
+    exported.  Call close() when all files are added.
+    '''
+
+    def __init__(self, outdir, classes = None):
+        self.outdir = outdir
+        self.classes = classes and set(name.lower() for name in classes)
+        #: Map of schema class name to map of column name to ColumnWriter
+        self.writers = dict()
+        #: One entry per file added, see add_file()
+        self.files = []
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        return
+
+    def table_writers(self, klass):
+        '''
+        Return the column writers of the schema class, making them if needed.
+        '''
+        name = klass.__name__
+        writers = self.writers.get(name)
+        if writers is not None:
+            return writers
+        dirname = os.path.join(self.outdir, name)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        records = klass.records_dtype()
+        columns = [(col, records[col]) for col in records.names] + provenance_columns
+        writers = dict()
+        for column, dtype in columns:
+            writers[column] = ColumnWriter(os.path.join(dirname, column + '.npy'), dtype)
+            continue
+        self.writers[name] = writers
+        return writers
+
+    def exportable(self, hdu):
+        'Return True if the HDU is a table to export.'
+        if not isinstance(hdu, base.TableBaseHDU) or not hdu.required_columns:
+            return False
+        if self.classes and type(hdu).__name__.lower() not in self.classes:
+            return False
+        return True
+
+    def add_file(self, filename):
+        '''
+        Append the tables of the result file.  Return the number of
+        rows appended.
+
+        A file which can not be read is noted in ``files`` with its
+        error and nothing of it is exported.
+        '''
+        file_id = len(self.files)
+        entry = dict(file = filename, rows = 0, error = None)
+        self.files.append(entry)
+        try:
+            hdus = base.lcatr_open(filename, lazy = True)
+        except Exception, err:
+            entry['error'] = '%s: %s' % (err.__class__.__name__, err)
+            return 0
+        try:
+            # read all tables of the file first so a bad file adds nothing
+            tables = []
+            primary = None
+            for hdu in hdus:
+                if primary is None:
+                    primary = hdu.header
+                if not self.exportable(hdu):
+                    continue
+                data = hdu.data
+                columns = [(name, data.field(name)) for name in hdu.records_dtype().names]
+                tables.append((type(hdu), len(data), columns))
+                continue
+        except Exception, err:
+            entry['error'] = '%s: %s' % (err.__class__.__name__, err)
+            hdus.close()
+            return 0
+
+        testname = str(primary.get('TESTNAME') or '')
+        date_obs = str(primary.get('DATE-OBS') or '')
+        for klass, nrows, columns in tables:
+            writers = self.table_writers(klass)
+            for name, array in columns:
+                writers[name].append(array)
+                continue
+            writers['_file_id'].append(numpy.repeat(file_id, nrows))
+            writers['_testname'].append(numpy.repeat(testname, nrows))
+            writers['_date_obs'].append(numpy.repeat(date_obs, nrows))
+            entry['rows'] += nrows
+            continue
+        hdus.close()
+        return entry['rows']
+
+    def close(self):
+        '''
+        Finish the column files and write ``files.json`` and
+        ``tables.json`` which describes each table's columns and rows.
+        '''
+        tables = dict()
+        for name, writers in self.writers.items():
+            rows = 0
+            for column, writer in writers.items():
+                writer.close()
+                rows = writer.rows
+                continue
+            tables[name] = dict(rows = rows, columns = sorted(writers))
+            continue
+        for what, obj in [('files', self.files), ('tables', tables)]:
+            fp = open(os.path.join(self.outdir, what + '.json'), 'w')
+            fp.write(json.dumps(obj, indent=1, sort_keys=True) + '\n')
+            fp.close()
+            continue
+        return
+
+    pass
+
+def export(args, outdir, pattern = '*.fits', classes = None):
+    '''
+    Export the result files given by args, as for ``bulk.find_files()``,
+    to a store in outdir.  Return the ``Exporter``.
+    '''
+    exporter = Exporter(outdir, classes)
+    for filename in bulk.find_files(args, pattern):
+        exporter.add_file(filename)
+        continue
+    exporter.close()
+    return exporter
+
+def load(outdir, classname, mmap_mode = 'r'):
+    '''
+    Return a dictionary mapping column names, including the provenance
+    columns, to the memory mapped arrays of the named schema class in
+    the store in outdir.
+    '''
+    dirname = os.path.join(outdir, classname)
+    ret = dict()
+    for filename in sorted(os.listdir(dirname)):
+        if not filename.endswith('.npy'): continue
+        ret[filename[:-4]] = numpy.load(os.path.join(dirname, filename), mmap_mode = mmap_mode)
+        continue
+    return ret
+
+def load_files(outdir):
+    '''
+    Return the list of files in the store in outdir, indexed by ``_file_id``.
+    '''
+    return json.load(open(os.path.join(outdir, 'files.json')))
+
+def main(argv = None):
+    '''
+    The ``lcatr-export`` command.  Return the exit code: 0 if all
+    files were exported, 1 if any could not be read.
+    '''
+    parser = OptionParser(usage = 'lcatr-export -o outdir [options] file|directory|glob ...')
+    parser.add_option('-o', '--output', default=None,
+                      help='Directory to write the columnar store to')
+    parser.add_option('-p', '--pattern', default='*.fits',
+                      help='Pattern matching files to export in directories')
+    parser.add_option('-c', '--classes', default=None,
+                      help='Comma separated list of schema classes to export, default is all')
+    opts, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no files given')
+    if not opts.output:
+        parser.error('no output directory given')
+
+    classes = opts.classes and opts.classes.split(',')
+    exporter = export(args, opts.output, opts.pattern, classes)
+    bad = [entry for entry in exporter.files if entry['error']]
+    for entry in bad:
+        sys.stderr.write('%(file)s: %(error)s\n' % entry)
+        continue
+    sys.stderr.write('%d files, %d not readable, %d rows\n' %
+                     (len(exporter.files), len(bad), sum(e['rows'] for e in exporter.files)))
+    if bad:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
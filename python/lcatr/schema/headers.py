@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+'''
+Read FITS headers directly from file.
+
+This module walks the 2880 byte blocks of a FITS file, parsing each
+header and skipping over the data that follows it without reading
+it.  It does not depend on ``pyfits`` or ``numpy`` and is meant for
+fast, header-only checks such as ``base.validate_headers()``.
+
+  >>> from lcatr.schema.headers import iter_headers
+  >>> for header in iter_headers("results.fits"):
+  ...     print header.get('EXTNAME'), header.get('NAXIS2')
+
+'''
+
+#: The size of a FITS block in bytes
+BLOCK_SIZE = 2880
+
+#: The size of a FITS header card in bytes
+CARD_SIZE = 80
+
+def padded_size(size):
+    '''
+    Return the given size rounded up to a whole number of blocks.
+    '''
+    return ((size + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE
+
+def parse_value(text):
+    '''
+    Convert the value field of a card to a Python object.
+
+    Strings, logicals, integers and floats are supported.  Anything
+    else, including an empty value, is returned as None.
+    '''
+    text = text.strip()
+    if not text:
+        return None
+    if text[0] == "'":
+        return text[1:text.rindex("'")].replace("''","'").rstrip()
+    if text == 'T': return True
+    if text == 'F': return False
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.upper().replace('D','E'))
+    except ValueError:
+        return None
+
+def parse_card(card):
+    '''
+    Parse an 80 character card into a (keyword, value, comment) triple.
+
+    Cards without a value indicator (eg, ``COMMENT``) have a value of
+    None and the rest of the card as the comment.
+    '''
+    key = card[:8].strip().upper()
+    if card[8:10] != '= ':
+        return key, None, card[8:].strip()
+    rest = card[10:]
+    if rest.lstrip().startswith("'"):
+        # find the closing quote, skipping over escaped ('') quotes
+        start = rest.index("'")
+        end = start + 1
+        while True:
+            end = rest.find("'", end)
+            if end < 0:
+                end = len(rest)
+                break
+            if rest[end+1:end+2] == "'":
+                end += 2
+                continue
+            break
+        value, comment = rest[:end+1], rest[end+1:]
+    else:
+        value, comment = rest, ''
+        if '/' in rest:
+            value, comment = rest.split('/',1)
+    comment = comment.strip()
+    if comment.startswith('/'):
+        comment = comment[1:].strip()
+    return key, parse_value(value), comment
+
+
+class RawHeader(object):
+    '''
+    A read-only FITS header as parsed directly from file.
+
+    It provides the subset of the ``pyfits.Header`` interface that
+    the validation code needs (``get()``, ``has_key()``, item access
+    and ``in``) plus where the header and its data live in the file.
+    '''
+
+    def __init__(self, cards, offset = 0, data_offset = 0):
+        #: The list of (keyword, value, comment) triples
+        self.cards = cards
+        #: The byte offset of the header in the file
+        self.offset = offset
+        #: The byte offset of the data following the header
+        self.data_offset = data_offset
+        self.values = dict()
+        for key,value,comment in cards:
+            if value is None or key in self.values: continue
+            self.values[key] = value
+            continue
+        return
+
+    def get(self, key, default = None):
+        return self.values.get(key.upper(), default)
+
+    def has_key(self, key):
+        return key.upper() in self.values
+
+    __contains__ = has_key
+
+    def __getitem__(self, key):
+        try:
+            return self.values[key.upper()]
+        except KeyError:
+            raise KeyError, 'Keyword "%s" not found.' % key
+
+    def keys(self):
+        return [key for key,value,comment in self.cards]
+
+    def data_size(self):
+        '''
+        Return the number of bytes of data, excluding padding.
+        '''
+        naxis = self.get('NAXIS',0)
+        if not naxis:
+            return 0
+        size = 1
+        first = 1
+        if self.get('SIMPLE') and self.get('NAXIS1') == 0:
+            first = 2           # random groups
+        for n in range(first, naxis+1):
+            size *= self.get('NAXIS%d' % n, 0)
+            continue
+        bits = abs(self.get('BITPIX',8))
+        return bits * self.get('GCOUNT',1) * (self.get('PCOUNT',0) + size) // 8
+
+    def padded_data_size(self):
+        '''
+        Return the number of bytes of data, including padding.
+        '''
+        return padded_size(self.data_size())
+
+    pass
+
+
+def read_header(fp):
+    '''
+    Read one header from the file object, leaving it positioned at
+    the start of the data.
+
+    Return a ``RawHeader`` or None if the end of file is reached
+    before any header.  ValueError is raised if the header is
+    truncated.
+    '''
+    offset = fp.tell()
+    cards = []
+    while True:
+        block = fp.read(BLOCK_SIZE)
+        if not block:
+            if cards: break
+            return None
+        if len(block) < BLOCK_SIZE:
+            raise ValueError, 'Truncated header block at byte %d' % offset
+        for start in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[start:start+CARD_SIZE]
+            if card[:8] == 'END     ':
+                return RawHeader(cards, offset, fp.tell())
+            if not card.strip(): continue
+            cards.append(parse_card(card))
+            continue
+        continue
+    raise ValueError, 'No END card in header at byte %d' % offset
+
+def iter_headers(filename):
+    '''
+    Generate a ``RawHeader`` for each HDU in the named file.
+
+    The data of each HDU is skipped over without being read.
+    '''
+    fp = open(filename, 'rb')
+    try:
+        while True:
+            header = read_header(fp)
+            if header is None: break
+            yield header
+            fp.seek(header.data_offset + header.padded_data_size())
+            continue
+    finally:
+        fp.close()
+    return
+
+def read_headers(filename):
+    '''
+    Return a list of all ``RawHeader``s in the named file.
+    '''
+    return list(iter_headers(filename))
@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+'''
+Load result files into an SQLite database.
+
+Each registered schema class gets its own tables, named after its
+``EXTNAME`` and ``EXTVER`` (see ``table_name()``):
+
+``<extname>_v<extver>``
+    one row per HDU holding its ``required_cards`` other than
+    ``EXTNAME`` and ``EXTVER``, made only for classes with such cards
+
+``<extname>_v<extver>_rows``
+    one row per table row holding its ``required_columns``, made
+    only for table classes
+
+Both are keyed by ``hdu_id`` which refers to the ``hdus`` table.  It
+holds each HDU's ``EXTNAME``, lower-cased as in the schema registry,
+its ``EXTVER``, schema class and position in its file, and refers to the ``files`` table by ``file_id``.  Each
+file's ``TESTNAME`` and ``DATE-OBS``, when its primary HDU has them,
+are copied to the ``files`` table.  These and ``EXTNAME``/``EXTVER``
+are indexed.
+
+Files are read as they are added and their rows written in batches,
+each one transaction of ``executemany()`` calls on one prepared
+statement per table:
+
+  >>> from lcatr.schema import ingest
+  >>> db = ingest.Ingester('results.db')
+  >>> for filename in bulk.find_files(['/data/results']):
+  ...     db.add_file(filename)
+  >>> db.close()
+  >>> conn = sqlite3.connect('results.db')
+  >>> conn.execute('SELECT testname, count(*) FROM files GROUP BY testname').fetchall()
+
+Adding a file already in the database replaces it.  This is also the
+``lcatr-ingest`` command:
+
+  $ lcatr-ingest -d results.db /data/results
+
+One process should write to a database at a time.
+
+Incremental ingest
+------------------
+
+``Ingester.update()`` loads only what changed in directory trees since
+the last update.  The database keeps a manifest of the files it has
+processed, with their size, modification time and SHA1 digest, and of
+the directories it has listed, with their modification time.  A scan
+stats each known directory and only lists those whose modification
+time changed, which is the case when files are created, removed or
+renamed in them.  Files rewritten in place do not change their
+directory, so those of the other directories are each checked with one
+stat against the manifest.  Files whose size or modification time
+changed are digested and only loaded again if their contents changed.
+New and changed files are opened with ``lcatr_open()`` and validated
+as above; removed ones are removed from the database.
+
+Where files are never rewritten in place, pass ``trust_dirs=True``, or
+``--trust-dirs`` to the command, to skip unchanged directories without
+looking at their files, so a scan's cost follows the number of
+directories rather than of files.  ``full=True``, or ``--full``,
+lists every directory whatever its modification time:
+
+  $ lcatr-ingest -d results.db --incremental /data/results
+  $ lcatr-ingest -d results.db --watch 60 --trust-dirs /data/results
+'''
+
+import os
+import sys
+import time
+import json
+import stat
+import sqlite3
+import fnmatch
+from optparse import OptionParser
+
+import base
+import bulk
+import util
+import instrument
+
+#: SQL statements making the tables common to all schema classes.
+create = [
+    '''CREATE TABLE IF NOT EXISTS files (
+       file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime REAL,
+       testname TEXT, date_obs TEXT, error TEXT, ingested REAL)''',
+    '''CREATE TABLE IF NOT EXISTS hdus (
+       hdu_id INTEGER PRIMARY KEY, file_id INTEGER, hdu_index INTEGER,
+       extname TEXT, extver INTEGER, classname TEXT)''',
+    'CREATE INDEX IF NOT EXISTS files_testname ON files (testname)',
+    'CREATE INDEX IF NOT EXISTS files_date_obs ON files (date_obs)',
+    'CREATE INDEX IF NOT EXISTS hdus_file_id ON hdus (file_id)',
+    'CREATE INDEX IF NOT EXISTS hdus_extname ON hdus (extname, extver)',
+    '''CREATE TABLE IF NOT EXISTS manifest (
+       path TEXT PRIMARY KEY, dirname TEXT, size INTEGER, mtime REAL, sha1 TEXT)''',
+    'CREATE INDEX IF NOT EXISTS manifest_dirname ON manifest (dirname)',
+    'CREATE TABLE IF NOT EXISTS manifest_dirs (dirname TEXT PRIMARY KEY, mtime REAL)',
+    ]
+
+#: Cards which are indexed in the card tables of classes that have them.
+indexed_cards = ['TESTNAME', 'DATE-OBS']
+
+def quote(name):
+    'Return the name quoted as an SQL identifier.'
+    return '"%s"' % name.replace('"', '""')
+
+def table_name(klass):
+    'Return the name of the card table of the schema class.'
+    return '%s_v%d' % (klass.__name__.lower(), klass.schema_version)
+
+def sql_type(dtype):
+    '''
+    Return the SQL column type for a column of the numpy dtype.
+    Columns with more than one element per row are stored as JSON text.
+    '''
+    if dtype is None:
+        return ''
+    if dtype.shape or dtype.kind in 'SU':
+        return 'TEXT'
+    if dtype.kind == 'f':
+        return 'REAL'
+    if dtype.kind in 'iub':
+        return 'INTEGER'
+    return ''
+
+class ClassTables(object):
+    '''
+    The SQL for the tables of one schema class.
+    '''
+
+    def __init__(self, klass):
+        plan = klass.schema_plan()
+        name = table_name(klass)
+
+        #: The cards stored, those required beyond EXTNAME and EXTVER
+        self.cards = [card for card in plan.card_names
+                      if card not in ('EXTNAME', 'EXTVER')]
+        #: The columns stored
+        self.columns = [column[0] for column in plan.columns]
+        #: Which columns are stored as JSON
+        self.json_columns = [bool(dtype is not None and dtype.shape) for dtype in plan.dtypes]
+
+        #: The card and row table names, None if not made
+        self.card_table = self.cards and name or None
+        self.row_table = issubclass(klass, base.TableBaseHDU) and name + '_rows' or None
+
+        #: SQL statements making the tables
+        self.create = []
+        #: Map of table name to its insert statement
+        self.insert = dict()
+        if self.card_table:
+            self.create.append('CREATE TABLE IF NOT EXISTS %s (hdu_id INTEGER PRIMARY KEY, %s)' % \
+                                   (quote(name), ', '.join(quote(card) for card in self.cards)))
+            for card in self.cards:
+                if card in indexed_cards:
+                    self.create.append('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % \
+                                           (quote('%s_%s' % (name, card.lower())),
+                                            quote(name), quote(card)))
+                continue
+            self.insert[name] = 'INSERT INTO %s VALUES (%s)' % \
+                (quote(name), ', '.join(['?'] * (len(self.cards) + 1)))
+        if self.row_table:
+            columns = ['hdu_id INTEGER', 'row INTEGER'] + \
+                ['%s %s' % (quote(column), sql_type(dtype))
+                 for column, dtype in zip(self.columns, plan.dtypes)]
+            self.create.append('CREATE TABLE IF NOT EXISTS %s (%s)' % \
+                                   (quote(self.row_table), ', '.join(columns)))
+            self.create.append('CREATE INDEX IF NOT EXISTS %s ON %s (hdu_id)' % \
+                                   (quote(self.row_table + '_hdu_id'), quote(self.row_table)))
+            self.insert[self.row_table] = 'INSERT INTO %s VALUES (%s)' % \
+                (quote(self.row_table), ', '.join(['?'] * (len(self.columns) + 2)))
+        return
+
+    def card_row(self, hdu_id, header):
+        'Return the card table row of an HDU with the given header.'
+        return (hdu_id,) + tuple(header.get(card) for card in self.cards)
+
+    def table_rows(self, hdu_id, data):
+        'Return the row table rows of an HDU with the given data.'
+        nrows = len(data)
+        columns = [[hdu_id] * nrows, range(nrows)]
+        for column, as_json in zip(self.columns, self.json_columns):
+            values = data.field(column).tolist()
+            if as_json:
+                values = [json.dumps(value) for value in values]
+            columns.append(values)
+            continue
+        return zip(*columns)
+
+    pass
+
+class Delta(object):
+    '''
+    The differences between directory trees and the manifest, see
+    ``Ingester.scan()``.
+    '''
+
+    def __init__(self):
+        #: New files, as a list of (path, size, mtime)
+        self.new = []
+        #: Files whose size or modification time changed, as a list of
+        #: (path, size, mtime, SHA1 digest in the manifest)
+        self.changed = []
+        #: Paths of files which are gone
+        self.deleted = []
+        #: Paths of changed files whose contents are the same, set by
+        #: ``Ingester.update()``
+        self.touched = []
+        #: Listed directories as a list of (path, mtime), the mtime is
+        #: None if the directory is to be listed again next time
+        self.dirs = []
+        #: Paths of directories which are gone
+        self.gone_dirs = []
+        return
+
+    def __len__(self):
+        return len(self.new) + len(self.changed) + len(self.deleted)
+
+    def summary(self):
+        return '%d new, %d changed, %d touched, %d deleted files in %d listed directories' % \
+            (len(self.new), len(self.changed) - len(self.touched), len(self.touched),
+             len(self.deleted), len(self.dirs))
+
+    pass
+
+class Ingester(object):
+    '''
+    Add result files to an SQLite database, batch_size files per
+    transaction.  Call close() when all files are added.
+
+    A file which can not be read, or which fails ``HDUList.validate()``
+    if validate is true, is noted in the ``files`` table with its
+    error and nothing else of it is stored.
+    '''
+
+    #: Default number of files per transaction
+    batch_size = 500
+
+    #: Directories modified less than this many seconds before they
+    #: are listed are listed again by the next scan, in case files
+    #: were added within the resolution of their time stamp.
+    settle_seconds = 2.0
+
+    def __init__(self, filename, batch_size = None, validate = True):
+        self.filename = filename
+        if batch_size:
+            self.batch_size = batch_size
+        self.validate = validate
+        self.conn = sqlite3.connect(filename, isolation_level = None)
+        self.conn.text_factory = str
+        util.use_wal(self.conn)
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for sql in create:
+            self.conn.execute(sql)
+            continue
+        #: Map of schema class to its ClassTables
+        self.tables = dict()
+        #: List of (path, error) of the files added which could not be loaded
+        self.errors = []
+        self.next_file_id = self.first_file_id = self._next_id('file_id', 'files')
+        self.next_hdu_id = self._next_id('hdu_id', 'hdus')
+        self._reset_batch()
+        return
+
+    def _next_id(self, column, table):
+        return (self.conn.execute('SELECT max(%s) FROM %s' % (column, table)).fetchone()[0] or 0) + 1
+
+    def _reset_batch(self):
+        #: Map of insert statement to the list of rows to insert
+        self.pending = dict()
+        #: The paths of the files in the batch
+        self.pending_paths = set()
+        #: The ids of the files to remove before inserting the batch
+        self.pending_removals = []
+        return
+
+    def class_tables(self, klass):
+        '''
+        Return the ``ClassTables`` of the schema class, making its
+        tables if needed.
+        '''
+        tables = self.tables.get(klass)
+        if tables is not None:
+            return tables
+        tables = ClassTables(klass)
+        for sql in tables.create:
+            self.conn.execute(sql)
+            continue
+        self.tables[klass] = tables
+        return tables
+
+    def file_id(self, path):
+        'Return the id of the file at path in the database or None.'
+        row = self.conn.execute('SELECT file_id FROM files WHERE path = ?', (path,)).fetchone()
+        return row and row[0]
+
+    def _queue(self, sql, rows):
+        self.pending.setdefault(sql, []).extend(rows)
+        return
+
+    def read_file(self, path):
+        '''
+        Return a list of (schema class, ``ClassTables``, extname,
+        extver, header, data) for each HDU of the file.  The class and
+        tables are None for HDUs of no schema class and the data is
+        None for those which are not tables.
+        '''
+        hdus = base.lcatr_open(path, lazy = True)
+        try:
+            if self.validate:
+                hdus.validate()
+            ret = []
+            for hdu in hdus:
+                klass = isinstance(hdu, base.BaseHDU) and type(hdu) or None
+                tables = klass and self.class_tables(klass)
+                data = None
+                if tables and tables.row_table:
+                    data = hdu.data
+                extname = hdu.header.get('EXTNAME')
+                ret.append((klass, tables, extname and extname.lower(), hdu.header.get('EXTVER'),
+                            hdu.header, data))
+                continue
+        finally:
+            hdus.close()
+        return ret
+
+    @instrument.timed('ingest.add_file')
+    def add_file(self, path):
+        '''
+        Queue the contents of the result file for the database,
+        replacing any earlier entry for the same path.  Return True if
+        it was read, False if it is only noted with an error.
+        '''
+        path = os.path.abspath(path)
+        if path in self.pending_paths:
+            self.flush()
+        old = self.file_id(path)
+        if old is not None:
+            self.pending_removals.append(old)
+
+        file_id = self.next_file_id
+        self.next_file_id += 1
+        size = mtime = None     # unknown if the file is gone
+        error = None
+        try:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+            hdus = self.read_file(path)
+        except Exception, err:
+            error = '%s: %s' % (err.__class__.__name__, err)
+            self.errors.append((path, error))
+            hdus = []
+
+        primary = hdus and hdus[0][4] or dict()
+        self._queue('INSERT INTO files VALUES (?,?,?,?,?,?,?,?)',
+                    [(file_id, path, size, mtime,
+                      primary.get('TESTNAME'), primary.get('DATE-OBS'), error, time.time())])
+        for hdu_index, (klass, tables, extname, extver, header, data) in enumerate(hdus):
+            hdu_id = self.next_hdu_id
+            self.next_hdu_id += 1
+            self._queue('INSERT INTO hdus VALUES (?,?,?,?,?,?)',
+                        [(hdu_id, file_id, hdu_index, extname, extver,
+                          klass and klass.__name__)])
+            if not tables:
+                continue
+            if tables.card_table:
+                self._queue(tables.insert[tables.card_table], [tables.card_row(hdu_id, header)])
+            if tables.row_table and data is not None:
+                self._queue(tables.insert[tables.row_table], tables.table_rows(hdu_id, data))
+            continue
+
+        self.pending_paths.add(path)
+        if len(self.pending_paths) >= self.batch_size:
+            self.flush()
+        return error is None
+
+    def remove_file(self, path):
+        '''
+        Remove the file at path from the database in the next batch.
+        Return True if it was there.
+        '''
+        path = os.path.abspath(path)
+        if path in self.pending_paths:
+            self.flush()
+        old = self.file_id(path)
+        if old is None:
+            return False
+        self.pending_removals.append(old)
+        if len(self.pending_removals) >= self.batch_size:
+            self.flush()
+        return True
+
+    def _remove(self, file_ids):
+        ids = [(file_id,) for file_id in file_ids]
+        names = [name for name, in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%\\_v%' ESCAPE '\\'")]
+        for name in names:
+            self.conn.executemany('DELETE FROM %s WHERE hdu_id IN '
+                                  '(SELECT hdu_id FROM hdus WHERE file_id = ?)' % quote(name), ids)
+            continue
+        self.conn.executemany('DELETE FROM hdus WHERE file_id = ?', ids)
+        self.conn.executemany('DELETE FROM files WHERE file_id = ?', ids)
+        return
+
+    @instrument.timed('ingest.flush')
+    def flush(self):
+        '''
+        Write the queued files in one transaction.
+        '''
+        if not self.pending and not self.pending_removals:
+            return
+        self.conn.execute('BEGIN')
+        try:
+            if self.pending_removals:
+                self._remove(self.pending_removals)
+            for sql, rows in self.pending.items():
+                self.conn.executemany(sql, rows)
+                instrument.count('ingest.rows', len(rows))
+                continue
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        self._reset_batch()
+        return
+
+    def manifest_files(self, dirname):
+        '''
+        Return a map of path to (size, mtime, SHA1 digest) of the files
+        in the manifest in the directory.
+        '''
+        return dict((path, (size, mtime, sha1)) for path, size, mtime, sha1 in self.conn.execute(
+                'SELECT path, size, mtime, sha1 FROM manifest WHERE dirname = ?', (dirname,)))
+
+    def check_files(self, dirname, delta):
+        '''
+        Add the files of the directory in the manifest which are gone,
+        or whose size or modification time changed, to the delta.
+        '''
+        instrument.count('ingest.check_files')
+        for path, (size, mtime, sha1) in sorted(self.manifest_files(dirname).items()):
+            try:
+                fst = os.stat(path)
+            except OSError:
+                delta.deleted.append(path)
+                continue
+            if (size, mtime) != (fst.st_size, fst.st_mtime):
+                delta.changed.append((path, fst.st_size, fst.st_mtime, sha1))
+            continue
+        return
+
+    def scan(self, roots, pattern = '*.fits', full = False, trust_dirs = False):
+        '''
+        Return the ``Delta`` between the files matching pattern in the
+        directory trees under roots and the manifest.
+
+        Known directories whose modification time is unchanged are not
+        listed unless full is true.  Their files in the manifest are
+        each stat'ed instead, unless trust_dirs is true.
+        '''
+        roots = [os.path.abspath(root) for root in roots]
+        for root in roots:
+            if not os.path.isdir(root):
+                raise ValueError, 'not a directory: %s' % root
+            continue
+        known = dict(self.conn.execute('SELECT dirname, mtime FROM manifest_dirs'))
+        todo = set(roots)
+        todo.update(dirname for dirname in known
+                    if any(dirname.startswith(root + os.sep) for root in roots))
+        todo = sorted(todo, reverse = True)
+        seen = set()
+        delta = Delta()
+        now = time.time()
+        while todo:
+            dirname = todo.pop()
+            if dirname in seen:
+                continue
+            seen.add(dirname)
+            try:
+                st = os.stat(dirname)
+            except OSError:
+                if dirname in known:
+                    delta.gone_dirs.append(dirname)
+                    delta.deleted.extend(sorted(self.manifest_files(dirname)))
+                continue
+            if not full and known.get(dirname) == st.st_mtime:
+                if not trust_dirs:
+                    self.check_files(dirname, delta)
+                continue
+            instrument.count('ingest.listdir')
+
+            old = self.manifest_files(dirname)
+            for name in sorted(os.listdir(dirname)):
+                path = os.path.join(dirname, name)
+                try:
+                    fst = os.lstat(path)
+                    if stat.S_ISDIR(fst.st_mode):
+                        if path not in known:
+                            todo.append(path)
+                        continue
+                    if not fnmatch.fnmatch(name, pattern):
+                        continue
+                    if stat.S_ISLNK(fst.st_mode):
+                        fst = os.stat(path)
+                except OSError:
+                    continue        # gone since listed
+                if not stat.S_ISREG(fst.st_mode):
+                    continue
+                entry = old.pop(path, None)
+                if entry is None:
+                    delta.new.append((path, fst.st_size, fst.st_mtime))
+                elif entry[:2] != (fst.st_size, fst.st_mtime):
+                    delta.changed.append((path, fst.st_size, fst.st_mtime, entry[2]))
+                continue
+            delta.deleted.extend(sorted(old))
+            mtime = st.st_mtime
+            if now - mtime < self.settle_seconds:
+                mtime = None
+            delta.dirs.append((dirname, mtime))
+            continue
+        return delta
+
+    @instrument.timed('ingest.update')
+    def update(self, roots, pattern = '*.fits', full = False, trust_dirs = False):
+        '''
+        Bring the database up to date with the files matching pattern
+        in the directory trees under roots, see ``scan()``.  Return
+        the ``Delta`` applied.
+        '''
+        delta = self.scan(roots, pattern, full, trust_dirs)
+        record = 'INSERT OR REPLACE INTO manifest VALUES (?,?,?,?,?)'
+        for path in delta.deleted:
+            self.remove_file(path)
+            self._queue('DELETE FROM manifest WHERE path = ?', [(path,)])
+            continue
+        for path, size, mtime, sha1 in delta.changed + [entry + (None,) for entry in delta.new]:
+            digest = util.sha1_digest(path)
+            if digest is None:
+                continue            # gone since the scan, the next one sees it
+            digest = digest.hexdigest()
+            if digest == sha1:
+                delta.touched.append(path)
+            else:
+                self.add_file(path)
+            self._queue(record, [(path, os.path.dirname(path), size, mtime, digest)])
+            continue
+        # directories go in the last batch, after all their files
+        self._queue('DELETE FROM manifest_dirs WHERE dirname = ?',
+                    [(dirname,) for dirname in delta.gone_dirs])
+        self._queue('INSERT OR REPLACE INTO manifest_dirs VALUES (?,?)', delta.dirs)
+        self.flush()
+        return delta
+
+    def close(self):
+        'Write any queued files and close the database.'
+        self.flush()
+        self.conn.close()
+        return
+
+    pass
+
+def ingest(args, dbfile, pattern = '*.fits', batch_size = None, validate = True):
+    '''
+    Add the result files given by args, as for ``bulk.find_files()``,
+    to the database in dbfile.  Return the ``Ingester``.
+    '''
+    db = Ingester(dbfile, batch_size, validate)
+    for filename in bulk.find_files(args, pattern):
+        db.add_file(filename)
+        continue
+    db.close()
+    return db
+
+def report_errors(errors):
+    for path, error in errors:
+        sys.stderr.write('%s: %s\n' % (path, error))
+        continue
+    return
+
+def main(argv = None):
+    '''
+    The ``lcatr-ingest`` command.  Return the exit code: 0 if all
+    files were loaded, 1 if any could not be.
+    '''
+    parser = OptionParser(usage = 'lcatr-ingest -d database [options] file|directory|glob ...')
+    parser.add_option('-d', '--database', default=None,
+                      help='SQLite database file to load into')
+    parser.add_option('-p', '--pattern', default='*.fits',
+                      help='Pattern matching files to load in directories')
+    parser.add_option('-b', '--batch-size', type='int', default=Ingester.batch_size,
+                      help='Number of files per transaction')
+    parser.add_option('--no-validate', action='store_true', default=False,
+                      help='Load files without validating them first')
+    parser.add_option('-i', '--incremental', action='store_true', default=False,
+                      help='Only load what changed in the given directories since last time')
+    parser.add_option('-w', '--watch', type='float', default=None,
+                      help='Update incrementally every this many seconds until interrupted')
+    parser.add_option('--full', action='store_true', default=False,
+                      help='List all directories when updating incrementally')
+    parser.add_option('--trust-dirs', action='store_true', default=False,
+                      help='Skip the files of unchanged directories when updating incrementally')
+    opts, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no files given')
+    if not opts.database:
+        parser.error('no database given')
+
+    start = time.time()
+    if not opts.incremental and not opts.watch:
+        db = ingest(args, opts.database, opts.pattern, opts.batch_size, not opts.no_validate)
+        report_errors(db.errors)
+        sys.stderr.write('%d files, %d not loaded, %.1f seconds\n' %
+                         (db.next_file_id - db.first_file_id, len(db.errors), time.time() - start))
+        return db.errors and 1 or 0
+
+    db = Ingester(opts.database, opts.batch_size, not opts.no_validate)
+    try:
+        while True:
+            nerrors = len(db.errors)
+            try:
+                delta = db.update(args, opts.pattern, opts.full, opts.trust_dirs)
+            except ValueError, msg:
+                parser.error(str(msg))
+            report_errors(db.errors[nerrors:])
+            sys.stderr.write('%s, %d not loaded, %.1f seconds\n' %
+                             (delta.summary(), len(db.errors) - nerrors, time.time() - start))
+            if not opts.watch:
+                break
+            time.sleep(opts.watch)
+            start = time.time()
+            continue
+    except KeyboardInterrupt:
+        pass
+    db.close()
+    return db.errors and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+'''
+Opt-in timers and counters on the hot paths of this package.
+
+The places where time usually goes are instrumented: table rebuilds
+(``TableBaseHDU.update_self()``), file hashing (``util.sha1_file()``
+and the digest cache), file lookups (``util.full_path()``), pyfits
+``verify()`` and the conversion of plain pyfits HDUs.  Nothing is
+recorded unless instrumentation is enabled, either for a block:
+
+  >>> from lcatr.schema import instrument
+  >>> with instrument.instrumented() as stats:
+  ...     hdus = pyfits.open('results.fits')
+  ...     hdus.validate()
+  >>> print stats.to_json()
+
+or for the whole process by setting the ``LCATR_INSTRUMENT``
+environment variable.  If its value names a file the stats are
+written there on exit, in the cProfile format if it ends in ``.prof``
+(see ``Stats.dump_stats()``) and as JSON otherwise.
+
+When disabled each instrumented call costs one global flag test.
+'''
+
+import os
+import time
+import json
+import atexit
+import marshal
+import threading
+import functools
+import contextlib
+
+#: True when timers and counters record.  Use enable(), disable() or
+#: instrumented() to change it.
+enabled = False
+
+class Stats(object):
+    '''
+    The named timers and counters recorded so far.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+        return
+
+    def reset(self):
+        'Forget everything recorded.'
+        with self._lock:
+            #: Map of timer name to [calls, total seconds, max seconds]
+            self.timers = dict()
+            #: Map of counter name to its value
+            self.counters = dict()
+        return
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+                return
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+        return
+
+    def add_count(self, name, count = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+        return
+
+    def as_dict(self):
+        '''
+        Return the stats as a dictionary with ``timers``, mapping each
+        name to its ``calls``, total ``seconds`` and ``max_seconds``,
+        and ``counters``, mapping each name to its value.
+        '''
+        with self._lock:
+            timers = dict((name, dict(calls = calls, seconds = seconds, max_seconds = most))
+                          for name, (calls, seconds, most) in self.timers.items())
+            return dict(timers = timers, counters = dict(self.counters))
+
+    def to_json(self):
+        'Return the stats as a JSON string, see as_dict().'
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def dump_stats(self, filename):
+        '''
+        Write the timers to a file which ``pstats.Stats`` can load, as
+        if written by ``cProfile``.  Each timer appears as a function
+        named after it.  Counters are not included.
+        '''
+        with self._lock:
+            entries = dict((('lcatr.schema', 0, name), (calls, calls, seconds, seconds, {}))
+                           for name, (calls, seconds, most) in self.timers.items())
+        fp = open(filename, 'wb')
+        try:
+            marshal.dump(entries, fp)
+        finally:
+            fp.close()
+        return
+
+    def save(self, filename):
+        'Write the stats to the file, see the module documentation.'
+        if filename.endswith('.prof'):
+            return self.dump_stats(filename)
+        fp = open(filename, 'w')
+        fp.write(self.to_json() + '\n')
+        fp.close()
+        return
+
+    pass
+
+#: The stats recorded while enabled.
+stats = Stats()
+
+def enable(reset = False):
+    'Start recording, optionally forgetting what was recorded before.'
+    global enabled
+    if reset:
+        stats.reset()
+    enabled = True
+    return
+
+def disable():
+    'Stop recording.'
+    global enabled
+    enabled = False
+    return
+
+@contextlib.contextmanager
+def instrumented(reset = True):
+    '''
+    Record while in the block, yielding the ``Stats``.  By default what
+    was recorded before is forgotten.  Recording is left as it was
+    found on leaving the block.
+    '''
+    global enabled
+    was = enabled
+    enable(reset)
+    try:
+        yield stats
+    finally:
+        enabled = was
+    return
+
+def count(name, number = 1):
+    'Add number to the named counter if enabled.'
+    if enabled:
+        stats.add_count(name, number)
+    return
+
+@contextlib.contextmanager
+def timer(name):
+    'Time the block under the given name if enabled.'
+    if not enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.time() - start)
+    return
+
+def timed(name):
+    '''
+    Decorator timing each call of the function under the given name
+    if enabled.
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwds):
+            if not enabled:
+                return func(*args, **kwds)
+            start = time.time()
+            try:
+                return func(*args, **kwds)
+            finally:
+                stats.add_time(name, time.time() - start)
+        return wrapper
+    return decorate
+
+
+def _from_environment():
+    value = os.environ.get('LCATR_INSTRUMENT')
+    if not value:
+        return
+    enable()
+    if value not in ('1', 'yes', 'true'):
+        atexit.register(stats.save, value)
+    return
+_from_environment()
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+'''
+Upgrade HDUs written with older versions of their schema.
+
+Each change to a schema class comes with an increment of its
+``schema_version`` (the ``EXTVER`` card) and the steps which turn an
+HDU of the previous version into one of the new.  They are given in
+the class's ``schema_upgrades`` dictionary, keyed by the version they
+upgrade from:
+
+  >>> from lcatr.schema import migrate
+  >>> class PtcAmpTableHDU(pyfits.BinTableHDU):
+  ...     schema_version = 2
+  ...     required_columns = [('LinearGain', 'E', 'Linear gain'),
+  ...                         ('Offset', 'E', 'Bias offset'), ...]
+  ...     schema_upgrades = {
+  ...         0: [migrate.RenameColumn('Gain', 'LinearGain')],
+  ...         1: [migrate.AddColumn('Offset', 'E', 0.0),
+  ...             migrate.RetypeColumn('AmpNum', 'J')],
+  ...         }
+
+Steps work on whole columns as numpy arrays, never row by row.  The
+steps from any older version to the current one are worked out once
+per class and version and kept, see ``upgrade_path()``.
+
+``upgrade_hdu()`` upgrades one HDU and ``upgrade_file()`` a file,
+either in place or into a new file.  ``upgrade_archive()`` does many
+files with a pool of processes; files with nothing to upgrade are left
+alone or, when writing to a new directory, copied as they are.  This
+is also the ``lcatr-migrate`` command:
+
+  $ lcatr-migrate -o /data/results-v2 /data/results
+  $ lcatr-migrate /data/results              # in place
+
+Only the cards and columns of an HDU are carried over by an upgrade,
+the cards describing the table layout (``TTYPEn``, ``TFORMn``,
+``TUNITn`` and the like) and checksums are made anew.
+'''
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+import numpy
+import pyfits
+import base
+import bulk
+import util
+
+#: Header keywords which describe an HDU's layout rather than its
+#: contents and are not carried over by an upgrade.
+layout_keywords = re.compile(r'^(SIMPLE|BITPIX|NAXIS\d*|EXTEND|XTENSION|PCOUNT|GCOUNT|TFIELDS|'
+                             r'EXTNAME|EXTVER|CHECKSUM|DATASUM|'
+                             r'(TTYPE|TFORM|TBCOL|TDIM|TNULL|TSCAL|TZERO|TDISP|TUNIT)\d+)$')
+
+class Contents(object):
+    '''
+    The cards and columns of an HDU being upgraded.  Upgrade steps
+    change these in place.
+    '''
+
+    def __init__(self, extname, version, cards, columns, data = None):
+        self.extname = extname
+        #: The version the contents are at
+        self.version = version
+        #: List of [name, value, comment] of the cards, see layout_keywords
+        self.cards = cards
+        #: List of [name, TFORM, array] of the table columns, empty if not a table
+        self.columns = columns
+        #: The image data if not a table
+        self.data = data
+        return
+
+    @property
+    def nrows(self):
+        'The number of rows of the table.'
+        if not self.columns:
+            return 0
+        return len(self.columns[0][2])
+
+    def card_index(self, name):
+        'Return the index of the named card in ``cards`` or None.'
+        name = name.upper()
+        for index, card in enumerate(self.cards):
+            if card[0] == name:
+                return index
+            continue
+        return None
+
+    def column_index(self, name):
+        '''
+        Return the index of the named column in ``columns``.
+        ValueError is raised if there is none.
+        '''
+        lower = name.lower()
+        for index, column in enumerate(self.columns):
+            if column[0].lower() == lower:
+                return index
+            continue
+        raise ValueError, '%s version %d: no column "%s"' % (self.extname, self.version, name)
+
+    def column(self, name):
+        'Return the array of the named column.'
+        return self.columns[self.column_index(name)][2]
+
+    pass
+
+class Step(object):
+    '''
+    One change made by an upgrade.  Subclasses implement apply().
+    '''
+
+    def apply(self, contents):
+        'Change the ``Contents`` in place.'
+        raise NotImplementedError
+
+    def __repr__(self):
+        args = ', '.join('%s=%r' % item for item in sorted(self.__dict__.items()))
+        return '%s(%s)' % (self.__class__.__name__, args)
+
+    pass
+
+class RenameColumn(Step):
+    'Rename a column.'
+    def __init__(self, old, new):
+        self.old, self.new = old, new
+        return
+    def apply(self, contents):
+        contents.columns[contents.column_index(self.old)][0] = self.new
+        return
+    pass
+
+class AddColumn(Step):
+    '''
+    Add a column of the given TFORM.  Its value is either one value
+    for all rows or a function of the ``Contents`` returning the
+    column's array.
+    '''
+    def __init__(self, name, tform, value = 0):
+        self.name, self.tform, self.value = name, tform, value
+        return
+    def apply(self, contents):
+        dtype = util.tform_dtype(self.tform)
+        if dtype is None:
+            raise ValueError, 'column "%s" of format "%s" has no numpy type' % (self.name, self.tform)
+        if callable(self.value):
+            array = numpy.asarray(self.value(contents), dtype = dtype.base)
+        else:
+            array = numpy.empty((contents.nrows,) + dtype.shape, dtype = dtype.base)
+            array[...] = self.value
+        contents.columns.append([self.name, self.tform, array])
+        return
+    pass
+
+class DropColumn(Step):
+    'Remove a column.'
+    def __init__(self, name):
+        self.name = name
+        return
+    def apply(self, contents):
+        del contents.columns[contents.column_index(self.name)]
+        return
+    pass
+
+class RetypeColumn(Step):
+    '''
+    Change a column to the given TFORM.  If given, convert is called
+    with the column's array and returns the new one, otherwise the
+    array is cast to the new type.
+    '''
+    def __init__(self, name, tform, convert = None):
+        self.name, self.tform, self.convert = name, tform, convert
+        return
+    def apply(self, contents):
+        column = contents.columns[contents.column_index(self.name)]
+        dtype = util.tform_dtype(self.tform)
+        array = column[2]
+        if self.convert:
+            array = self.convert(array)
+        if dtype is not None:
+            array = numpy.asarray(array).astype(dtype.base)
+        column[1:] = [self.tform, array]
+        return
+    pass
+
+class RenameCard(Step):
+    'Rename a card.'
+    def __init__(self, old, new):
+        self.old, self.new = old, new
+        return
+    def apply(self, contents):
+        index = contents.card_index(self.old)
+        if index is None:
+            raise ValueError, '%s version %d: no card "%s"' % \
+                (contents.extname, contents.version, self.old)
+        contents.cards[index][0] = self.new.upper()
+        return
+    pass
+
+class AddCard(Step):
+    '''
+    Add a card, or set it if already there.  The value may be a
+    function of the ``Contents``.
+    '''
+    def __init__(self, name, value, comment = ''):
+        self.name, self.value, self.comment = name, value, comment
+        return
+    def apply(self, contents):
+        value = self.value
+        if callable(value):
+            value = value(contents)
+        index = contents.card_index(self.name)
+        if index is None:
+            contents.cards.append([self.name.upper(), value, self.comment])
+        else:
+            contents.cards[index][1] = value
+        return
+    pass
+
+class DropCard(Step):
+    'Remove a card if it is there.'
+    def __init__(self, name):
+        self.name = name
+        return
+    def apply(self, contents):
+        index = contents.card_index(self.name)
+        if index is not None:
+            del contents.cards[index]
+        return
+    pass
+
+class RetypeCard(Step):
+    'Replace a card value by what convert returns for it.'
+    def __init__(self, name, convert):
+        self.name, self.convert = name, convert
+        return
+    def apply(self, contents):
+        index = contents.card_index(self.name)
+        if index is not None:
+            contents.cards[index][1] = self.convert(contents.cards[index][1])
+        return
+    pass
+
+class UpgradePath(object):
+    '''
+    The steps upgrading one version of a schema to its current class.
+    '''
+
+    def __init__(self, klass, version, steps):
+        #: The schema class upgraded to
+        self.klass = klass
+        #: The version upgraded from
+        self.version = version
+        #: The list of (version, step) in the order they apply
+        self.steps = steps
+        return
+
+    def apply(self, contents):
+        'Upgrade the ``Contents`` in place.'
+        for version, step in self.steps:
+            contents.version = version
+            step.apply(contents)
+            continue
+        contents.version = self.klass.schema_version
+        return
+
+    pass
+
+def upgrade_steps(name, version):
+    '''
+    Return the list of steps upgrading the given version of the named
+    schema to the next or None if there are none.  They are taken from
+    the ``schema_upgrades`` of the registered classes of that name and
+    of a higher version.
+    '''
+    name = name.lower()
+    for (extname, extver), klass in base.registered_schema():
+        if extname != name or extver <= version:
+            continue
+        steps = (klass.schema_upgrades or dict()).get(version)
+        if steps is not None:
+            return steps
+        continue
+    return None
+
+# Map of (schema class, version) to UpgradePath
+_paths = dict()
+
+def upgrade_path(name, version):
+    '''
+    Return the ``UpgradePath`` from the given version of the named
+    schema to its current class.  ValueError is raised if there is no
+    such class or a step along the way is missing.
+    '''
+    klass = base.find_schema(name)
+    if klass is None:
+        raise ValueError, 'No known class for HDU "%s"' % name
+    version = int(version)
+    path = _paths.get((klass, version))
+    if path is not None:
+        return path
+    if version > klass.schema_version:
+        raise ValueError, '%s: version %d is newer than the known %d' % \
+            (klass.__name__, version, klass.schema_version)
+    steps = []
+    for ver in range(version, klass.schema_version):
+        more = upgrade_steps(name, ver)
+        if more is None:
+            raise ValueError, '%s: no upgrade from version %d to %d' % (klass.__name__, ver, ver+1)
+        steps.extend((ver, step) for step in more)
+        continue
+    path = _paths[(klass, version)] = UpgradePath(klass, version, steps)
+    return path
+
+def needs_upgrade(hdu):
+    '''
+    Return True if the HDU is of a known schema at an older version.
+    '''
+    extname = hdu.header.get('EXTNAME')
+    if not extname:
+        return False
+    klass = base.find_schema(extname)
+    return klass is not None and (hdu.header.get('EXTVER') or 0) < klass.schema_version
+
+def read_contents(hdu):
+    '''
+    Return the ``Contents`` of an HDU.  Table columns are the arrays
+    of its data, which for a file opened with memory mapping are not
+    read until used.
+    '''
+    header = hdu.header
+    cards = [[card.key, card.value, card.comment] for card in header.ascard
+             if not layout_keywords.match(card.key)]
+    columns = []
+    data = None
+    if header.get('XTENSION') in ('TABLE', 'BINTABLE'):
+        for col in hdu.columns:
+            if hdu.data is None:
+                dtype = util.tform_dtype(col.format)
+                array = numpy.empty((0,) + dtype.shape, dtype = dtype.base)
+            else:
+                array = hdu.data.field(col.name)
+            columns.append([col.name, col.format, array])
+            continue
+    else:
+        data = hdu.data
+    return Contents(header.get('EXTNAME'), header.get('EXTVER') or 0, cards, columns, data)
+
+def build_hdu(klass, contents):
+    '''
+    Return a new HDU of the schema class holding the contents.
+    Required columns take the class's TFORM.
+    '''
+    if issubclass(klass, base.TableBaseHDU):
+        formats = dict((name.lower(), typestr) for name, typestr, comment, kwname
+                       in klass.schema_plan().columns)
+        cols = []
+        for name, tform, array in contents.columns:
+            tform = formats.get(name.lower(), tform)
+            dtype = util.tform_dtype(tform)
+            if dtype is not None:
+                array = numpy.asarray(array, dtype = dtype.base)
+            cols.append(pyfits.Column(name = name, format = tform, array = array))
+            continue
+        kind = issubclass(klass, base.TableHDU) and 'TableHDU' or 'BinTableHDU'
+        hdu = klass()
+        hdu.update_self(pyfits.new_table(pyfits.ColDefs(cols), tbtype = kind))
+    else:
+        hdu = klass(data = contents.data)
+    hdu.initialize_cards()
+    add_cards(hdu.header, contents.cards)
+    return hdu
+
+def add_cards(header, cards):
+    '''
+    Set the given (name, value, comment) cards in the header.
+    ``COMMENT`` and ``HISTORY`` cards are added to those already there.
+    '''
+    for name, value, comment in cards:
+        if name == 'COMMENT':
+            header.add_comment(value)
+        elif name == 'HISTORY':
+            header.add_history(value)
+        elif name:
+            header.update(name, value, comment)
+        continue
+    return
+
+def upgrade_hdu(hdu):
+    '''
+    Return the HDU upgraded to the current version of its schema
+    class, or the HDU itself if it needs no upgrade.  ValueError is
+    raised if it can not be upgraded or does not meet its schema's
+    header requirements once upgraded.
+    '''
+    if not needs_upgrade(hdu):
+        return hdu
+    contents = read_contents(hdu)
+    path = upgrade_path(contents.extname, contents.version)
+    path.apply(contents)
+    new = build_hdu(path.klass, contents)
+    new.header.add_history('Upgraded from EXTVER %d to %d' % (path.version, path.klass.schema_version))
+    path.klass.validate_header(new.header)
+    return new
+
+def upgrade_file(src, dst = None):
+    '''
+    Upgrade the HDUs of the file src which need it, writing the file
+    to dst or, if not given, replacing src.  Return True if any HDU
+    was upgraded.
+
+    If nothing needs upgrading src is copied to dst, if given and not
+    src, and is otherwise left alone.  The new file is written next
+    to its destination and renamed into place so that a failed
+    upgrade leaves no partial file.
+    '''
+    dst = dst or src
+    dirname = os.path.dirname(os.path.abspath(dst))
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname): # made by another worker
+                raise
+
+    hdus = base.pyfitsopen(src, memmap = base.can_memmap(src))
+    try:
+        outdated = [needs_upgrade(hdu) for hdu in hdus]
+        if not any(outdated):
+            hdus.close()
+            if os.path.abspath(src) != os.path.abspath(dst):
+                shutil.copyfile(src, dst)
+            return False
+        out = pyfits.HDUList()
+        for hdu, old in zip(hdus, outdated):
+            if old:
+                hdu = upgrade_hdu(hdu)
+            out.append(hdu)
+            continue
+        fd, tmp = tempfile.mkstemp(suffix = '.fits', prefix = '.upgrade-', dir = dirname)
+        os.close(fd)
+        try:
+            out.writeto(tmp, clobber = True)
+            shutil.copymode(src, tmp)
+        except:
+            os.remove(tmp)
+            raise
+    finally:
+        hdus.close()
+    os.rename(tmp, dst)
+    return True
+
+def archive_files(args, outdir = None, pattern = '*.fits'):
+    '''
+    Generate (file, destination) for the files given by args, as for
+    ``bulk.find_files()``.  The destination is None without an outdir,
+    otherwise it is the file's path relative to the directory
+    argument it was found in, or its base name, under outdir.
+    '''
+    for arg in args:
+        for filename in bulk.find_files([arg], pattern):
+            dst = None
+            if outdir and os.path.isdir(arg):
+                dst = os.path.join(outdir, os.path.relpath(filename, arg))
+            elif outdir:
+                dst = os.path.join(outdir, os.path.basename(filename))
+            yield filename, dst
+            continue
+        continue
+    return
+
+def upgrade_report(src, dst = None):
+    '''
+    Upgrade one file as for ``upgrade_file()`` and return its report
+    as a dictionary.
+    '''
+    start = time.time()
+    report = dict(file = src, output = dst or src, upgraded = False, error = None)
+    try:
+        report['size'] = os.stat(src).st_size
+        report['upgraded'] = upgrade_file(src, dst)
+    except Exception, err:
+        report['error'] = '%s: %s' % (err.__class__.__name__, err)
+    report['seconds'] = time.time() - start
+    return report
+
+# Pool workers take a single argument.
+def _upgrade_args(args):
+    return upgrade_report(*args)
+
+def upgrade_archive(args, outdir = None, pattern = '*.fits', workers = None):
+    '''
+    Generate an ``upgrade_report()`` for each of the files given by
+    args, in the order they finish, see ``archive_files()``.  The
+    files are upgraded in place unless outdir is given.
+
+    Up to workers processes are used, see util.process_map().
+    '''
+    return util.process_map(_upgrade_args, archive_files(args, outdir, pattern), workers)
+
+def main(argv = None):
+    '''
+    The ``lcatr-migrate`` command.  Return the exit code: 0 if all
+    files were upgraded or needed no upgrade, 1 otherwise.
+    '''
+    parser = OptionParser(usage = 'lcatr-migrate [-o outdir] [options] file|directory|glob ...')
+    parser.add_option('-o', '--output', default=None,
+                      help='Directory to write the files to, default is to upgrade in place')
+    parser.add_option('-j', '--workers', type='int', default=None,
+                      help='Number of worker processes, default is one per CPU')
+    parser.add_option('-p', '--pattern', default='*.fits',
+                      help='Pattern matching files to upgrade in directories')
+    opts, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no files given')
+
+    start = time.time()
+    nfiles = nbytes = upgraded = 0
+    bad = []
+    for report in upgrade_archive(args, opts.output, opts.pattern, opts.workers):
+        nfiles += 1
+        nbytes += report.get('size', 0)
+        upgraded += report['upgraded']
+        if report['error']:
+            bad.append(report)
+            sys.stderr.write('%(file)s: %(error)s\n' % report)
+        continue
+    seconds = max(time.time() - start, 1e-9)
+    sys.stderr.write('%d files, %d upgraded, %d failed, %.2f s, %.1f MB/s\n' %
+                     (nfiles, upgraded, len(bad), seconds, nbytes/seconds/(1<<20)))
+    if bad:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -46,10 +46,10 @@ class PtcAmpTableHDU(pyfits.BinTableHDU):
 
     #: One column for each per-amplifier measurement
     required_columns = [
-        ('LinearGain','E','Linear gain measuremnt'),
-        ('MedianGain','E','Gain from median method'),
-        ('OverScanNoise','E','Noise from overscan method'),
-        ('StdDevNoise','E','Noise from standard deviation'),
+        ('LinearGain','E','Linear gain measuremnt', dict(gt=0, finite=True)),
+        ('MedianGain','E','Gain from median method', dict(gt=0, finite=True)),
+        ('OverScanNoise','E','Noise from overscan method', dict(gt=0, finite=True)),
+        ('StdDevNoise','E','Noise from standard deviation', dict(gt=0, finite=True)),
         ('FullWell','E','Point at which the gain curve blows up'),
         ('LinearRangeMin','E','Min where response is in linear range'),
         ('LinearRangeMAx','E','Max where response is in linear range'),
@@ -70,9 +70,9 @@ class PtcColdSpotTableHDU(pyfits.BinTableHDU):
     #: One column for each per-cold-spot measurement
     required_columns = [
         ('AmpNum','I','Amplifier number, 1-based'),
-        ('PixCount','I','Number of cold pixels'),
-        ('SpotX','I', 'The X-pixel nearest to the spot center'),
-        ('SpotY','I', 'The Y-pixel nearest to the spot center'),
+        ('PixCount','I','Number of cold pixels', dict(min=0)),
+        ('SpotX','I', 'The X-pixel nearest to the spot center', dict(min=0)),
+        ('SpotY','I', 'The Y-pixel nearest to the spot center', dict(min=0)),
         ]
     pass
 
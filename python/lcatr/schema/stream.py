@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+'''
+Write result files whose tables do not fit in memory.
+
+A ``StreamWriter`` writes a file one HDU at a time.  HDUs held in
+memory, such as the primary, are written whole.  Binary tables are
+written from chunks of rows as they are made, each a numpy structured
+array or a dictionary of column arrays, so that memory use depends on
+the size of a chunk and not of the table:
+
+  >>> from lcatr.schema import stream
+  >>> with stream.StreamWriter('defects.fits') as out:
+  ...     out.write_hdu(limsmeta.LimsMetaPrimaryHDU(testname='Dark', ...))
+  ...     with out.table(ptc.PtcColdSpotTableHDU) as table:
+  ...         for spots in find_spots():
+  ...             table.write(spots)
+  ...     out.write_table(ptc.PtcColdSpotTableHDU, chunk_generator())
+
+Each HDU's header is checked against its schema class before anything
+of it is written (see ``BaseHDU.validate_header()``), as is each chunk
+against the ``required_columns`` and their constraints, a chunk with
+offending rows being refused whole.  A ``monotonic`` column is checked
+across chunks.  A table with a ``unique`` column can not be streamed
+as that would need every row at hand.  A table's ``NAXIS2`` and the
+``CHECKSUM`` and ``DATASUM`` cards of every HDU are filled in once its
+data is written.  The file is written under a temporary name and only
+renamed into place when the writer is closed without error.
+'''
+
+import os
+import tempfile
+
+import numpy
+import base
+import util
+import headers
+import migrate
+
+def ones_complement_fold(total):
+    'Fold a sum into 32 bits with end around carry.'
+    while total >> 32:
+        total = (total & 0xffffffff) + (total >> 32)
+    return total
+
+class OnesSum(object):
+    '''
+    Running 32 bit ones' complement sum of a byte stream, as used by
+    the FITS ``CHECKSUM`` and ``DATASUM`` cards.
+    '''
+
+    def __init__(self):
+        self.total = 0
+        self.tail = ''          # bytes short of a whole word
+        return
+
+    def add(self, data):
+        'Add the bytes of a string to the sum.'
+        if self.tail:
+            need = 4 - len(self.tail)
+            head, data = self.tail + data[:need], data[need:]
+            self.tail = ''
+            if len(head) < 4:
+                self.tail = head
+                return
+            self.total += int(numpy.frombuffer(head, '>u4')[0])
+        whole = len(data) // 4
+        if whole:
+            self.total += int(numpy.frombuffer(data, '>u4', whole).sum(dtype = numpy.uint64))
+        self.tail = data[whole*4:]
+        return
+
+    def value(self):
+        'Return the folded sum, as if the stream were padded with zeros to whole words.'
+        total = self.total
+        if self.tail:
+            total += int(numpy.frombuffer(self.tail.ljust(4, '\0'), '>u4')[0])
+        return ones_complement_fold(total)
+
+    pass
+
+# Characters the checksum encoding avoids, see encode_checksum().
+_checksum_exclude = set(range(0x3a, 0x41) + range(0x5b, 0x61))
+
+def encode_checksum(value):
+    '''
+    Return the 16 character ASCII encoding of the ones' complement of
+    a 32 bit checksum, as stored in the ``CHECKSUM`` card.
+    '''
+    value = ~value & 0xffffffff
+    asc = [0] * 16
+    for index in range(4):
+        byte = (value >> ((3 - index) * 8)) & 0xff
+        quotient, remainder = byte // 4 + ord('0'), byte % 4
+        chars = [quotient + remainder, quotient, quotient, quotient]
+        check = True
+        while check:
+            check = False
+            for pair in [0, 2]:
+                if chars[pair] in _checksum_exclude or chars[pair+1] in _checksum_exclude:
+                    chars[pair] += 1
+                    chars[pair+1] -= 1
+                    check = True
+                continue
+            continue
+        for count in range(4):
+            asc[4*count + index] = chars[count]
+            continue
+        continue
+    text = ''.join(chr(c) for c in asc)
+    return text[-1] + text[:-1]
+
+def header_string(header):
+    'Return the header as the blocks written to file.'
+    text = repr(header.ascard) + 'END'.ljust(headers.CARD_SIZE)
+    return text.ljust(headers.padded_size(len(text)))
+
+def raw_dtype(klass):
+    '''
+    Return the big endian numpy dtype of a row of the binary table
+    schema class as stored in the file.  Logical columns are stored as
+    ``T`` or ``F`` characters.
+    '''
+    want = klass.records_dtype()
+    if want is None:
+        raise ValueError, '%s: no required columns' % klass.__name__
+    fields = []
+    for name in want.names:
+        dtype = want[name]
+        if dtype.base.kind == 'b':
+            dtype = numpy.dtype(('i1', dtype.shape))
+        fields.append((name, dtype.newbyteorder('>')))
+        continue
+    return numpy.dtype(fields)
+
+class HDUStream(object):
+    '''
+    Write one HDU to an open file, keeping the data checksum as it
+    goes, and fill in its final cards at the end.
+    '''
+
+    def __init__(self, fp, header):
+        self.fp = fp
+        self.header = header
+        header.update('CHECKSUM', '0' * 16, 'HDU checksum')
+        header.update('DATASUM', '0', 'data unit checksum')
+        self.offset = fp.tell()
+        self.header_size = len(header_string(header))
+        fp.write(' ' * self.header_size) # written for real by finish()
+        self.datasum = OnesSum()
+        self.size = 0
+        return
+
+    def write_data(self, data):
+        'Write a string of data.'
+        self.datasum.add(data)
+        self.fp.write(data)
+        self.size += len(data)
+        return
+
+    def finish(self, **cards):
+        '''
+        Pad the data, set the given cards and the checksums in the
+        header and write it in its place.
+        '''
+        self.fp.write('\0' * (headers.padded_size(self.size) - self.size))
+        for name, value in cards.items():
+            self.header[name] = value
+            continue
+        datasum = self.datasum.value()
+        self.header['DATASUM'] = str(datasum)
+        self.header['CHECKSUM'] = '0' * 16
+        text = header_string(self.header)
+        hsum = OnesSum()
+        hsum.add(text)
+        self.header['CHECKSUM'] = encode_checksum(ones_complement_fold(hsum.value() + datasum))
+        text = header_string(self.header)
+        if len(text) != self.header_size:
+            raise ValueError, 'header of %s changed size' % self.header.get('EXTNAME')
+        end = self.fp.tell()
+        self.fp.seek(self.offset)
+        self.fp.write(text)
+        self.fp.seek(end)
+        return
+
+    pass
+
+class TableStream(object):
+    '''
+    Write a binary table of a schema class from chunks of rows.  Get
+    one from ``StreamWriter.table()`` and call write() for each chunk
+    and then close(), or use it as a context manager.
+    '''
+
+    def __init__(self, writer, klass, header = None, **kwds):
+        if not issubclass(klass, base.BinTableHDU):
+            raise ValueError, '%s: only binary tables can be streamed' % klass.__name__
+        self.klass = klass
+        self.want = klass.records_dtype()
+        self.raw = raw_dtype(klass)
+        self.rows = 0
+        self.constraints = klass.schema_plan().constraints
+        for name, constraints in self.constraints:
+            if constraints.get('unique'):
+                raise ValueError, '%s: column "%s": unique can not be checked when streaming' % \
+                    (klass.__name__, name)
+            continue
+        #: The last value of each monotonic column written so far
+        self.last = dict()
+
+        hdu = klass(**kwds)
+        hdu.sync()
+        head = hdu.header
+        if header is not None:
+            given = set(name for name, comment, kwname in klass.schema_plan().cards
+                        if kwds.get(kwname) is not None)
+            migrate.add_cards(head, [(card.key, card.value, card.comment) for card in header.ascard
+                                     if not migrate.layout_keywords.match(card.key) and
+                                     card.key not in given])
+        if head['NAXIS1'] != self.raw.itemsize:
+            raise ValueError, '%s: row of %d bytes, expected %d' % \
+                (klass.__name__, self.raw.itemsize, head['NAXIS1'])
+        # the rows are checked as they come, and their number at close()
+        head['NAXIS2'] = 1
+        klass.validate_header(head)
+        head['NAXIS2'] = 0
+        self.stream = HDUStream(writer.fp, head)
+        self.writer = writer
+        return
+
+    def records(self, rows):
+        '''
+        Return the chunk of rows, a structured array or a dictionary
+        of column arrays, as an array with the columns of the schema.
+        '''
+        if isinstance(rows, dict) or \
+                not base.same_record_layout(numpy.asanyarray(rows).dtype, self.want):
+            rows = self.klass._copy_records(self.want, rows)
+        return numpy.asarray(rows)
+
+    def check(self, rows):
+        '''
+        Raise ValueError listing every row of the chunk, numbered
+        within the table, which breaks the column constraints.
+        '''
+        violations = []
+        for name, constraints in self.constraints:
+            column = rows[rows.dtype.names[self.want.names.index(name)]]
+            first = self.rows
+            if name in self.last:
+                # the previous row takes part in a monotonic check
+                column = numpy.concatenate([self.last[name], column])
+                first -= 1
+            for what, bad in base.column_violations(column, constraints):
+                violations.append((name, what, bad + first))
+                continue
+            continue
+        if violations:
+            raise ValueError, 'TableHDU "%s": column constraints not met: %s' % \
+                (self.klass.__name__, base.violations_text(violations))
+        for name, constraints in self.constraints:
+            if constraints.get('monotonic') and len(rows):
+                self.last[name] = rows[rows.dtype.names[self.want.names.index(name)]][-1:].copy()
+            continue
+        return
+
+    def convert(self, rows):
+        '''
+        Return the chunk of rows, a structured array or a dictionary
+        of column arrays, as an array of the file's row type.
+        '''
+        rows = self.records(rows)
+        out = numpy.empty(len(rows), dtype = self.raw)
+        for index, name in enumerate(self.raw.names):
+            column = rows[rows.dtype.names[index]]
+            kind = self.want[index].base.kind
+            if kind == 'b':
+                column = numpy.where(column, ord('T'), ord('F'))
+            out[name] = column
+            continue
+        return out
+
+    def write(self, rows):
+        '''
+        Write a chunk of rows.  ValueError is raised, and nothing
+        written, if any row breaks the column constraints.
+        '''
+        if self.stream is None:
+            raise ValueError, '%s: table already closed' % self.klass.__name__
+        rows = self.records(rows)
+        self.check(rows)
+        out = self.convert(rows)
+        self.stream.write_data(out.tostring())
+        self.rows += len(out)
+        return
+
+    def close(self):
+        '''
+        Finish the table.  ValueError is raised if it has no rows and
+        its schema class does not allow that.
+        '''
+        if self.stream is None:
+            return
+        if not self.rows and not self.klass.allow_empty:
+            raise ValueError,'TableHDU "%s": no table data' % self.klass.__name__
+        self.stream.finish(NAXIS2 = self.rows)
+        self.stream = None
+        self.writer.current = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        return False
+
+    pass
+
+class StreamWriter(object):
+    '''
+    Write a result file one HDU at a time, see the module
+    documentation.  The first HDU written must be the primary.
+    '''
+
+    def __init__(self, filename, clobber = False):
+        if os.path.exists(filename) and not clobber:
+            raise IOError, 'File "%s" already exists.' % filename
+        self.filename = filename
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, self.tmpname = tempfile.mkstemp(suffix = '.fits', prefix = '.stream-', dir = dirname)
+        self.fp = os.fdopen(fd, 'wb')
+        self.nhdus = 0
+        #: The table being written, if any
+        self.current = None
+        return
+
+    def _check_next(self, primary):
+        if self.fp is None:
+            raise ValueError, 'writer for "%s" is closed' % self.filename
+        if self.current is not None:
+            raise ValueError, 'table %s not closed' % self.current.klass.__name__
+        if primary != (self.nhdus == 0):
+            raise ValueError, 'the primary HDU must come first and only first'
+        return
+
+    def write_hdu(self, hdu):
+        '''
+        Write an HDU held in memory.  Tables are written as by
+        write_table() with the whole table as one chunk.
+        '''
+        if isinstance(hdu, base.TableBaseHDU):
+            data = hdu.data
+            columns = dict((name, data.field(name)) for name in hdu.records_dtype().names)
+            return self.write_table(type(hdu), [columns], hdu.header)
+        self._check_next(isinstance(hdu, base.pyfitsPrimaryHDU))
+        header = hdu.header.copy()
+        if isinstance(hdu, base.BaseHDU):
+            hdu.validate_header(header)
+        stream = HDUStream(self.fp, header)
+        self.nhdus += 1
+        if hdu.data is not None:
+            data = numpy.asarray(hdu.data)
+            stream.write_data(data.astype(data.dtype.newbyteorder('>')).tostring())
+        stream.finish()
+        return
+
+    def table(self, klass, header = None, **kwds):
+        '''
+        Start a binary table of the schema class and return its
+        ``TableStream``.  Keyword arguments give values of required
+        cards as for the class's constructor.  The cards of header, if
+        given, are copied except for those describing the table layout
+        and those given as keyword arguments.
+        '''
+        self._check_next(False)
+        self.current = TableStream(self, klass, header, **kwds)
+        self.nhdus += 1
+        return self.current
+
+    def write_table(self, klass, chunks, header = None, **kwds):
+        '''
+        Write a binary table of the schema class from an iterable of
+        chunks of rows.  Return the number of rows.
+        '''
+        table = self.table(klass, header, **kwds)
+        for rows in chunks:
+            table.write(rows)
+            continue
+        table.close()
+        return table.rows
+
+    def close(self):
+        'Finish the file and move it into place.'
+        if self.fp is None:
+            return
+        if self.current is not None:
+            self.current.close()
+        if not self.nhdus:
+            raise ValueError, 'no HDUs written to "%s"' % self.filename
+        self.fp.close()
+        self.fp = None
+        os.chmod(self.tmpname, util.new_file_mode())
+        os.rename(self.tmpname, self.filename)
+        return
+
+    def abort(self):
+        'Give up on the file, removing what was written.'
+        if self.fp is None:
+            return
+        self.fp.close()
+        self.fp = None
+        os.remove(self.tmpname)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    pass
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
 import os
+import re
+import errno
+import time
 import datetime
 import hashlib
+import instrument
 
 def wash_datetime(dt):
     '''
@@ -26,6 +30,175 @@ def keywordify(cardname):
     '''
     return cardname.replace('-','_').lower()
 
+def tform_key(tform, ascii = False):
+    '''
+    Return a canonical, comparable form of a TFORM column format.
+
+    For binary tables this is a (repeat, type) tuple so that, eg,
+    ``A64`` and ``64A`` compare equal.  For ASCII tables (ascii is
+    True) the width is set by the writer so only the type is kept.
+    '''
+    tform = tform.strip().upper()
+    match = re.match(r'^(\d*)([A-Z])(.*)$', tform)
+    if not match:
+        return tform
+    repeat, code, rest = match.groups()
+    if ascii:
+        return code
+    if not repeat and rest.isdigit():
+        repeat = rest           # pyfits accepts Aw as wA
+    return (int(repeat or 1), code)
+
+#: Map of binary table TFORM type codes to numpy type strings
+tform_numpy_types = dict(L='b1', B='u1', I='i2', J='i4', K='i8',
+                         E='f4', D='f8', C='c8', M='c16')
+
+def tform_dtype(tform):
+    '''
+    Return the numpy dtype matching a binary table TFORM column format
+    or None if it has no simple equivalent (eg, bit or variable length
+    arrays).
+    '''
+    import numpy
+    key = tform_key(tform)
+    if not isinstance(key, tuple):
+        return None
+    repeat, code = key
+    if code == 'A':
+        return numpy.dtype('S%d' % repeat)
+    typestr = tform_numpy_types.get(code)
+    if typestr is None:
+        return None
+    if repeat == 1:
+        return numpy.dtype(typestr)
+    return numpy.dtype((typestr, repeat))
+
+class PathResolver(object):
+    '''
+    Locate files along a search path using cached directory listings.
+
+    Instead of checking for each candidate file, the listing of each
+    directory searched is read once and kept.  A listing is reused
+    for as long as its directory's modification time is unchanged.
+    Directory modification times are checked at most once per call to
+    ``resolve_all()`` and, across calls, only once every ``ttl``
+    seconds.  With the default ttl of 0 they are checked on every
+    call.
+
+    A file is found if its name is listed, without a stat of its own.
+    A dangling symbolic link is therefore found, and only fails when
+    the file is opened or stat'ed, as by sha1_digest().
+
+    If paths is None the search path is taken from the environment
+    as described in full_path().
+    '''
+
+    def __init__(self, paths = None, ttl = 0):
+        self.paths = paths
+        self.ttl = ttl
+        self.invalidate()
+        return
+
+    def invalidate(self):
+        '''
+        Forget all cached directory listings.
+        '''
+        #: Map of directory to (mtime, time last checked, set of names)
+        self.listings = dict()
+        return
+
+    def search_paths(self):
+        '''
+        Return the list of directories to search for relative paths.
+        '''
+        if self.paths is not None:
+            return list(self.paths)
+        paths = ['.']
+        root = os.environ.get('CCDTEST_ROOT')
+        if root:
+            paths.append(root)
+        paths += [p for p in os.environ.get('CCDTEST_PATH','').split(':') if p]
+        return paths
+
+    def listing(self, dirname, checked = None):
+        '''
+        Return the set of names in the given directory or None if it
+        can not be listed.
+
+        If checked is given it is a set of directories already known
+        to be current and dirname is added to it.
+
+        Listings are kept by absolute path so changing the current
+        directory does not return the listing of another.
+        '''
+        dirname = os.path.abspath(dirname)
+        now = time.time()
+        entry = self.listings.get(dirname)
+        if entry and (now - entry[1] < self.ttl or 
+                      (checked is not None and dirname in checked)):
+            return entry[2]
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:
+            self.listings.pop(dirname, None)
+            return None
+        # a listing made within a second of the last change may have
+        # missed a later change in the same mtime tick so is not trusted
+        if entry and entry[0] == mtime and entry[1] > mtime + 1:
+            names = entry[2]
+        else:
+            instrument.count('path.listdir')
+            try:
+                names = set(os.listdir(dirname))
+            except OSError:
+                return None
+        self.listings[dirname] = (mtime, now, names)
+        if checked is not None:
+            checked.add(dirname)
+        return names
+
+    def _exists(self, path, checked):
+        dirname, name = os.path.split(path)
+        names = self.listing(dirname or '.', checked)
+        return names is not None and name in names
+
+    @instrument.timed('full_path')
+    def resolve_all(self, filenames):
+        '''
+        Return a list of the full path to each of the given filenames
+        or None for those not found.
+        '''
+        instrument.count('full_path.files', len(filenames))
+        paths = self.search_paths()
+        checked = set()
+        ret = []
+        for filename in filenames:
+            found = None
+            if filename[0] == '/':
+                if self._exists(filename, checked):
+                    found = filename
+            else:
+                for dir in paths:
+                    check = os.path.join(dir,filename)
+                    if self._exists(check, checked):
+                        found = check
+                        break
+                    continue
+            ret.append(found)
+            continue
+        return ret
+
+    def resolve(self, filename):
+        '''
+        Return the full path to the given filename or None.
+        '''
+        return self.resolve_all([filename])[0]
+
+    pass
+
+#: The PathResolver used by full_path() and full_paths().
+path_resolver = PathResolver()
+
 def full_path(filename):
     '''
     Return the full path to a given filename or None if it is not found.
@@ -34,32 +207,192 @@ def full_path(filename):
     under a directory pointed to by a CCDTEST_ROOT environment
     variable (if defined) and finally by all directories listed in a
     $CCDTEST_PATH environment variable (if defined).
+
+    See ``PathResolver`` for how lookups are cached.
     '''
-    if filename[0] == '/':
-        if os.path.exists(filename): return filename
-        return None
+    return path_resolver.resolve(filename)
 
-    paths = ['.'] \
-        + os.environ.get('CCDTEST_ROOT',[]) \
-        + os.environ.get('CCDTEST_PATH','').split(':')
+def full_paths(filenames):
+    '''
+    Return a list of full_path() results for the given filenames
+    found in one pass over the search path.
+    '''
+    return path_resolver.resolve_all(filenames)
 
-    for dir in paths:
-        check = os.path.join(dir,filename)
-        if os.path.exists(check): return check
-        continue
-    return None
+#: Default number of bytes read at a time when taking a digest.
+digest_buffer_size = 1<<20
+
+@instrument.timed('sha1_file')
+def sha1_file(path, bufsize = None):
+    '''
+    Return a hashlib.sha1() object for the contents of the file at
+    the given path.
+
+    The file is read in chunks of bufsize bytes (default is
+    ``digest_buffer_size``) so memory use does not depend on the
+    size of the file.
+    '''
+    bufsize = bufsize or digest_buffer_size
+    digest = hashlib.sha1()
+    nbytes = 0
+    fp = open(path, 'rb')
+    try:
+        while True:
+            chunk = fp.read(bufsize)
+            if not chunk: break
+            digest.update(chunk)
+            nbytes += len(chunk)
+            continue
+    finally:
+        fp.close()
+    instrument.count('sha1_file.bytes', nbytes)
+    return digest
+
+#: The cache.DigestCache consulted by sha1_digest(), if any.  Set it
+#: with use_digest_cache() or the LCATR_DIGEST_CACHE environment
+#: variable.
+digest_cache = None
+
+def use_digest_cache(filename, max_entries = None):
+    '''
+    Make sha1_digest() use a persistent digest cache kept in the given
+    SQLite database file.  A filename of None turns caching off.
+
+    See ``cache.DigestCache``.
+    '''
+    global digest_cache
+    if filename is None:
+        digest_cache = None
+        return
+    import cache
+    digest_cache = cache.DigestCache(filename, max_entries)
+    return
 
-def sha1_digest(filename):
+def sha1_digest(filename, bufsize = None):
     '''
     Return a hashlib.sha1() object for the contents of the given file.
     The file is searched for via the full_path() function above.
+
+    See sha1_file() for the meaning of bufsize.
+
+    If a digest cache is in use (see use_digest_cache()) it is
+    consulted first and a ``cache.Digest`` which provides the same
+    ``hexdigest()`` and ``digest()`` methods is returned.
     '''
-    path = full_path(filename)
+    return _sha1_found(full_path(filename), bufsize)
+
+# Digest a file already located with full_path(), if it was found.
+def _sha1_found(path, bufsize = None):
     if not path: return None
-    return hashlib.sha1(open(path).read())
+    try:
+        if digest_cache is not None:
+            import cache
+            return cache.Digest(digest_cache.sha1(path, bufsize))
+        return sha1_file(path, bufsize)
+    except (IOError, OSError), err:
+        if err.errno == errno.ENOENT:
+            return None         # a dangling link, or gone since found
+        raise
+
+#: Default number of files hashed concurrently by sha1_digests().
+digest_workers = 1
+
+def sha1_digests(filenames, workers = None, bufsize = None):
+    '''
+    Return an iterator over sha1_digest() results, one for each of the
+    given filenames and in the same order.
+
+    The files are first all located with full_paths().  Up to workers
+    files (default is ``digest_workers``) are then hashed at once by a
+    pool of threads.  Reading and hashing release the GIL so this
+    overlaps I/O across files.
+
+    The pool belongs to the iterator.  If it is closed, or dropped,
+    before the end no more files are started.
+    '''
+    paths = full_paths(filenames)
+    workers = min(workers or digest_workers, len(paths))
+    if workers <= 1:
+        return (_sha1_found(path, bufsize) for path in paths)
+    return _pooled_digests(paths, workers, bufsize)
+
+# Hash the paths in a pool of threads, stopping it when done with.
+def _pooled_digests(paths, workers, bufsize):
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        for digest in pool.imap(lambda path: _sha1_found(path, bufsize), paths):
+            yield digest
+            continue
+    finally:
+        pool.terminate()        # drops the files not yet started
+    return
+
+def process_map(function, args, workers = None):
+    '''
+    Generate function(arg) for each of the args, in the order they
+    finish.  The function must be a module level one so that it can
+    be handed to the workers.
 
+    Up to workers processes are used, by default one per CPU.  With
+    a single worker everything runs in this process.  The pool belongs
+    to the generator and is stopped when it is closed or dropped.
+    '''
+    import multiprocessing
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        for arg in args:
+            yield function(arg)
+            continue
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for ret in pool.imap_unordered(function, args, chunksize=4):
+            yield ret
+            continue
+    finally:
+        pool.terminate()
+    return
+
+def new_file_mode(mode = 0666):
+    '''
+    Return the permissions open() would give a new file asked for with
+    mode, that is mode less the process umask.  Files made with
+    ``tempfile.mkstemp()`` are only readable by their owner and need
+    this before being renamed into place.
+    '''
+    umask = os.umask(0)
+    os.umask(umask)
+    return mode & ~umask
+
+def use_wal(conn):
+    '''
+    Put the SQLite connection in write ahead log mode, so readers do
+    not wait on writers, where the file system supports it.
+    '''
+    import sqlite3
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.DatabaseError:
+        pass            # not all file systems support WAL
+    return
 
-def fitsverify(filename):
+def fitsverify(filename, external = False):
+    '''
+    Verify the structure of the FITS file of given name.
+
+    If verification fails, return list of error strings.
+
+    By default the checks are done in this process, see the
+    ``verifier`` module.  If external is True the ``fitsverify``
+    program is run instead, see run_fitsverify().
+    '''
+    if external:
+        return run_fitsverify(filename)
+    import verifier
+    return verifier.verify_file(filename)
+
+def run_fitsverify(filename):
     '''
     Run fitsverify on file of given name.  
 
@@ -75,12 +408,218 @@ def fitsverify(filename):
     if not proc.returncode:
         return None
 
+    found = parse_fitsverify_report(out, [filename], err)
+    if filename in found:
+        return found[filename]
+    return fitsverify_errors(err) or \
+        ['Error: fitsverify exited with status %d' % proc.returncode]
+
+def run_fitsverify_batch(filenames):
+    '''
+    Run fitsverify once on all of the given files.
+
+    Return a dictionary mapping each filename to its result as from
+    run_fitsverify().  See parse_fitsverify_report() for how the
+    combined report is split.
+    '''
+    from subprocess import Popen, PIPE
+    proc = Popen(['fitsverify'] + list(filenames), stdout=PIPE, stderr=PIPE)
+    out,err = proc.communicate()
+    return parse_fitsverify_report(out, filenames, err)
+
+def fitsverify_errors(text):
+    '''
+    Return the error strings of the non blank lines of fitsverify
+    output, each without its leading ``***`` marker.
+    '''
     ret = []
-    for line in err.split('\n'):
+    for line in text.split('\n'):
         line = line.strip()
         if not line: continue
         ret.append(' '.join(line.split()[1:]))
         continue
     return ret
 
-    
+def parse_fitsverify_report(report, filenames, err = ''):
+    '''
+    Split the report fitsverify writes to standard output into a
+    dictionary mapping each filename to None if it verified or a list
+    of error strings.  This is used for one file as for several.
+
+    Each file's part of the report starts with a "File: <name>" line
+    and ends with a "**** Verification found ... ****" summary.  A
+    file's errors are the "*** Error:" lines of its part or, if there
+    are none and only one file was checked, the lines fitsverify wrote
+    to standard error, given as err.  Output on standard error can not
+    be told apart between several files, so a file with errors but no
+    error lines is left out, as is one with no summary (for example
+    because fitsverify stopped early).  The caller can then run it
+    again on its own.
+    '''
+    wanted = set(filenames)
+    single = len(wanted) == 1
+    ret = {}
+    current = None
+    errors = []
+    for line in report.split('\n'):
+        line = line.strip()
+        if line.startswith('File: '):
+            current = line[len('File: '):].strip()
+            errors = []
+            continue
+        if current not in wanted:
+            continue
+        if line.startswith('*** Error:'):
+            errors.extend(fitsverify_errors(line))
+            continue
+        match = re.match(r'^\*\*\*\* Verification found (\d+) warning\(s\) and (\d+) error\(s\)', line)
+        if match:
+            nerrors = int(match.group(2))
+            if not nerrors:
+                ret[current] = None
+            elif errors:
+                ret[current] = errors
+            elif single:
+                ret[current] = fitsverify_errors(err) or \
+                    ['Error: fitsverify found %d error(s)' % nerrors]
+            current = None
+        continue
+    return ret
+
+#: The cache.ResultCache consulted by fitsverify_files(), if any.  Set
+#: it with use_result_cache() or the LCATR_RESULT_CACHE environment
+#: variable.
+result_cache = None
+
+def use_result_cache(filename, max_entries = None):
+    '''
+    Make fitsverify_files() remember results in the given SQLite
+    database file.  A filename of None turns caching off.
+
+    See ``cache.ResultCache``.
+    '''
+    global result_cache
+    if filename is None:
+        result_cache = None
+        return
+    import cache
+    result_cache = cache.ResultCache(filename, max_entries)
+    return
+
+# Versions found by fitsverify_version(), by kind
+_fitsverify_versions = dict()
+
+def fitsverify_version(external = False):
+    '''
+    Return a string which changes whenever the verifier used by
+    fitsverify() may give different results: a digest of the source
+    of the ``verifier`` module or, if external is True, of the path,
+    size and modification time of the ``fitsverify`` program found in
+    the PATH.  It is part of the keys of results kept by
+    fitsverify_files().
+    '''
+    kind = external and 'external' or 'internal'
+    version = _fitsverify_versions.get(kind)
+    if version is not None:
+        return version
+    if external:
+        from distutils.spawn import find_executable
+        program = find_executable('fitsverify')
+        ident = 'missing'
+        if program:
+            st = os.stat(os.path.realpath(program))
+            ident = '%s:%d:%r' % (os.path.realpath(program), st.st_size, st.st_mtime)
+        version = hashlib.sha1(ident).hexdigest()[:16]
+    else:
+        import verifier
+        source = os.path.splitext(verifier.__file__)[0] + '.py'
+        if not os.path.exists(source):
+            source = verifier.__file__
+        version = sha1_file(source).hexdigest()[:16]
+    _fitsverify_versions[kind] = version
+    return version
+
+#: Default number of fitsverify runs made concurrently by fitsverify_files().
+fitsverify_workers = 4
+
+#: Default number of files given to each run of the fitsverify program.
+fitsverify_batch_size = 16
+
+def fitsverify_files(filenames, workers = None, external = False, batch_size = None):
+    '''
+    Verify many FITS files, returning a list of fitsverify() results
+    in the same order as the filenames.
+
+    Up to workers (default ``fitsverify_workers``) checks run at once
+    in a pool of threads.  With external True each run of the
+    ``fitsverify`` program is given up to batch_size files (default
+    ``fitsverify_batch_size``) and any file its report can not be
+    split for is run again on its own.
+
+    If a result cache is in use (see use_result_cache()) results are
+    stored under the SHA1 digest of the file's contents and the
+    fitsverify_version() so files which have not changed are not
+    verified again until the verifier does.
+    '''
+    filenames = list(filenames)
+    kind = external and 'external' or 'internal'
+    if result_cache is not None:
+        kind = '%s:%s' % (kind, fitsverify_version(external))
+    results = [None] * len(filenames)
+
+    keys = [None] * len(filenames)
+    todo = []
+    for index, filename in enumerate(filenames):
+        if result_cache is not None and os.path.isfile(filename):
+            keys[index] = 'fitsverify:%s:%s' % (kind, _sha1_found(filename).hexdigest())
+            found = result_cache.get(keys[index])
+            if found is not None:
+                results[index] = found or None
+                continue
+        todo.append(index)
+        continue
+
+    def run(batch):
+        names = [filenames[index] for index in batch]
+        if not external:
+            return [fitsverify(name) for name in names]
+        if len(names) == 1:
+            return [run_fitsverify(names[0])]
+        found = run_fitsverify_batch(names)
+        ret = []
+        for name in names:
+            if name in found:
+                ret.append(found[name])
+            else:
+                ret.append(run_fitsverify(name))
+            continue
+        return ret
+
+    batch_size = external and (batch_size or fitsverify_batch_size) or 1
+    batches = [todo[start:start+batch_size] for start in range(0, len(todo), batch_size)]
+    workers = min(workers or fitsverify_workers, len(batches))
+    if workers <= 1:
+        done = map(run, batches)
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            done = pool.map(run, batches)
+        finally:
+            pool.close()
+            pool.join()
+
+    for batch, batch_results in zip(batches, done):
+        for index, result in zip(batch, batch_results):
+            results[index] = result
+            if keys[index] is not None:
+                result_cache.put(keys[index], result or [])
+            continue
+        continue
+    return results
+
+
+if os.environ.get('LCATR_DIGEST_CACHE'):
+    use_digest_cache(os.environ['LCATR_DIGEST_CACHE'])
+if os.environ.get('LCATR_RESULT_CACHE'):
+    use_result_cache(os.environ['LCATR_RESULT_CACHE'])
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+'''
+Check the structure of a FITS file without running ``fitsverify``.
+
+The file is read block by block and each HDU is checked against the
+rules of the FITS standard which the files made by this package rely
+on:
+
+ - the file is a whole number of 2880 byte blocks,
+
+ - headers hold only valid, printable cards, end with ``END`` and are
+   padded with blanks,
+
+ - the mandatory keywords are present and in the required order for
+   primary, image, ASCII table and binary table HDUs,
+
+ - table columns have valid ``TFORMn`` and, for ASCII tables only,
+   ``TBCOLn`` cards consistent with the row width,
+
+ - data is padded with zeros (blanks for ASCII tables).
+
+Problems are returned as a list of strings in the same form as
+``util.fitsverify()`` so the external program is only needed as a
+cross check:
+
+  >>> from lcatr.schema.verifier import verify_file
+  >>> errors = verify_file("results.fits")
+  >>> if errors: print '\n'.join(errors)
+
+'''
+
+import os
+import re
+from headers import BLOCK_SIZE, CARD_SIZE, padded_size, parse_card, RawHeader
+
+#: The allowed values of BITPIX
+bitpix_values = [8, 16, 32, 64, -32, -64]
+
+#: Bytes per element for binary table TFORM type codes.  Bits (X) are
+#: handled separately.
+binary_widths = dict(L=1, B=1, I=2, J=4, K=8, A=1, E=4, D=8, C=8, M=16, P=8, Q=16)
+
+binary_tform_re = re.compile(r'^(\d*)([LXBIJKAEDCMPQ])(.*)$')
+ascii_tform_re = re.compile(r'^([AIFED])(\d+)(\.\d+)?$')
+keyword_re = re.compile(r'^[A-Z0-9_-]*$')
+
+def binary_tform_width(tform):
+    '''
+    Return the number of bytes a binary table column of the given
+    TFORM takes in a row or None if the TFORM is invalid.
+    '''
+    match = binary_tform_re.match(tform.strip())
+    if not match:
+        return None
+    repeat, code, rest = match.groups()
+    repeat = int(repeat or 1)
+    if code in 'PQ':
+        if not re.match(r'^[LXBIJKAEDCM](\(\d+\))?$', rest):
+            return None
+        return binary_widths[code]
+    if rest and code != 'A':
+        return None
+    if code == 'X':
+        return (repeat + 7) // 8
+    return repeat * binary_widths[code]
+
+def ascii_tform_width(tform):
+    '''
+    Return the number of characters an ASCII table column of the
+    given TFORM takes or None if the TFORM is invalid.
+    '''
+    match = ascii_tform_re.match(tform.strip())
+    if not match:
+        return None
+    code, width, decimals = match.groups()
+    if code != 'A' and code != 'I' and not decimals:
+        return None
+    if code in 'AI' and decimals:
+        return None
+    return int(width)
+
+
+class Verifier(object):
+    '''
+    Collects the problems found in one file.
+    '''
+
+    def __init__(self):
+        self.errors = []
+        return
+
+    def error(self, hdunum, msg):
+        if hdunum:
+            msg = 'HDU %d: %s' % (hdunum, msg)
+        self.errors.append('Error: ' + msg)
+        return
+
+    def check_cards(self, hdunum, cards):
+        '''
+        Check that raw cards are well formed.
+        '''
+        for cardnum, card in enumerate(cards):
+            key = card[:8]
+            if [c for c in card if not ' ' <= c <= '~']:
+                self.error(hdunum, 'card %d contains non-printable characters' % (cardnum+1))
+            if key.rstrip() != key.strip() or not keyword_re.match(key.rstrip()):
+                self.error(hdunum, 'card %d has an illegal keyword "%s"' % (cardnum+1, key.rstrip()))
+            continue
+        return
+
+    def check_order(self, hdunum, header, expected):
+        '''
+        Check that the first cards are the expected keywords, in order.
+        '''
+        keys = header.keys()
+        for count, key in enumerate(expected):
+            if count >= len(keys) or keys[count] != key:
+                found = keys[count] if count < len(keys) else 'nothing'
+                self.error(hdunum, 'keyword #%d should be %s, found %s' % (count+1, key, found))
+                return False
+            continue
+        return True
+
+    def check_int(self, hdunum, header, key, allowed = None, minimum = None):
+        value = header.get(key)
+        if not isinstance(value, (int,long)) or isinstance(value, bool):
+            self.error(hdunum, '%s must be an integer, found %r' % (key, value))
+            return None
+        if allowed is not None and value not in allowed:
+            self.error(hdunum, '%s must be %s, found %d' %
+                       (key, ' or '.join(map(str, allowed)), value))
+        if minimum is not None and value < minimum:
+            self.error(hdunum, '%s must be >= %d, found %d' % (key, minimum, value))
+        return value
+
+    def check_header(self, hdunum, header):
+        '''
+        Check the mandatory keywords of an HDU header.
+        '''
+        naxis = header.get('NAXIS')
+        naxis = naxis if isinstance(naxis, int) and 0 <= naxis <= 999 else 0
+        axes = ['NAXIS%d' % n for n in range(1, naxis+1)]
+
+        if hdunum == 1:
+            if header.get('SIMPLE') is not True:
+                self.error(hdunum, 'SIMPLE must be T')
+            mandatory = ['SIMPLE', 'BITPIX', 'NAXIS'] + axes
+        else:
+            xtension = header.get('XTENSION')
+            mandatory = ['XTENSION', 'BITPIX', 'NAXIS'] + axes + ['PCOUNT', 'GCOUNT']
+            if xtension in ('TABLE', 'BINTABLE'):
+                mandatory.append('TFIELDS')
+
+        if not self.check_order(hdunum, header, mandatory):
+            return
+        self.check_int(hdunum, header, 'BITPIX', bitpix_values)
+        self.check_int(hdunum, header, 'NAXIS', minimum = 0)
+        for key in axes:
+            self.check_int(hdunum, header, key, minimum = 0)
+
+        if hdunum == 1:
+            return
+        self.check_int(hdunum, header, 'PCOUNT', minimum = 0)
+        self.check_int(hdunum, header, 'GCOUNT', minimum = 1)
+        xtension = header.get('XTENSION')
+        if xtension == 'BINTABLE':
+            self.check_table(hdunum, header, True)
+        elif xtension == 'TABLE':
+            self.check_table(hdunum, header, False)
+        return
+
+    def check_table(self, hdunum, header, binary):
+        '''
+        Check the table specific keywords.
+        '''
+        kind = binary and 'Binary' or 'ASCII'
+        if header.get('BITPIX') != 8:
+            self.error(hdunum, 'BITPIX must be 8 in the %s table' % kind)
+        if header.get('NAXIS') != 2:
+            self.error(hdunum, 'NAXIS must be 2 in the %s table' % kind)
+        if header.get('GCOUNT') != 1:
+            self.error(hdunum, 'GCOUNT must be 1 in the %s table' % kind)
+        if not binary and header.get('PCOUNT') != 0:
+            self.error(hdunum, 'PCOUNT must be 0 in the ASCII table')
+
+        tfields = self.check_int(hdunum, header, 'TFIELDS', minimum = 0)
+        if tfields is None:
+            return
+        if tfields > 999:
+            self.error(hdunum, 'TFIELDS must be <= 999, found %d' % tfields)
+            return
+        rowlen = header.get('NAXIS1') or 0
+
+        for key in header.keys():
+            match = re.match(r'^(TFORM|TBCOL)(\d+)$', key)
+            if match and not 1 <= int(match.group(2)) <= tfields:
+                self.error(hdunum, '%s is beyond TFIELDS = %d' % (key, tfields))
+            continue
+
+        width = 0
+        for count in range(1, tfields+1):
+            tform = header.get('TFORM%d' % count)
+            tbcol = header.get('TBCOL%d' % count)
+            if not isinstance(tform, basestring):
+                self.error(hdunum, 'TFORM%d is missing or not a string' % count)
+                continue
+            if binary:
+                if 'TBCOL%d' % count in header:
+                    self.error(hdunum, 'TBCOL%d is not allowed in the Binary table.' % count)
+                size = binary_tform_width(tform)
+                if size is None:
+                    self.error(hdunum, 'TFORM%d = "%s" is not a valid Binary table format' % (count, tform))
+                    continue
+                width += size
+                continue
+            size = ascii_tform_width(tform)
+            if size is None:
+                self.error(hdunum, 'TFORM%d = "%s" is not a valid ASCII table format' % (count, tform))
+                continue
+            if not isinstance(tbcol, int) or isinstance(tbcol, bool):
+                self.error(hdunum, 'TBCOL%d is required in the ASCII table' % count)
+                continue
+            if tbcol < 1 or tbcol + size - 1 > rowlen:
+                self.error(hdunum, 'column %d (TBCOL%d = %d, width %d) does not fit in NAXIS1 = %d' %
+                           (count, count, tbcol, size, rowlen))
+            continue
+
+        if binary and width != rowlen:
+            self.error(hdunum, 'NAXIS1 = %d does not equal the sum of the column widths, %d' %
+                       (rowlen, width))
+        return
+
+    def check_padding(self, hdunum, padding, fill, what):
+        if padding.strip(fill):
+            self.error(hdunum, '%s is not padded with %s' %
+                       (what, fill == ' ' and 'blanks' or 'zeros'))
+        return
+
+    def read_header(self, fp, hdunum):
+        '''
+        Read and check one header, returning a ``RawHeader`` or None at
+        end of file or if the header can not be read.
+        '''
+        offset = fp.tell()
+        cards = []
+        while True:
+            block = fp.read(BLOCK_SIZE)
+            if not block:
+                if cards:
+                    self.error(hdunum, 'END card is missing')
+                return None
+            if len(block) < BLOCK_SIZE:
+                self.error(hdunum, 'file ends with a partial block of %d bytes' % len(block))
+                return None
+            if not cards and hdunum > 1 and block[:8] != 'XTENSION':
+                self.error(0, 'extra bytes after the last HDU at byte %d' % offset)
+                return None
+            for start in range(0, BLOCK_SIZE, CARD_SIZE):
+                card = block[start:start+CARD_SIZE]
+                if card[:8] == 'END     ':
+                    self.check_padding(hdunum, card[8:], ' ', 'END card')
+                    self.check_padding(hdunum, block[start+CARD_SIZE:], ' ', 'header')
+                    self.check_cards(hdunum, cards)
+                    parsed = [parse_card(c) for c in cards if c.strip()]
+                    return RawHeader(parsed, offset, fp.tell())
+                cards.append(card)
+                continue
+            continue
+        return None
+
+    def verify(self, fp):
+        '''
+        Check all HDUs in the open file.
+        '''
+        filesize = os.fstat(fp.fileno()).st_size
+        if filesize % BLOCK_SIZE:
+            self.error(0, 'file size %d is not a multiple of %d' % (filesize, BLOCK_SIZE))
+        hdunum = 0
+        while True:
+            hdunum += 1
+            header = self.read_header(fp, hdunum)
+            if header is None:
+                break
+            self.check_header(hdunum, header)
+            try:
+                size = header.data_size()
+            except TypeError:
+                self.error(hdunum, 'can not determine the size of the data')
+                break
+            # data ending on a block boundary has no padding to run short
+            if header.data_offset + padded_size(size) > filesize:
+                self.error(hdunum, 'data is truncated')
+                break
+            fp.seek(header.data_offset + size)
+            padding = fp.read(padded_size(size) - size)
+            fill = header.get('XTENSION') == 'TABLE' and ' ' or '\0'
+            self.check_padding(hdunum, padding, fill, 'data')
+            continue
+        if hdunum == 1 and not self.errors:
+            self.error(0, 'file is empty')
+        return
+
+    pass
+
+
+def verify_file(filename):
+    '''
+    Check the structure of the named FITS file.
+
+    Return None if no problems are found, otherwise a list of error
+    strings.
+    '''
+    verifier = Verifier()
+    try:
+        fp = open(filename, 'rb')
+    except IOError, msg:
+        return ['Error: %s' % msg]
+    try:
+        verifier.verify(fp)
+    finally:
+        fp.close()
+    return verifier.errors or None
@@ -9,6 +9,8 @@ setup(name = 'lcatr',
       url = 'http://www.phy.bnl.gov/~bviren/lsst/lcatr/',
       packages = ['lcatr','lcatr.schema'],
       package_dir = {'':'python'},
+      scripts = ['scripts/lcatr-validate', 'scripts/lcatr-export', 'scripts/lcatr-ingest',
+                 'scripts/lcatr-migrate'],
       requires = ['pyfits','numpy']
       )
 
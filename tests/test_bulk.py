@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Test bulk validation of files
+'''
+
+import os
+import lcatr.schema
+from lcatr.schema import bulk
+import pyfits
+
+good_file = 'test_bulk_good.fits'
+bad_file = 'test_bulk_bad.fits'
+
+def make_files():
+    for filename in [good_file, bad_file]:
+        if os.path.exists(filename):
+            os.remove(filename)
+        continue
+    pyfits.HDUList([lcatr.schema.limsmeta.LimsMetaPrimaryHDU(
+                testname = 'TestBulk', date_obs = '2012-01-01T00:00:00', 
+                username = 'testuser')]).writeto(good_file)
+    pyfits.HDUList([lcatr.schema.limsmeta.LimsMetaPrimaryHDU()]).writeto(bad_file)
+    return
+
+def test_find_files():
+    make_files()
+    found = list(bulk.find_files(['.', 'test_bulk_*.fits'], 'test_bulk_*'))
+    assert found.count(good_file) == 1
+    assert os.path.join('.', good_file) in found
+
+def test_validate_files():
+    make_files()
+    for workers in [1, 2]:
+        for header_only in [False, True]:
+            reports = list(bulk.validate_files([good_file, bad_file], workers, header_only))
+            reports = dict([(r['file'], r) for r in reports])
+            assert reports[good_file]['valid']
+            assert not reports[bad_file]['valid']
+            assert 'TESTNAME' in reports[bad_file]['error']
+            continue
+        continue
+    summary = bulk.summarize(reports.values(), 1.0)
+    assert summary['files'] == 2 and summary['invalid'] == 1
+
+def test_main():
+    make_files()
+    assert bulk.main(['-j', '1', '-o', 'test_bulk.jsonl', good_file]) == 0
+    assert bulk.main(['-j', '1', '-o', 'test_bulk.jsonl', good_file, bad_file]) == 1
+    assert len(open('test_bulk.jsonl').readlines()) == 2
+
+if __name__ == '__main__':
+    test_find_files()
+    test_validate_files()
+    test_main()
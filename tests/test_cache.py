@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Test the persistent caches
+'''
+
+import os
+import time
+from hashlib import sha1
+from lcatr.schema import util, cache
+
+cache_filename = 'test_cache.db'
+data_filename = 'test_cache.dat'
+
+def fresh_cache(**kwds):
+    for ext in ['', '-wal', '-shm']:
+        if os.path.exists(cache_filename + ext):
+            os.remove(cache_filename + ext)
+        continue
+    return cache.DigestCache(cache_filename, **kwds)
+
+def write_data(text):
+    fp = open(data_filename, 'wb')
+    fp.write(text)
+    fp.close()
+    return sha1(text).hexdigest()
+
+def test_digest_cache():
+    dc = fresh_cache()
+    expected = write_data('first contents')
+    assert dc.lookup(data_filename) is None
+    assert dc.sha1(data_filename) == expected
+    assert dc.lookup(data_filename) == expected
+    assert len(dc) == 1
+
+    # a changed file is not served from the cache
+    st = os.stat(data_filename)
+    expected = write_data('second, longer contents')
+    os.utime(data_filename, (st.st_atime, st.st_mtime + 10))
+    assert dc.lookup(data_filename) is None
+    assert dc.sha1(data_filename) == expected
+    assert len(dc) == 1
+
+    # a second connection sees the same entries
+    assert cache.DigestCache(cache_filename).lookup(data_filename) == expected
+
+def test_evict():
+    dc = fresh_cache(max_entries = 3)
+    for count in range(5):
+        dc.store('entry%d' % count, 'digest', st = os.stat(__file__))
+        continue
+    dc.evict()
+    assert len(dc) == 3
+
+def test_sha1_digest_uses_cache():
+    expected = write_data('cached contents')
+    fresh_cache()
+    util.use_digest_cache(cache_filename)
+    try:
+        assert util.sha1_digest(data_filename).hexdigest() == expected
+        assert util.digest_cache.lookup(data_filename) == expected
+        got = [h.hexdigest() for h in util.sha1_digests([data_filename]*4, workers=2)]
+        assert got == [expected]*4
+    finally:
+        util.use_digest_cache(None)
+    assert util.sha1_digest(data_filename).hexdigest() == expected
+
+def test_cache_hit_stats():
+    expected = write_data('cached contents')
+    fresh_cache()
+    util.use_digest_cache(cache_filename)
+    calls = []
+    def counted(function):
+        def call(path, *args):
+            calls.append(os.path.basename(path))
+            return function(path, *args)
+        return call
+    saved = os.stat, os.lstat
+    try:
+        assert util.sha1_digest(data_filename).hexdigest() == expected
+        os.stat, os.lstat = counted(os.stat), counted(os.lstat)
+        try:
+            got = [h.hexdigest() for h in util.sha1_digests([data_filename]*3)]
+        finally:
+            os.stat, os.lstat = saved
+        assert got == [expected]*3
+        # one stat of the file per hit, and one of its directory
+        assert calls.count(data_filename) == 3, calls
+        assert len(calls) == 4, calls
+
+        # the same relative name in another directory is another file
+        dirname = 'test_cache_dir'
+        if not os.path.exists(dirname):
+            os.mkdir(dirname)
+        open(os.path.join(dirname, data_filename), 'wb').write('other contents')
+        here = os.getcwd()
+        os.chdir(dirname)
+        try:
+            assert util.digest_cache.lookup(data_filename) is None
+            assert util.sha1_digest(data_filename).hexdigest() == sha1('other contents').hexdigest()
+        finally:
+            os.chdir(here)
+        assert util.digest_cache.lookup(data_filename) is None # replaced by the other
+        assert util.sha1_digest(data_filename).hexdigest() == expected
+    finally:
+        util.use_digest_cache(None)
+
+if __name__ == '__main__':
+    test_digest_cache()
+    test_evict()
+    test_sha1_digest_uses_cache()
+    test_cache_hit_stats()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''
+Test the spatial index of cold spots
+'''
+
+import os
+import time
+import shutil
+import numpy
+import pyfits
+import lcatr.schema
+from lcatr.schema import coldspots, export
+
+test_dir = 'test_coldspots_files'
+store_dir = 'test_coldspots_store'
+cache_file = 'test_coldspots.npz'
+
+def make_files(nfiles, nspots = 200):
+    '''
+    Write result files with random cold spots, the last with a table
+    in the older GNC layout.  Return the names and the spots written.
+    '''
+    for dirname in [test_dir, store_dir]:
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        continue
+    os.makedirs(test_dir)
+    rand = numpy.random.RandomState(42)
+    filenames = []
+    spots = []
+    for count in range(nfiles):
+        amp = rand.randint(1, 17, nspots)
+        x = rand.randint(0, 512, nspots)
+        y = rand.randint(0, 2002, nspots)
+        pixcount = rand.randint(1, 50, nspots)
+        if count < nfiles - 1:
+            table = lcatr.schema.ptc.PtcColdSpotTableHDU(ampnum = amp, pixcount = pixcount,
+                                                          spotx = x, spoty = y)
+        else:
+            cols = [pyfits.Column(name = name, format = 'I', array = array) for name, array in
+                    [('ampnum', amp), ('pixcount', pixcount), ('spotx', x), ('spoty', y)]]
+            table = pyfits.new_table(cols)
+            table.name = 'ColdSpot'
+        filename = os.path.join(test_dir, 'result%d.fits' % count)
+        pyfits.HDUList([
+                lcatr.schema.limsmeta.LimsMetaPrimaryHDU(
+                    testname = 'Test%d' % count, date_obs = '2012-01-%02dT00:00:00' % (count+1),
+                    username = 'testuser'),
+                table]).writeto(filename)
+        filenames.append(filename)
+        spots.append((numpy.repeat(count, nspots), amp, x, y))
+        continue
+    spots = [numpy.concatenate(column) for column in zip(*spots)]
+    return filenames, spots
+
+def check_queries(index, filenames, spots):
+    file_id, amp, x, y = spots
+    rand = numpy.random.RandomState(7)
+    qamp = rand.randint(1, 17, 100)
+    qx = rand.uniform(-20, 530, 100)
+    qy = rand.uniform(-20, 2020, 100)
+    r = rand.uniform(0, 100, 100)
+    query, spot = index.radius(qamp, qx, qy, r)
+    assert list(query) == sorted(query)
+    for count in range(100):
+        dist = numpy.hypot(x - qx[count], y - qy[count])
+        want = (amp == qamp[count]) & (dist <= r[count])
+        got = spot[query == count]
+        assert sorted(zip(index.x[got], index.y[got])) == sorted(zip(x[want], y[want]))
+        assert sorted(set(index.files[i] for i in index.file_id[got])) == \
+            sorted(set(filenames[i] for i in file_id[want]))
+        continue
+
+    query, spot = index.box(qamp, qx - r, qy, qx, qy + 2*r)
+    for count in range(100):
+        want = (amp == qamp[count]) & (x >= qx[count] - r[count]) & (x <= qx[count]) & \
+            (y >= qy[count]) & (y <= qy[count] + 2*r[count])
+        assert (query == count).sum() == want.sum()
+        continue
+    return
+
+def test_coldspots():
+    filenames, spots = make_files(4)
+    index = coldspots.from_files(filenames, cell = 16)
+    assert len(index) == 800
+    check_queries(index, filenames, spots)
+
+    file_id, amp, x, y = spots
+    near = index.files_near(amp[0], x[0], y[0], 0)
+    assert filenames[0] in near
+
+    query, spot = index.radius([], [], [], 5)
+    assert len(query) == len(spot) == 0
+    empty = coldspots.from_files([])
+    assert len(empty) == 0 and len(empty.radius(1, 10, 10, 5)[0]) == 0
+
+    # unreadable files are skipped and reported
+    broken = os.path.join(test_dir, 'broken.fits')
+    open(broken, 'w').write('not a FITS file')
+    index = coldspots.from_files([broken] + filenames + [os.path.join(test_dir, 'missing.fits')])
+    assert len(index) == 800 and index.files == filenames
+    assert [name for name, error in index.errors] == [broken, os.path.join(test_dir, 'missing.fits')]
+    check_queries(index, filenames, spots)
+
+def test_export_and_cache():
+    filenames, spots = make_files(3)
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+
+    index = coldspots.cached(cache_file, filenames)
+    assert os.path.exists(cache_file)
+    assert os.stat(cache_file).st_mode & 0777 == lcatr.schema.util.new_file_mode()
+    again = coldspots.cached(cache_file, filenames)
+    assert again.fingerprint == index.fingerprint
+    assert again.files == index.files
+    assert (again.keys == index.keys).all()
+    check_queries(again, filenames, spots)
+    assert again.errors == []
+    missing = os.path.join(test_dir, 'missing.fits')
+    assert coldspots.cached(cache_file, filenames + [missing]).errors[0][0] == missing
+    assert coldspots.cached(cache_file, filenames + [missing]).errors[0][0] == missing
+
+    # a changed file makes a new index
+    os.utime(filenames[0], (time.time() + 10, time.time() + 10))
+    assert coldspots.cached(cache_file, filenames).fingerprint != index.fingerprint
+
+    # the GNC layout table is not exported, only the PTC ones
+    export.export([test_dir], store_dir)
+    stored = coldspots.cached(cache_file, outdir = store_dir)
+    assert len(stored) == 400
+    query, spot = stored.radius(spots[1][:400], spots[2][:400], spots[3][:400], 0)
+    assert (numpy.unique(query) == numpy.arange(400)).all()
+    assert coldspots.cached(cache_file, outdir = store_dir).fingerprint == stored.fingerprint
+
+if __name__ == '__main__':
+    test_coldspots()
+    test_export_and_cache()
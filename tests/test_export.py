@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''
+Test exporting result tables to a columnar store
+'''
+
+import os
+import shutil
+import numpy
+import lcatr.schema
+from lcatr.schema import export
+import pyfits
+
+test_dir = 'test_export_files'
+store_dir = 'test_export_store'
+
+def make_files(nfiles):
+    for dirname in [test_dir, store_dir]:
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        continue
+    os.makedirs(test_dir)
+    for count in range(nfiles):
+        amps = numpy.arange(16) + 100*count
+        pyfits.HDUList([
+                lcatr.schema.limsmeta.LimsMetaPrimaryHDU(
+                    testname = 'Test%d' % count, date_obs = '2012-01-%02dT00:00:00' % (count+1),
+                    username = 'testuser'),
+                lcatr.schema.ptc.PtcColdSpotTableHDU(
+                    ampnum = amps % 16 + 1, pixcount = amps, spotx = amps, spoty = amps),
+                ]).writeto(os.path.join(test_dir, 'result%d.fits' % count))
+        continue
+    open(os.path.join(test_dir, 'broken.fits'), 'w').write('not a FITS file')
+    return
+
+def test_export():
+    make_files(3)
+    assert export.main(['-o', store_dir, test_dir]) == 1 # broken.fits
+
+    files = export.load_files(store_dir)
+    assert len(files) == 4
+    assert [f['error'] is None for f in files] == [False, True, True, True]
+
+    spots = export.load(store_dir, 'PtcColdSpotTableHDU')
+    assert isinstance(spots['SpotX'], numpy.memmap)
+    assert sorted(spots) == ['AmpNum', 'PixCount', 'SpotX', 'SpotY',
+                             '_date_obs', '_file_id', '_testname']
+    assert len(spots['SpotX']) == 48
+    assert spots['PixCount'].sum() == sum(range(16))*3 + 16*(100+200)
+    assert list(numpy.unique(spots['_file_id'])) == [1,2,3]
+    assert spots['_testname'][16] == 'Test1'
+    assert spots['_date_obs'][-1] == '2012-01-03T00:00:00'
+    assert files[spots['_file_id'][0]]['file'].endswith('result0.fits')
+
+def test_npy_header():
+    for dtype in [numpy.dtype('<f4'), numpy.dtype('S64'), numpy.dtype(('>i2',(3,)))]:
+        header = export.npy_header(dtype, 12345678)
+        assert len(header) == export.npy_header_size
+        continue
+
+if __name__ == '__main__':
+    test_export()
+    test_npy_header()
@@ -3,7 +3,9 @@
 Test util.fitsverify
 '''
 
+import os
 import pyfits
+from lcatr.schema import util
 from lcatr.schema.util import fitsverify
 
 good_file = 'test_fitsverify_good.fits'
@@ -52,8 +54,132 @@ def test_fitsverify_should_succeed():
 def test_fitsverify_should_fail():
     _check(bad_file, True)
 
+sample_report = '''
+fitsverify 4.18 (CFITSIO V3.370)
+--------------------------------
+ 
+File: a.fits
+
+1 Header-Data Units in this file.
+ 
+**** Verification found 0 warning(s) and 0 error(s). ****
+ 
+File: b.fits
+
+2 Header-Data Units in this file.
+ 
+*** Error:   TBCOL1 is not allowed in the Binary table.
+*** Error:   TBCOL2 is not allowed in the Binary table.
+ 
+**** Verification found 0 warning(s) and 2 error(s). ****
+ 
+File: c.fits
+
+'''
+
+def test_parse_fitsverify_report():
+    res = util.parse_fitsverify_report(sample_report, ['a.fits','b.fits','c.fits'])
+    assert res['a.fits'] is None
+    assert res['b.fits'] == ['Error: TBCOL1 is not allowed in the Binary table.',
+                             'Error: TBCOL2 is not allowed in the Binary table.'], res['b.fits']
+    assert 'c.fits' not in res  # no summary, must be run again
+    return
+
+cache_file = 'test_fitsverify_cache.db'
+
+def test_fitsverify_files():
+    names = [good_file, bad_file, good_file]
+    res = util.fitsverify_files(names, workers=2)
+    assert res[0] is None and res[2] is None, res
+    assert res[1], res
+
+    for ext in ['','-wal','-shm']:
+        if os.path.exists(cache_file + ext):
+            os.remove(cache_file + ext)
+    util.use_result_cache(cache_file)
+    try:
+        assert util.fitsverify_files(names) == res
+        assert len(util.result_cache) == 2
+
+        # unchanged files are answered from the cache
+        key = 'fitsverify:internal:%s:%s' % (util.fitsverify_version(),
+                                             util.sha1_file(good_file).hexdigest())
+        util.result_cache.put(key, ['Error: from the cache'])
+        assert util.fitsverify_files([good_file]) == [['Error: from the cache']]
+
+        # a new verifier does not use the old results
+        util._fitsverify_versions['internal'] = 'other'
+        assert util.fitsverify_files([good_file]) == [None]
+    finally:
+        util.use_result_cache(None)
+        util._fitsverify_versions.clear()
+    return
+
+def test_parse_fitsverify_streams():
+    # errors on standard error are used for a single file
+    report = sample_report.replace('*** Error:   TBCOL1 is not allowed in the Binary table.\n', '')
+    report = report.replace('*** Error:   TBCOL2 is not allowed in the Binary table.\n', '')
+    err = '*** Error:   TBCOL1 is not allowed in the Binary table.\n'
+    res = util.parse_fitsverify_report(report, ['b.fits'], err)
+    assert res['b.fits'] == ['Error: TBCOL1 is not allowed in the Binary table.'], res
+    # but with several files they can not be placed, so it is run again alone
+    res = util.parse_fitsverify_report(report, ['a.fits','b.fits'], err)
+    assert res == {'a.fits': None}, res
+    # as the single file run finds them on standard output
+    res = util.parse_fitsverify_report(sample_report, ['b.fits'], err)
+    assert len(res['b.fits']) == 2
+    return
+
+fake_bin = 'test_fitsverify_bin'
+
+fake_fitsverify = '''#!/bin/sh
+# Stand in for fitsverify: files named *bad* have one error, written
+# to standard error and, unless FAKE_STDERR_ONLY is set, the report.
+nerrors=0
+for name in "$@"; do
+    echo "File: $name"
+    case "$name" in
+    *bad*)
+        echo "*** Error:   bad $name" >&2
+        test -z "$FAKE_STDERR_ONLY" && echo "*** Error:   bad $name"
+        echo "**** Verification found 0 warning(s) and 1 error(s). ****"
+        nerrors=`expr $nerrors + 1`;;
+    *)
+        echo "**** Verification found 0 warning(s) and 0 error(s). ****";;
+    esac
+done
+exit $nerrors
+'''
+
+def test_external_streams():
+    if not os.path.exists(fake_bin):
+        os.mkdir(fake_bin)
+    program = os.path.join(fake_bin, 'fitsverify')
+    open(program, 'w').write(fake_fitsverify)
+    os.chmod(program, 0755)
+    saved = dict(os.environ)
+    os.environ['PATH'] = os.path.abspath(fake_bin) + ':' + os.environ['PATH']
+    try:
+        names = [good_file, bad_file, good_file]
+        for stderr_only in ['', '1']:
+            os.environ['FAKE_STDERR_ONLY'] = stderr_only
+            single = util.run_fitsverify(bad_file)
+            assert single == ['Error: bad %s' % bad_file], single
+            assert util.run_fitsverify(good_file) is None
+            res = util.fitsverify_files(names, workers=1, external=True)
+            assert res == [None, single, None], res
+            continue
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    return
+
 if __name__ == '__main__':
     test_make_good_file()
     test_make_bad_file()
     test_fitsverify_should_fail()
     test_fitsverify_should_succeed()
+    test_parse_fitsverify_report()
+    test_parse_fitsverify_streams()
+    test_fitsverify_files()
+    test_external_streams()
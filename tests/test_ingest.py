@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+'''
+Test loading result files into an SQLite database
+'''
+
+import os
+import shutil
+import sqlite3
+import numpy
+import lcatr.schema
+from lcatr.schema import ingest
+import pyfits
+
+test_dir = 'test_ingest_files'
+test_db = 'test_ingest.db'
+
+def write_file(count, offset = 100):
+    amps = numpy.arange(16) + offset*count
+    filename = os.path.join(test_dir, 'result%d.fits' % count)
+    if os.path.exists(filename):
+        os.remove(filename)
+    pyfits.HDUList([
+            lcatr.schema.limsmeta.LimsMetaPrimaryHDU(
+                testname = 'Test%d' % count, date_obs = '2012-01-%02dT00:00:00' % (count+1),
+                username = 'testuser'),
+            lcatr.schema.ptc.PtcColdSpotTableHDU(
+                ampnum = amps % 16 + 1, pixcount = amps, spotx = amps, spoty = amps),
+            ]).writeto(filename)
+    return filename
+
+def setup_files(nfiles):
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    for filename in os.listdir('.'):
+        if filename.startswith(test_db):
+            os.remove(filename)
+        continue
+    os.makedirs(test_dir)
+    for count in range(nfiles):
+        write_file(count)
+        continue
+    open(os.path.join(test_dir, 'broken.fits'), 'w').write('not a FITS file')
+    return
+
+def test_ingest():
+    setup_files(3)
+    assert ingest.main(['-d', test_db, '-b', '2', test_dir]) == 1 # broken.fits
+
+    conn = sqlite3.connect(test_db)
+    files = conn.execute('SELECT path, testname, date_obs, error FROM files ORDER BY path').fetchall()
+    assert len(files) == 4
+    assert files[0][0].endswith('broken.fits') and files[0][3]
+    assert [f[1] for f in files[1:]] == ['Test0', 'Test1', 'Test2']
+    assert not any(f[3] for f in files[1:])
+
+    count, = conn.execute('SELECT count(*) FROM hdus WHERE extname = ? AND extver = ?',
+                          ('ptccoldspottablehdu', 0)).fetchone()
+    assert count == 3
+
+    user, = conn.execute('SELECT USERNAME FROM limsmetaprimaryhdu_v0 '
+                         'WHERE "DATE-OBS" = ?', ('2012-01-02T00:00:00',)).fetchone()
+    assert user == 'testuser'
+
+    pixcount, = conn.execute('SELECT sum(PixCount) FROM ptccoldspottablehdu_v0_rows').fetchone()
+    assert pixcount == sum(range(16))*3 + 16*(100+200)
+
+    plans = [row[-1] for row in conn.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM files WHERE testname = ?', ('Test1',))]
+    assert 'files_testname' in ' '.join(plans), plans
+    conn.close()
+
+    # a file gone between listing and ingest is noted, not fatal
+    db = ingest.Ingester(test_db)
+    gone = os.path.join(test_dir, 'vanished.fits')
+    assert not db.add_file(gone)
+    db.close()
+    assert db.errors[0][0] == os.path.abspath(gone) and 'OSError' in db.errors[0][1]
+    conn = sqlite3.connect(test_db)
+    row = conn.execute('SELECT size, mtime, error FROM files WHERE path = ?',
+                       (os.path.abspath(gone),)).fetchone()
+    assert row[0] is None and row[1] is None and row[2]
+    conn.close()
+
+def test_replace():
+    setup_files(2)
+    ingest.ingest([test_dir], test_db)
+
+    # the same file rewritten with other rows replaces the old ones
+    filename = write_file(1, offset = 1000)
+    db = ingest.Ingester(test_db)
+    assert db.add_file(filename)
+    assert db.remove_file(os.path.join(test_dir, 'result0.fits'))
+    assert not db.remove_file('no-such-file.fits')
+    db.close()
+
+    conn = sqlite3.connect(test_db)
+    assert [row[0] for row in conn.execute('SELECT testname FROM files WHERE testname IS NOT NULL')] == ['Test1']
+    assert conn.execute('SELECT count(*) FROM hdus').fetchone()[0] == 2
+    assert conn.execute('SELECT count(*), sum(PixCount) FROM ptccoldspottablehdu_v0_rows').fetchone() == (16, sum(range(16)) + 16*1000)
+    conn.close()
+
+def test_incremental():
+    setup_files(3)
+    os.makedirs(os.path.join(test_dir, 'sub'))
+    os.rename(os.path.join(test_dir, 'result2.fits'), os.path.join(test_dir, 'sub', 'result2.fits'))
+    db = ingest.Ingester(test_db)
+    db.settle_seconds = 0
+
+    delta = db.update([test_dir])
+    assert len(delta.new) == 4 and len(delta) == 4
+    assert len(delta.dirs) == 2
+    assert len(db.errors) == 1  # broken.fits
+
+    # nothing changed, nothing listed
+    delta = db.update([test_dir])
+    assert len(delta) == 0 and not delta.dirs
+
+    # a new time stamp is seen without listing, and the file is not loaded again
+    filename = os.path.join(test_dir, 'result0.fits')
+    os.utime(filename, (1e9, 1e9))
+    assert len(db.update([test_dir], trust_dirs = True)) == 0
+    delta = db.update([test_dir])
+    assert not delta.dirs
+    assert [entry[0] for entry in delta.changed] == [os.path.abspath(filename)]
+    assert delta.touched == [os.path.abspath(filename)]
+    os.utime(filename, (2e9, 2e9))
+    delta = db.update([test_dir], full = True, trust_dirs = True)
+    assert delta.touched == [os.path.abspath(filename)] and len(delta.dirs) == 2
+
+    # a file rewritten in place leaves its directory as it was
+    sub = os.path.join(test_dir, 'sub')
+    before = os.stat(sub).st_mtime
+    fp = open(os.path.join(sub, 'result2.fits'), 'r+b')
+    fp.write(open(os.path.join(test_dir, 'result1.fits'), 'rb').read())
+    fp.truncate()
+    fp.close()
+    os.utime(os.path.join(sub, 'result2.fits'), (3e9, 3e9))
+    assert os.stat(sub).st_mtime == before
+    delta = db.update([test_dir])
+    assert not delta.dirs and len(delta.changed) == 1 and not delta.touched
+
+    # rewritten and removed files
+    write_file(1, offset = 1000)
+    os.remove(filename)
+    delta = db.update([test_dir])
+    assert len(delta.changed) == 1 and not delta.touched
+    assert delta.deleted == [os.path.abspath(filename)]
+
+    shutil.rmtree(os.path.join(test_dir, 'sub'))
+    delta = db.update([test_dir])
+    assert len(delta.deleted) == 1 and len(delta.gone_dirs) == 1
+    db.close()
+
+    conn = sqlite3.connect(test_db)
+    assert [row[0] for row in conn.execute('SELECT testname FROM files WHERE testname IS NOT NULL')] == ['Test1']
+    assert conn.execute('SELECT sum(PixCount) FROM ptccoldspottablehdu_v0_rows').fetchone() == \
+        (sum(range(16)) + 16*1000,)
+    assert conn.execute('SELECT count(*) FROM manifest').fetchone() == (2,)
+    assert conn.execute('SELECT count(*) FROM manifest WHERE sha1 IS NULL').fetchone() == (0,)
+    conn.close()
+
+if __name__ == '__main__':
+    test_ingest()
+    test_replace()
+    test_incremental()
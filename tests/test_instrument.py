@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''
+Test the instrumentation timers and counters
+'''
+
+import os
+import json
+import pstats
+import lcatr.schema
+from lcatr.schema import instrument, util
+import pyfits
+
+test_filename = 'test_instrument.fits'
+prof_filename = 'test_instrument.prof'
+
+def test_disabled():
+    instrument.stats.reset()
+    assert not instrument.enabled
+    util.sha1_file(__file__)
+    instrument.count('nothing')
+    assert instrument.stats.as_dict() == dict(timers = {}, counters = {})
+
+def test_instrumented():
+    with instrument.instrumented() as stats:
+        hdus = pyfits.HDUList([
+                lcatr.schema.ptc.schema[0](),
+                lcatr.schema.ptc.PtcColdSpotTableHDU(
+                    ampnum = [1,2], pixcount = [10,20], spotx = [100,200], spoty = [5,6]),
+                ])
+        if os.path.exists(test_filename):
+            os.remove(test_filename)
+        hdus.writeto(test_filename)
+        pyfits.open(test_filename).validate()
+        util.full_paths([test_filename, 'no-such-file'])
+        util.sha1_file(test_filename)
+    assert not instrument.enabled
+
+    got = stats.as_dict()
+    print stats.to_json()
+    for name in ['update_self', 'verify', 'hdu_pyfits2lcatr', 'schema_lookup',
+                 'full_path', 'sha1_file']:
+        assert got['timers'][name]['calls'] >= 1, name
+        continue
+    assert got['counters']['new_table'] >= 1
+    assert got['counters']['full_path.files'] == 2
+    assert got['counters']['sha1_file.bytes'] == os.stat(test_filename).st_size
+    assert json.loads(stats.to_json()) == json.loads(json.dumps(got))
+
+    stats.dump_stats(prof_filename)
+    ps = pstats.Stats(prof_filename)
+    assert ('lcatr.schema', 0, 'verify') in ps.stats
+    ps.sort_stats('cumulative').print_stats(5)
+
+if __name__ == '__main__':
+    test_disabled()
+    test_instrumented()
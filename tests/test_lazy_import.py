@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+'''
+Test that importing lcatr.schema loads nothing heavy until it is used
+'''
+
+import os
+import sys
+from subprocess import Popen, PIPE
+
+def run(code):
+    '''
+    Run the code in a fresh interpreter and return what it prints.
+    '''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([path, env.get('PYTHONPATH','')])
+    proc = Popen([sys.executable, '-c', code], stdout=PIPE, stderr=PIPE, env=env)
+    out, err = proc.communicate()
+    assert not proc.returncode, err
+    return out.strip()
+
+def test_light_import():
+    out = run('import sys, lcatr.schema\n'
+              'from lcatr.schema import util, headers\n'
+              'util.full_path(".")\n'
+              'print sorted(m for m in ["pyfits","numpy","lcatr.schema.base"] if m in sys.modules)')
+    print out
+    assert out == '[]', out
+
+def test_load_patches_pyfits():
+    out = run('import lcatr.schema, pyfits\n'
+              'print pyfits.open.__name__\n'
+              'lcatr.schema.load()\n'
+              'print pyfits.open.__name__, lcatr.schema.open.__name__\n'
+              'print len(lcatr.schema.base.registered_schema()) > 3')
+    print out
+    assert out.split() == ['lcatr_open', 'lcatr_open', 'lcatr_open', 'True'], out
+
+def test_pyfits_import_loads():
+    # importing pyfits after the package, or before it, loads the schema
+    check = ('import sys\n'
+             'print pyfits.open.__name__, "lcatr.schema.ptc" in sys.modules\n'
+             'print isinstance(pyfits.PrimaryHDU(), lcatr.schema.base.BaseHDU)')
+    for imports in ['import lcatr.schema\nimport pyfits\n',
+                    'import pyfits\nimport lcatr.schema\n',
+                    'import lcatr.schema\nimport pyfits.hdu\nimport pyfits\n',
+                    'import lcatr.schema\nfrom lcatr.schema import base\nimport pyfits\n']:
+        out = run(imports + check)
+        assert out.split() == ['lcatr_open', 'True', 'True'] or \
+            (out.split() == ['lcatr_open', 'False', 'True'] and 'import base' in imports), \
+            (imports, out)
+        continue
+    # and opening a file finds the schema classes
+    out = run('import lcatr.schema\n'
+              'from lcatr.schema import base\n'
+              'print base.find_schema("PtcAmpTableHDU").__name__')
+    assert out == 'PtcAmpTableHDU', out
+
+def test_attribute_loads():
+    out = run('import lcatr.schema\n'
+              'print lcatr.schema.ptc.PtcAmpTableHDU.__name__, lcatr.schema.PrimaryHDU.__module__\n'
+              'print hasattr(lcatr.schema, "no_such_thing")')
+    assert out.split() == ['PtcAmpTableHDU', 'lcatr.schema.base', 'False'], out
+
+if __name__ == '__main__':
+    test_light_import()
+    test_load_patches_pyfits()
+    test_pyfits_import_loads()
+    test_attribute_loads()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+Test lazy opening of files with lcatr_open(..., lazy=True)
+'''
+
+import os
+import lcatr.schema
+from lcatr.schema import base
+import pyfits
+
+test_filename = "test_lazy_open.fits"
+
+def make_file():
+    hdus = pyfits.HDUList([
+        lcatr.schema.limsmeta.LimsMetaPrimaryHDU(
+            testname = 'TestLazyOpen', date_obs = '2012-01-01T00:00:00',
+            username = 'testuser'),
+        lcatr.schema.ptc.PtcColdSpotTableHDU(
+            ampnum = [1,2], pixcount = [10,20], spotx = [100,200], spoty = [5,6]),
+        ])
+    if os.path.exists(test_filename):
+        os.remove(test_filename)
+    hdus.writeto(test_filename)
+    return
+
+def test_lazy_open():
+    make_file()
+    hl = pyfits.open(test_filename, lazy=True)
+    assert isinstance(hl, base.LazyHDUList)
+
+    # nothing converted or read yet
+    raw = list.__getitem__(hl, 1)
+    assert not isinstance(raw, base.BaseHDU)
+    assert not raw._data_loaded
+
+    prim = hl[0]
+    assert isinstance(prim, lcatr.schema.limsmeta.LimsMetaPrimaryHDU)
+    assert prim.header['TESTNAME'] == 'TestLazyOpen'
+
+    # accessing the primary does not touch the table
+    assert not isinstance(list.__getitem__(hl, 1), base.BaseHDU)
+
+    spots = hl[1]
+    assert spots is raw         # adopted in place, not rebuilt
+    assert isinstance(spots, lcatr.schema.ptc.PtcColdSpotTableHDU)
+    assert not spots._data_loaded
+    assert list(spots.data['SpotX']) == [100,200]
+
+    hl.validate()
+    print [type(h).__name__ for h in hl]
+
+if __name__ == '__main__':
+    test_lazy_open()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+Test upgrading HDUs written with older schema versions
+'''
+
+import os
+import shutil
+import filecmp
+import numpy
+import lcatr.schema
+from lcatr.schema import base, migrate
+import pyfits
+
+test_dir = 'test_migrate_files'
+out_dir = 'test_migrate_out'
+
+class MigTestTableHDU(pyfits.BinTableHDU):
+    required_cards = [('OPERATOR', 'Who ran it')]
+    required_columns = [('Gain', 'E', 'Gain'),
+                        ('AmpNum', 'I', 'Amplifier')]
+    pass
+Version0 = MigTestTableHDU
+
+def write_files():
+    for dirname in [test_dir, out_dir]:
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        continue
+    os.makedirs(os.path.join(test_dir, 'sub'))
+    primary = lcatr.schema.limsmeta.LimsMetaPrimaryHDU(
+        testname = 'Migrate', date_obs = '2012-01-01T00:00:00', username = 'testuser')
+    table = Version0(operator = 'someone', gain = numpy.arange(16) + 0.5,
+                     ampnum = numpy.arange(16) + 1)
+    pyfits.HDUList([primary, table]).writeto(os.path.join(test_dir, 'sub', 'old.fits'))
+    pyfits.HDUList([primary]).writeto(os.path.join(test_dir, 'current.fits'))
+    return
+
+class MigTestTableHDU(pyfits.BinTableHDU):
+    schema_version = 1
+    required_cards = [('USERNAME', 'Who ran it')]
+    required_columns = [('LinearGain', 'E', 'Gain'),
+                        ('AmpNum', 'J', 'Amplifier')]
+    schema_upgrades = {0: [migrate.RenameColumn('Gain', 'LinearGain'),
+                           migrate.RetypeColumn('AmpNum', 'J'),
+                           migrate.RenameCard('OPERATOR', 'USERNAME')]}
+    pass
+
+class MigTestTableHDU(pyfits.BinTableHDU):
+    schema_version = 2
+    required_cards = [('USERNAME', 'Who ran it')]
+    required_columns = [('LinearGain', 'E', 'Gain'),
+                        ('AmpNum', 'J', 'Amplifier'),
+                        ('Offset', 'E', 'Offset')]
+    schema_upgrades = {1: [migrate.AddColumn('Offset', 'E', lambda c: c.column('LinearGain') * 2)]}
+    pass
+
+def check_upgraded(filename):
+    hdus = base.lcatr_open(filename)
+    hdus.validate(use_cache = False)
+    table = hdus[1]
+    assert isinstance(table, MigTestTableHDU)
+    assert table.header['EXTVER'] == 2
+    assert table.header['USERNAME'] == 'someone'
+    assert 'OPERATOR' not in table.header
+    assert table.get_column('AmpNum').format == 'J'
+    assert list(table.data.field('AmpNum')) == range(1, 17)
+    assert numpy.all(table.data.field('Offset') == (numpy.arange(16) + 0.5) * 2)
+    return
+
+def test_upgrade_path():
+    path = migrate.upgrade_path('MigTestTableHDU', 0)
+    assert path is migrate.upgrade_path('migtesttablehdu', 0)
+    assert path.klass is MigTestTableHDU
+    assert [version for version, step in path.steps] == [0, 0, 0, 1]
+    assert not migrate.upgrade_path('MigTestTableHDU', 2).steps
+    for version in [3, -1]:
+        try:
+            migrate.upgrade_path('MigTestTableHDU', version)
+        except ValueError:
+            pass
+        else:
+            raise RuntimeError, 'upgrade from version %d did not fail' % version
+        continue
+
+def test_upgrade_archive():
+    write_files()
+    assert migrate.main(['-j', '1', '-o', out_dir, test_dir]) == 0
+    check_upgraded(os.path.join(out_dir, 'sub', 'old.fits'))
+    assert filecmp.cmp(os.path.join(test_dir, 'current.fits'),
+                       os.path.join(out_dir, 'current.fits'), shallow = False)
+
+    # in place, the second time there is nothing to do
+    filename = os.path.join(test_dir, 'sub', 'old.fits')
+    assert migrate.upgrade_file(filename)
+    check_upgraded(filename)
+    assert not migrate.upgrade_file(filename)
+    assert sorted(os.listdir(os.path.join(test_dir, 'sub'))) == ['old.fits']
+
+def teardown_module(module = None):
+    'Take the test classes out of the registry so later tests do not see them.'
+    for version in range(3):
+        base.schema_registry.pop(('migtesttablehdu', version), None)
+        continue
+    return
+
+if __name__ == '__main__':
+    test_upgrade_path()
+    test_upgrade_archive()
+    teardown_module()
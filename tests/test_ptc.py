@@ -61,8 +61,20 @@ def test_ptc():
     print 'Initial creation:'
     print hdus[0].header
 
+    # amp 14 failed its fit: its linear gain is negative and its median gain zero
+    def check_amp14(hdus):
+        try:
+            hdus.validate()
+        except ValueError, msg:
+            print 'Caught expected:', msg
+            assert 'LinearGain gt=0 at rows 13' in str(msg)
+            assert 'MedianGain gt=0 at rows 13' in str(msg)
+        else:
+            raise ValueError, 'expected the failed fit of amp 14 to fail validation'
+        return
+
     print 'Validating original'
-    hdus.validate()
+    check_amp14(hdus)
 
     if os.path.exists(test_filename):
         print 'Removing preexisting file: "%s"' % test_filename
@@ -75,7 +87,7 @@ def test_ptc():
     print hdus2[0].header
 
     print 'Validating copy'
-    hdus2.validate()
+    check_amp14(hdus2)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+Test the schema registry
+'''
+
+import lcatr.schema
+from lcatr.schema import base
+
+def test_registered():
+    names = [name for (name,ver),klass in base.registered_schema()]
+    print 'Registered schema:', names
+    for mod in [lcatr.schema.limsmeta, lcatr.schema.ptc]:
+        for klass in mod.schema:
+            assert klass.__name__.lower() in names, klass.__name__
+            continue
+        continue
+    assert 'basehdu' not in names
+    assert 'tablebasehdu' not in names
+
+def test_find():
+    klass = base.find_schema('PTCAMPTABLEHDU', 0)
+    assert klass is lcatr.schema.ptc.PtcAmpTableHDU
+    assert base.find_schema('ptcamptablehdu') is klass
+    assert base.find_schema('ptcamptablehdu', 42) is None
+    assert base.find_schema('NoSuchHDU') is None
+
+def test_new_class_registers():
+    class RegistryTestHDU(base.BinTableHDU):
+        schema_version = 3
+        required_columns = [('Value','E','Some value')]
+        pass
+    assert base.find_schema('registrytesthdu', 3) is RegistryTestHDU
+    assert base.find_schema('registrytesthdu') is RegistryTestHDU
+    hdu = RegistryTestHDU(value=[1.0, 2.0])
+    assert hdu.header['EXTVER'] == 3
+    del base.schema_registry[('registrytesthdu', 3)]
+
+def test_schema_plan():
+    class PlanTestHDU(base.BinTableHDU):
+        required_cards = [('PLN-CARD','A card')]
+        required_columns = [('Value','E','Some value'), ('Label','A8','Some label')]
+        pass
+    plan = PlanTestHDU.__dict__['_schema_plan'] # made at definition
+    assert PlanTestHDU.schema_plan() is plan
+    assert plan.card_names == ('EXTNAME','EXTVER','PLN-CARD')
+    assert plan.cards[-1][2] == 'pln_card'
+    assert plan.column_index == dict(value=0, label=1)
+    assert plan.tform_keys == [(1,'E'), (8,'A')]
+
+    hdu = PlanTestHDU(pln_card='x', value=[1.0], label=['a'])
+    assert hdu.header['PLN-CARD'] == 'x'
+    assert hdu.get_column('LABEL').name == 'Label'
+    PlanTestHDU.validate_header(hdu.header)
+
+    # a subclass has a plan of its own, from the inherited lists
+    class PlanTestSubHDU(PlanTestHDU):
+        pass
+    assert PlanTestSubHDU.schema_plan() is not plan
+    assert PlanTestSubHDU.schema_plan().klass is PlanTestSubHDU
+    assert PlanTestHDU.schema_plan() is plan
+
+    # editing the requirements in place makes a new plan
+    assert isinstance(PlanTestHDU.required_cards, base.SchemaList)
+    PlanTestHDU.required_cards.append(('PLN-MORE','Another card'))
+    edited = PlanTestHDU.schema_plan()
+    assert edited is not plan and edited.card_names[-1] == 'PLN-MORE'
+    assert PlanTestSubHDU.schema_plan().card_names[-1] == 'PLN-MORE'
+    del PlanTestHDU.required_cards[-1]
+    assert PlanTestHDU.schema_plan().card_names == plan.card_names
+    plan = PlanTestHDU.schema_plan()
+    PlanTestHDU.allow_empty = True
+    assert PlanTestHDU.schema_plan() is not plan
+
+    # replacing the requirements makes a new plan
+    plan = PlanTestHDU.schema_plan()
+    PlanTestHDU.required_columns = PlanTestHDU.required_columns + [('Other','J','')]
+    assert isinstance(PlanTestHDU.required_columns, base.SchemaList)
+    assert PlanTestHDU.schema_plan() is not plan
+    try:
+        PlanTestHDU.validate_header(hdu.header)
+    except ValueError, msg:
+        print 'Caught expected error:', msg
+    else:
+        raise RuntimeError, 'Expected missing column to fail validation'
+    del base.schema_registry[('plantesthdu', 0)]
+    del base.schema_registry[('plantestsubhdu', 0)]
+
+if __name__ == '__main__':
+    test_registered()
+    test_find()
+    test_new_class_registers()
+    test_schema_plan()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+'''
+Test writing result files with tables streamed in chunks
+'''
+
+import os
+import warnings
+import numpy
+import lcatr.schema
+from lcatr.schema import stream, base
+import pyfits
+
+test_file = 'test_stream.fits'
+
+def primary():
+    return lcatr.schema.limsmeta.LimsMetaPrimaryHDU(
+        testname = 'Stream', date_obs = '2012-01-01T00:00:00', username = 'testuser')
+
+def spot_chunks(nchunks, size):
+    for count in range(nchunks):
+        amps = numpy.arange(size) + count*size
+        if count % 2:
+            # a structured array of another byte order
+            chunk = numpy.empty(size, dtype = [('AmpNum','<i2'), ('PixCount','<i2'),
+                                               ('SpotX','<i2'), ('SpotY','<i2')])
+            for name in chunk.dtype.names:
+                chunk[name] = amps
+                continue
+            yield chunk
+        else:
+            yield dict(ampnum = amps, pixcount = amps, spotx = amps, spoty = amps)
+        continue
+    return
+
+def check_checksums(filename):
+    with warnings.catch_warnings(record = True) as caught:
+        warnings.simplefilter('always')
+        hdus = base.pyfitsopen(filename, checksum = True)
+        for hdu in hdus:
+            hdu.data
+            continue
+        hdus.close()
+    return [str(w.message) for w in caught if 'verification failed' in str(w.message)]
+
+def test_stream():
+    if os.path.exists(test_file):
+        os.remove(test_file)
+    with stream.StreamWriter(test_file) as out:
+        out.write_hdu(primary())
+        assert out.write_table(lcatr.schema.ptc.PtcColdSpotTableHDU, spot_chunks(5, 999)) == 5*999
+        with out.table(lcatr.schema.common.FileRefTableHDU, filedesc = 'Files') as table:
+            files = ['test_stream.py', 'test_table.py']
+            table.write(dict(filename = files,
+                             sha1hash = [lcatr.schema.util.sha1_digest(name).hexdigest()
+                                         for name in files]))
+        assert not os.path.exists(test_file)
+
+    hdus = base.lcatr_open(test_file)
+    hdus.validate(use_cache = False)
+    spots = hdus[1].data
+    assert len(spots) == 5*999
+    assert list(spots.field('SpotY')) == range(5*999)
+    assert hdus[2].header['FILEDESC'] == 'Files'
+    assert list(hdus[2].data.field('Filename')) == ['test_stream.py', 'test_table.py']
+    hdus.close()
+    assert not check_checksums(test_file)
+
+    # a damaged file fails the checksums
+    data = open(test_file, 'rb').read()
+    offset = 2880*3 + 100
+    open(test_file, 'wb').write(data[:offset] + chr((ord(data[offset]) + 1) % 256) + data[offset+1:])
+    assert check_checksums(test_file)
+
+def test_stream_mode():
+    # readable by others, as a file written by pyfits would be
+    if os.path.exists(test_file):
+        os.remove(test_file)
+    saved = os.umask(022)
+    try:
+        with stream.StreamWriter(test_file) as out:
+            out.write_hdu(primary())
+    finally:
+        os.umask(saved)
+    assert os.stat(test_file).st_mode & 0777 == 0644
+
+def test_stream_checks():
+    if os.path.exists(test_file):
+        os.remove(test_file)
+    out = stream.StreamWriter(test_file)
+    for bad in [lambda: out.table(lcatr.schema.ptc.PtcColdSpotTableHDU),
+                lambda: out.write_hdu(lcatr.schema.limsmeta.LimsMetaPrimaryHDU())]:
+        try:
+            bad()
+        except ValueError:
+            pass
+        else:
+            raise RuntimeError, 'not refused'
+        continue
+    out.write_hdu(primary())
+    table = out.table(lcatr.schema.ptc.PtcColdSpotTableHDU)
+    try:
+        table.write(dict(ampnum = [1]))
+    except ValueError:
+        pass
+    else:
+        raise RuntimeError, 'missing columns not refused'
+    try:
+        table.close()
+    except ValueError:
+        pass
+    else:
+        raise RuntimeError, 'empty table not refused'
+    out.abort()
+    assert not os.path.exists(test_file)
+    assert not [name for name in os.listdir('.') if name.startswith('.stream-')]
+
+def test_stream_constraints():
+    if os.path.exists(test_file):
+        os.remove(test_file)
+    good = range(1, 4)
+    try:
+        with stream.StreamWriter(test_file) as out:
+            out.write_hdu(primary())
+            table = out.table(lcatr.schema.ptc.PtcColdSpotTableHDU)
+            table.write(dict(ampnum = good, pixcount = good, spotx = good, spoty = good))
+            size = out.fp.tell()
+            try:
+                table.write(dict(ampnum = good, pixcount = [-1,-2,-3], spotx = good, spoty = good))
+            except ValueError, msg:
+                print 'Caught expected:', msg
+                assert 'PixCount min=0 at rows 3,4,5' in str(msg)
+            else:
+                raise RuntimeError, 'negative pixel counts not refused'
+            assert table.rows == 3 and out.fp.tell() == size
+            table.write(dict(ampnum = [1], pixcount = [-1], spotx = [0], spoty = [0]))
+    except ValueError, msg:
+        assert 'PixCount min=0 at rows 3' in str(msg)
+    else:
+        raise RuntimeError, 'negative pixel count not refused'
+    assert not os.path.exists(test_file)
+
+    class StreamConstraintHDU(base.BinTableHDU):
+        required_columns = [
+            ('Time','D','Time of the row', dict(monotonic='strictly increasing')),
+            ]
+        pass
+    class UniqueConstraintHDU(base.BinTableHDU):
+        required_columns = [
+            ('Serial','J','Row serial number', dict(unique=True)),
+            ]
+        pass
+    try:
+        with stream.StreamWriter(test_file) as out:
+            out.write_hdu(primary())
+            table = out.table(StreamConstraintHDU)
+            table.write(dict(time = [1.0, 2.0]))
+            table.write(dict(time = []))
+            table.write(dict(time = [3.0, 4.0]))
+            try:
+                table.write(dict(time = [4.0, 5.0])) # repeats the last row written
+            except ValueError, msg:
+                assert 'Time monotonic=strictly increasing at rows 4' in str(msg)
+            else:
+                raise RuntimeError, 'order across chunks not checked'
+            table.write(dict(time = [4.5]))
+            table.close()
+            try:
+                out.table(UniqueConstraintHDU)
+            except ValueError, msg:
+                assert 'unique' in str(msg)
+            else:
+                raise RuntimeError, 'unique column streamed'
+        hdus = base.lcatr_open(test_file)
+        assert list(hdus[1].data.field('Time')) == [1.0, 2.0, 3.0, 4.0, 4.5]
+        hdus.close()
+    finally:
+        del base.schema_registry[('streamconstrainthdu', 0)]
+        del base.schema_registry[('uniqueconstrainthdu', 0)]
+
+if __name__ == '__main__':
+    test_stream()
+    test_stream_mode()
+    test_stream_checks()
+    test_stream_constraints()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+'''
+Test filling table HDUs
+'''
+
+import time
+import numpy
+import lcatr.schema
+from lcatr.schema import base
+
+def test_append_column_array():
+    hdu = lcatr.schema.ptc.PtcColdSpotTableHDU(ampnum=[1], pixcount=[2], spotx=[3], spoty=[4])
+    hdu.append_column_array('AmpNum', 7)
+    assert len(hdu.data) == 2
+    assert list(hdu.data.field('AmpNum')) == [1,7]
+
+def test_row_builder():
+    rb = base.RowBuilder([('A','i2'),('B','S8')])
+    for count in range(1000):
+        rb.append(count, 'x%d' % count)
+    rb.extend(b = ['y','z'], a = [-1,-2])
+    arrays = rb.arrays()
+    assert len(rb) == 1002
+    assert list(arrays['A'][-3:]) == [999,-1,-2]
+    assert arrays['B'][1] == 'x1'
+    for bad in [lambda: rb.append(1), lambda: rb.append(a=1, c=2), 
+                lambda: rb.extend(a=[1], b=['p','q'])]:
+        try:
+            bad()
+        except ValueError, msg:
+            print 'Caught expected:', msg
+        else:
+            raise ValueError, 'expected a failure'
+
+def fill_spots(nspots):
+    hdu = lcatr.schema.ptc.PtcColdSpotTableHDU()
+    start = time.time()
+    with hdu.batch() as rows:
+        for count in xrange(nspots):
+            rows.append(ampnum=count%16+1, pixcount=count%100, 
+                        spotx=count%2000, spoty=count%500)
+            continue
+    return hdu, time.time() - start
+
+def test_batch():
+    hdu, took = fill_spots(10)
+    assert len(hdu.data) == 10
+    assert list(hdu.data.field('AmpNum')[:3]) == [1,2,3]
+    hdu.validate()
+
+    # second batch appends and a failed batch changes nothing
+    with hdu.batch() as rows:
+        rows.extend(ampnum=[16], pixcount=[1], spotx=[2], spoty=[3])
+    try:
+        with hdu.batch() as rows:
+            rows.append(ampnum=1, pixcount=1, spotx=1, spoty=1)
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert len(hdu.data) == 11
+    assert hdu.data.field('AmpNum')[-1] == 16
+
+def test_batch_scaling():
+    big, tbig = fill_spots(100000)
+    print 'Filled 100k spots in %.3fs' % tbig
+    assert len(big.data) == 100000
+
+    # buffers grow geometrically: few reallocations, capacity under twice the rows
+    rb = base.RowBuilder([('A','i4')])
+    capacities = [len(rb.buffers[0])]
+    for count in xrange(100000):
+        rb.append(count)
+        if len(rb.buffers[0]) != capacities[-1]:
+            capacities.append(len(rb.buffers[0]))
+        continue
+    assert capacities == [base.RowBuilder.initial_capacity * 2**n for n in range(len(capacities))]
+    assert len(capacities) - 1 <= 11, capacities
+    assert capacities[-1] < 2 * len(rb)
+    rb.extend(numpy.arange(300000))
+    assert len(rb.buffers[0]) < 2 * len(rb)
+
+def test_deferred_rebuild():
+    import os
+    import pyfits
+    hdu = lcatr.schema.ptc.PtcAmpTableHDU()
+    # positive values throughout: the failed fit of amp 14 is test_ptc's concern
+    values = numpy.arange(1, 17) * 0.25
+    for name,typestr,comment,kwname in hdu.schema_plan().columns:
+        hdu.set_column_array(name, values)
+        continue
+    assert hdu.rebuilds == 0 and hdu.dirty
+    hdu.validate()
+    assert hdu.rebuilds == 1 and not hdu.dirty
+    assert hdu.header['NAXIS2'] == 16
+    assert list(hdu.data.field('LinearGain')) == list(values)
+
+    hdu.set_column_array('FullWell', [1.0]*16)
+    filename = 'test_table.fits'
+    if os.path.exists(filename):
+        os.remove(filename)
+    pyfits.HDUList([lcatr.schema.base.PrimaryHDU(), hdu]).writeto(filename, checksum=True)
+    assert hdu.rebuilds == 2
+
+    hdus = pyfits.open(filename, checksum=True)
+    assert hdus[1].rebuilds == 0
+    assert list(hdus[1].data.field('FullWell')) == [1.0]*16
+    hdus.validate()
+
+def test_from_records():
+    klass = lcatr.schema.ptc.PtcColdSpotTableHDU
+    want = klass.records_dtype()
+    assert want.names == ('AmpNum','PixCount','SpotX','SpotY')
+
+    # matching layout, other case and byte order: wrapped, not copied
+    recs = numpy.zeros(100, dtype=[('ampnum','>i2'),('pixcount','>i2'),
+                                   ('spotx','>i2'),('spoty','>i2')])
+    recs['spotx'] = numpy.arange(100)
+    hdu = klass.from_records(recs)
+    assert numpy.may_share_memory(hdu.data, recs)
+    assert hdu.rebuilds == 0 and not hdu.dirty
+    assert hdu.columns.names == list(want.names)
+    recs['spotx'][0] = 42
+    assert hdu.data.field('SpotX')[0] == 42
+    hdu.validate()
+
+    # other types or order are copied once
+    recs = numpy.zeros(10, dtype=[('SpotY','i4'),('SpotX','i4'),('PixCount','f8'),('AmpNum','i8')])
+    hdu = klass.from_records(recs)
+    assert not numpy.may_share_memory(hdu.data, recs)
+    assert hdu.data.dtype.names == want.names
+    hdu.validate()
+
+    # as are dictionaries of columns
+    hdu = klass.from_records(dict(ampnum=[1,2], pixcount=[3,4], spotx=[5,6], spoty=[7,8]))
+    assert list(hdu.data.field('SpotY')) == [7,8]
+    hdu.validate()
+
+    for bad in [dict(ampnum=[1,2]), dict(ampnum=[1], pixcount=[3,4], spotx=[5,6], spoty=[7,8]),
+                numpy.arange(3)]:
+        try:
+            klass.from_records(bad)
+        except ValueError, msg:
+            print 'Caught expected:', msg
+        else:
+            raise ValueError, 'expected a failure'
+
+def test_column_constraints():
+    class ConstraintTestHDU(base.BinTableHDU):
+        required_columns = [
+            ('Serial','J','Row serial number', dict(unique=True, monotonic='strictly increasing')),
+            ('Gain','E','A gain', dict(min=0, max=10, finite=True)),
+            ('Kind','A4','A kind', dict(values=['bias','dark','flat'])),
+            ('Time','D','Time of the row', dict(monotonic='increasing')),
+            ('Ratio','E','A ratio', dict(gt=0, lt=1)),
+            ('Note','A8','Anything'),
+            ]
+        pass
+    try:
+        plan = ConstraintTestHDU.schema_plan()
+        assert [name for name, constraints in plan.constraints] == ['Serial','Gain','Kind','Time','Ratio']
+
+        def make(nrows):
+            return ConstraintTestHDU.from_records(dict(
+                    serial = numpy.arange(nrows), gain = numpy.ones(nrows),
+                    kind = numpy.repeat('dark', nrows), time = numpy.arange(nrows) * 0.5,
+                    ratio = numpy.repeat(0.5, nrows),
+                    note = numpy.repeat('', nrows)))
+        hdu = make(10)
+        assert hdu.constraint_violations() == []
+        hdu.validate()
+
+        data = hdu.data
+        data.field('Serial')[[3,7]] = 2         # repeats 2, breaking the order at both
+        data.field('Gain')[[1,4,5]] = [-1, numpy.nan, 11]
+        data.field('Kind')[9] = 'junk'
+        data.field('Time')[6] = 0
+        data.field('Ratio')[[0,2,8]] = [0, 1, 1e-6]     # the bounds themselves are excluded
+        found = dict(((name, what), list(rows)) for name, what, rows in hdu.constraint_violations())
+        assert found == {('Serial','unique'): [3,7],
+                         ('Serial','monotonic=strictly increasing'): [3,7],
+                         ('Gain','min=0'): [1],
+                         ('Gain','max=10'): [5],
+                         ('Gain','finite'): [4],
+                         ('Kind','values'): [9],
+                         ('Time','monotonic=increasing'): [6],
+                         ('Ratio','gt=0'): [0],
+                         ('Ratio','lt=1'): [2]}, found
+        try:
+            hdu.validate()
+        except ValueError, msg:
+            print 'Caught expected:', msg
+            assert 'Gain min=0 at rows 1' in str(msg)
+            assert 'Serial unique at rows 3,7' in str(msg)
+        else:
+            raise ValueError, 'expected constraints to fail'
+
+        # a million rows cost a few whole column passes
+        hdu = make(1000000)
+        hdu.data.field('Gain')[::1000] = -1
+        start = time.time()
+        violations = hdu.constraint_violations()
+        took = time.time() - start
+        print 'Checked constraints of 1M rows in %.3fs' % took
+        assert [(name, what, len(rows)) for name, what, rows in violations] == \
+            [('Gain','min=0',1000)]
+        assert took < 5
+    finally:
+        del base.schema_registry[('constrainttesthdu', 0)]
+
+    # a class whose constraints are bad is not registered, nor replaces one
+    class BadConstraintHDU(base.BinTableHDU):
+        required_columns = [('Value','E','A value', dict(min=0))]
+        pass
+    good = BadConstraintHDU
+    try:
+        for bad in [dict(minimum=0), dict(monotonic='up')]:
+            try:
+                class BadConstraintHDU(base.BinTableHDU):
+                    required_columns = [('Value','E','A value', bad)]
+                    pass
+            except ValueError, msg:
+                print 'Caught expected:', msg
+            else:
+                raise ValueError, 'expected a bad constraint to fail'
+            assert base.find_schema('badconstrainthdu') is good
+            continue
+    finally:
+        del base.schema_registry[('badconstrainthdu', 0)]
+    for bad in [dict(minimum=0), dict(monotonic='up')]:
+        try:
+            class BadConstraintHDU(base.BinTableHDU):
+                required_columns = [('Value','E','A value', bad)]
+                pass
+        except ValueError:
+            pass
+        assert base.find_schema('badconstrainthdu') is None
+        continue
+
+if __name__ == '__main__':
+    test_append_column_array()
+    test_row_builder()
+    test_batch()
+    test_batch_scaling()
+    test_deferred_rebuild()
+    test_from_records()
+    test_column_constraints()
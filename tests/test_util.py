@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+Test lcatr.schema.util
+'''
+
+import os
+from hashlib import sha1
+from lcatr.schema import util
+
+def test_sha1_digest():
+    expected = sha1(open(__file__,'rb').read()).hexdigest()
+    for bufsize in [None, 1, 7, 1<<10, 1<<30]:
+        got = util.sha1_digest(__file__, bufsize)
+        assert got.hexdigest() == expected, bufsize
+        continue
+    assert util.sha1_digest('no-such-file-for-test_util') is None
+
+def test_sha1_digests():
+    filenames = [__file__, 'no-such-file-for-test_util', util.__file__] * 5
+    expected = [util.sha1_digest(f) for f in filenames]
+    expected = [h and h.hexdigest() for h in expected]
+    for workers in [None, 1, 4]:
+        got = [h and h.hexdigest() for h in util.sha1_digests(filenames, workers)]
+        assert got == expected, workers
+        continue
+
+def test_sha1_digests_stop():
+    import time
+    hashed = []
+    def slow_sha1(path, bufsize = None):
+        time.sleep(0.01)
+        hashed.append(path)
+        return sha1(path)
+    saved = util.sha1_file
+    util.sha1_file = slow_sha1
+    try:
+        digests = util.sha1_digests([__file__] * 200, 2)
+        digests.next()
+        digests.close()
+        count = len(hashed)
+        time.sleep(0.1)
+        assert len(hashed) <= count + 2, (count, len(hashed))
+        assert len(hashed) < 20
+    finally:
+        util.sha1_file = saved
+
+def test_new_file_mode():
+    saved = os.umask(027)
+    try:
+        assert util.new_file_mode() == 0640
+        assert util.new_file_mode(0777) == 0750
+        assert os.umask(027) == 027
+    finally:
+        os.umask(saved)
+
+def test_fileref_parallel():
+    from lcatr.schema.common import FileRefTableHDU
+    filenames = [__file__, util.__file__, 'no-such-file-for-test_util', __file__]
+    frt = FileRefTableHDU(filename=filenames[:2], sha1hash=[None, None])
+    frt.generate(workers=4)
+    frt.validate(workers=4)
+
+    frt = FileRefTableHDU(filename=filenames, sha1hash=['bogus']*len(filenames))
+    for workers in [1, 4]:
+        try:
+            frt.validate(workers=workers, report_all=True)
+        except ValueError, msg:
+            lines = str(msg).split('\n')
+            print lines
+            assert len(lines) == len(filenames)
+            assert 'no-such-file-for-test_util' in lines[2]
+        else:
+            raise ValueError, 'validation should have failed'
+        try:
+            frt.validate(workers=workers)
+        except ValueError, msg:
+            assert 'test_util' in str(msg) and '\n' not in str(msg)
+        else:
+            raise ValueError, 'validation should have failed'
+        continue
+
+def test_full_path():
+    here = os.path.dirname(os.path.abspath(__file__))
+    name = os.path.basename(__file__)
+    saved = dict(os.environ)
+    try:
+        os.environ['CCDTEST_ROOT'] = here
+        os.environ['CCDTEST_PATH'] = '/no/such/dir:' + here
+        assert util.full_path(name) is not None
+        assert util.full_path(os.path.join(here, name)) == os.path.join(here, name)
+        assert util.full_path('no-such-file-for-test_util') is None
+        got = util.full_paths([name, 'no-such-file-for-test_util', name])
+        assert got[1] is None and got[0] == got[2] and got[0]
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+def test_path_resolver():
+    from lcatr.schema.common import FileRefTableHDU
+    dirname = 'test_util_dir'
+    if not os.path.exists(dirname):
+        os.mkdir(dirname)
+    for name in os.listdir(dirname):
+        os.remove(os.path.join(dirname, name))
+    resolver = util.PathResolver(paths = ['/no/such/dir', dirname])
+    assert resolver.resolve('newfile') is None
+    open(os.path.join(dirname, 'newfile'),'w').close()
+    assert resolver.resolve('newfile') == os.path.join(dirname, 'newfile')
+    os.remove(os.path.join(dirname, 'newfile'))
+    assert resolver.resolve('newfile') is None
+
+    # a dangling link is listed, so found, but has no digest
+    os.symlink('no-such-target', os.path.join(dirname, 'dangling'))
+    assert resolver.resolve('dangling') == os.path.join(dirname, 'dangling')
+    assert util.sha1_digest(os.path.join(dirname, 'dangling')) is None
+    frt = FileRefTableHDU(filename=[os.path.join(dirname, 'dangling')], sha1hash=['x'])
+    try:
+        frt.validate()
+    except ValueError, msg:
+        assert 'Failed to take SHA1' in str(msg)
+    else:
+        raise ValueError, 'validation should have failed'
+
+    # listings of relative directories follow the current directory
+    open(os.path.join(dirname, 'inside'),'w').close()
+    resolver = util.PathResolver(paths = ['.'], ttl = 60)
+    assert resolver.resolve('inside') is None
+    here = os.getcwd()
+    os.chdir(dirname)
+    try:
+        assert resolver.resolve('inside') == './inside'
+    finally:
+        os.chdir(here)
+    assert resolver.resolve('inside') is None
+
+if __name__ == '__main__':
+    test_sha1_digest()
+    test_full_path()
+    test_path_resolver()
+    test_sha1_digests()
+    test_sha1_digests_stop()
+    test_new_file_mode()
+    test_fileref_parallel()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+Test header-only validation
+'''
+
+import os
+import lcatr.schema
+from lcatr.schema import base, headers
+import pyfits
+
+test_filename = "test_validate_headers.fits"
+
+def write(hdus):
+    if os.path.exists(test_filename):
+        os.remove(test_filename)
+    pyfits.HDUList(hdus).writeto(test_filename)
+    return
+
+def primary(**kwds):
+    cards = dict(testname = 'TestValidateHeaders', 
+                 date_obs = '2012-01-01T00:00:00', username = 'testuser')
+    cards.update(kwds)
+    return lcatr.schema.limsmeta.LimsMetaPrimaryHDU(**cards)
+
+def spots(**kwds):
+    return lcatr.schema.ptc.PtcColdSpotTableHDU(**kwds)
+
+def _check_fails(what):
+    try:
+        base.validate_headers(test_filename)
+    except ValueError, msg:
+        print 'Failed as expected:', msg
+        assert what in str(msg), msg
+    else:
+        raise ValueError, 'Expected "%s" to fail validation' % test_filename
+    return
+
+def test_raw_headers():
+    write([primary(), spots(ampnum=[1,2], pixcount=[3,4], spotx=[5,6], spoty=[7,8])])
+    hdrs = headers.read_headers(test_filename)
+    assert len(hdrs) == 2
+    assert hdrs[0]['TESTNAME'] == 'TestValidateHeaders'
+    assert hdrs[0].get('EXTNAME') == 'LIMSMETAPRIMARYHDU'
+    assert hdrs[1].get('NAXIS2') == 2
+    assert hdrs[1].data_size() == 2*4*2
+    assert hdrs[1].data_offset % headers.BLOCK_SIZE == 0
+
+def test_good():
+    write([primary(), spots(ampnum=[1,2], pixcount=[3,4], spotx=[5,6], spoty=[7,8])])
+    base.validate_headers(test_filename)
+    pyfits.open(test_filename, lazy=True).validate(header_only=True)
+
+def test_missing_card():
+    p = primary()
+    p.header['USERNAME'] = ''
+    write([p])
+    _check_fails('USERNAME')
+
+def test_empty_table():
+    write([primary(), spots()])
+    _check_fails('no table data')
+
+def test_wrong_column():
+    s = spots(ampnum=[1], pixcount=[3], spotx=[5], spoty=[7])
+    s.header['TFORM3'] = 'J'
+    s.header['NAXIS1'] = 10
+    write([primary(), s])
+    _check_fails('SpotX')
+
+def test_tform_key():
+    from lcatr.schema.util import tform_key
+    assert tform_key('A64') == tform_key('64A')
+    assert tform_key('E') == tform_key('1E')
+    assert tform_key('E') != tform_key('D')
+    assert tform_key('E15.7', True) == tform_key('E', True)
+
+if __name__ == '__main__':
+    test_raw_headers()
+    test_good()
+    test_missing_card()
+    test_empty_table()
+    test_wrong_column()
+    test_tform_key()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''
+Test caching of HDUList.validate() results
+'''
+
+import os
+import lcatr.schema
+from lcatr.schema import base, util
+import pyfits
+
+test_filename = 'test_validation_cache.fits'
+cache_filename = 'test_validation_cache.db'
+
+def make_file(spotx = [100,200]):
+    hdus = pyfits.HDUList([
+        lcatr.schema.limsmeta.LimsMetaPrimaryHDU(
+            testname = 'TestValidationCache', date_obs = '2012-01-01T00:00:00',
+            username = 'testuser'),
+        lcatr.schema.ptc.PtcColdSpotTableHDU(
+            ampnum = [1,2], pixcount = [10,20], spotx = spotx, spoty = [5,6]),
+        ])
+    if os.path.exists(test_filename):
+        os.remove(test_filename)
+    hdus.writeto(test_filename)
+    return
+
+def use_fresh_cache():
+    for ext in ['', '-wal', '-shm']:
+        if os.path.exists(cache_filename + ext):
+            os.remove(cache_filename + ext)
+        continue
+    util.use_result_cache(cache_filename)
+    return
+
+def open_counted(**kwds):
+    '''
+    Open the test file and count calls to each HDU's validate().
+    '''
+    hl = pyfits.open(test_filename, **kwds)
+    calls = []
+    for hdu in hl:
+        def counted(hdu = hdu, validate = hdu.validate):
+            calls.append(hdu.name)
+            return validate()
+        hdu.validate = counted
+        continue
+    return hl, calls
+
+def test_validation_cache():
+    make_file()
+    use_fresh_cache()
+    try:
+        hl, calls = open_counted()
+        hl.validate()
+        assert len(calls) == 2, calls
+        assert len(util.result_cache) == 2
+
+        # known good, for both kinds of open
+        for lazy in [False, True]:
+            hl, calls = open_counted(lazy = lazy)
+            hl.validate()
+            assert not calls, calls
+            hl.validate(use_cache = False)
+            assert len(calls) == 2, calls
+
+        # a modified table is validated
+        hl, calls = open_counted()
+        hl[1].set_column_array('SpotX', [1,2])
+        hl.validate()
+        assert len(calls) == 2, calls
+
+        # as is everything once the file changes
+        make_file([300,400])
+        hl, calls = open_counted()
+        hl.validate()
+        assert len(calls) == 2, calls
+    finally:
+        util.use_result_cache(None)
+    return
+
+def test_schema_change():
+    klass = lcatr.schema.ptc.PtcColdSpotTableHDU
+    before = klass.schema_fingerprint()
+    make_file()
+    use_fresh_cache()
+    try:
+        pyfits.open(test_filename).validate()
+        saved = klass.required_columns
+        klass.required_columns = saved[:-1]
+        try:
+            assert klass.schema_fingerprint() != before
+            hl, calls = open_counted()
+            hl.validate()
+            assert calls == [hl[1].name], calls
+        finally:
+            klass.required_columns = saved
+        assert klass.schema_fingerprint() == before
+    finally:
+        util.use_result_cache(None)
+    return
+
+def test_schema_edit_in_place():
+    klass = lcatr.schema.ptc.PtcColdSpotTableHDU
+    before = klass.schema_fingerprint()
+    make_file()
+    use_fresh_cache()
+    try:
+        pyfits.open(test_filename).validate()
+        columns = klass.required_columns
+        saved = columns[1]
+        # same list, same length: only the constraint changes
+        columns[1] = saved[:3] + (dict(min=15),)
+        try:
+            assert klass.schema_fingerprint() != before
+            hl, calls = open_counted()
+            try:
+                hl.validate()
+            except ValueError, msg:
+                print 'Caught expected:', msg
+                assert 'PixCount min=15 at rows 0' in str(msg)
+            else:
+                raise ValueError, 'expected the edited schema to fail the file'
+            assert calls == [hl[1].name], calls
+        finally:
+            columns[1] = saved
+        assert klass.schema_fingerprint() == before
+        hl, calls = open_counted()
+        hl.validate()
+        assert calls == [], calls
+    finally:
+        util.use_result_cache(None)
+    return
+
+if __name__ == '__main__':
+    test_validation_cache()
+    test_schema_change()
+    test_schema_edit_in_place()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+Test the in-process FITS structure verifier
+'''
+
+import os
+import numpy
+import pyfits
+import lcatr.schema
+from lcatr.schema.verifier import verify_file, binary_tform_width, ascii_tform_width
+
+test_filename = 'test_verifier.fits'
+
+def write_tables():
+    cols = [pyfits.Column(name='Num', format='I', array=range(10)),
+            pyfits.Column(name='Name', format='A8', array=['n%d' % n for n in range(10)])]
+    hdus = pyfits.HDUList([pyfits.PrimaryHDU(),
+                           pyfits.new_table(cols, tbtype='BinTableHDU')])
+    if os.path.exists(test_filename):
+        os.remove(test_filename)
+    hdus.writeto(test_filename)
+    return open(test_filename,'rb').read()
+
+def rewrite(data):
+    fp = open(test_filename,'wb')
+    fp.write(data)
+    fp.close()
+    return verify_file(test_filename)
+
+def expect_error(errors, what):
+    print errors
+    assert errors, 'expected an error about "%s"' % what
+    assert [e for e in errors if what in e], errors
+
+def test_good():
+    write_tables()
+    assert verify_file(test_filename) is None
+
+def test_truncated():
+    data = write_tables()
+    errors = rewrite(data[:-100])
+    expect_error(errors, 'not a multiple of 2880')
+    expect_error(errors, 'data is truncated')
+
+    # data filling whole blocks, cut at a block boundary
+    data = numpy.zeros((10, 72), dtype=numpy.float32)
+    if os.path.exists(test_filename):
+        os.remove(test_filename)
+    pyfits.HDUList([pyfits.PrimaryHDU(data)]).writeto(test_filename)
+    data = open(test_filename,'rb').read()
+    assert len(data) == 2*2880
+    assert rewrite(data) is None
+    expect_error(rewrite(data[:2880]), 'data is truncated')
+
+def test_bad_padding():
+    data = write_tables()
+    # last block holds the table data, padded with zeros
+    expect_error(rewrite(data[:-1] + 'x'), 'not padded with zeros')
+
+def test_keyword_order():
+    data = write_tables()
+    bitpix = data.index('BITPIX')
+    naxis = data.index('NAXIS ')
+    swapped = data[:bitpix] + data[naxis:naxis+80] + data[bitpix:bitpix+80] + data[naxis+80:]
+    expect_error(rewrite(swapped), 'keyword #2 should be BITPIX')
+
+def test_tbcol_in_binary():
+    data = write_tables()
+    tfields = data.index('TFIELDS', 2880)
+    card = 'TBCOL1  = %20d' % 1
+    card = card + ' '*(80 - len(card))
+    # overwrite a card after the mandatory ones
+    data = data[:tfields+80] + card + data[tfields+160:]
+    expect_error(rewrite(data), 'TBCOL1 is not allowed in the Binary table')
+
+def test_tform_widths():
+    assert binary_tform_width('64A') == 64
+    assert binary_tform_width('3E') == 12
+    assert binary_tform_width('12X') == 2
+    assert binary_tform_width('1PE(100)') == 8
+    assert binary_tform_width('E15.7') is None
+    assert ascii_tform_width('E15.7') == 15
+    assert ascii_tform_width('I10') == 10
+    assert ascii_tform_width('E') is None
+
+if __name__ == '__main__':
+    test_good()
+    test_truncated()
+    test_bad_padding()
+    test_keyword_order()
+    test_tbcol_in_binary()
+    test_tform_widths()